@@ -0,0 +1,219 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Google, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Activity: post-trade bookkeeping, batched per market off the request path.
+
+Committed trades are queued as pull tasks tagged by market. One worker per
+market per FOLD_INTERVAL starts once its interval is over, leases everything
+queued for the market and folds the price ticks into the bars (rollups.py)
+and the volume into the activity counters (stats.py), with one transaction
+each however many trades were made. Locally the work is done as soon as it is
+queued.
+"""
+
+import webapp2
+
+import collections
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+import rollups
+import stats
+
+from models import to_timestamp
+from google.appengine.ext import ndb
+
+# Seconds per worker bucket; at most one worker per market starts per bucket.
+FOLD_INTERVAL = 5
+# Queued records leased per fold.
+MAX_LEASE = 500
+# How long a worker holds leased records before they are handed out again.
+LEASE_SECONDS = 60
+
+
+class LocalActivityQueue(object):
+  """In-process queue of records per market.
+
+  Folds on notify, or if not inline, gathers the markets to fold on run().
+  """
+
+  def __init__(self, inline=True):
+    self._lock = threading.Lock()
+    self._queues = collections.defaultdict(collections.deque)
+    self._inline = inline
+    self.pending = collections.OrderedDict()
+
+  def add(self, prediction_key, payload):
+    with self._lock:
+      self._queues[prediction_key.urlsafe()].append(payload)
+
+  def lease(self, prediction_key, max_tasks):
+    """Returns up to max_tasks (payload, handle) pairs in queue order."""
+    with self._lock:
+      queue = self._queues[prediction_key.urlsafe()]
+      return [(queue.popleft(), None)
+              for _ in range(min(max_tasks, len(queue)))]
+
+  def delete(self, handles):
+    pass
+
+  def release(self, prediction_key, leased):
+    with self._lock:
+      self._queues[prediction_key.urlsafe()].extendleft(
+          reversed([payload for payload, _ in leased]))
+
+  def notify(self, prediction_key):
+    if self._inline:
+      fold(prediction_key)
+    else:
+      self.pending[prediction_key] = True
+
+  def run(self):
+    while self.pending:
+      prediction_key, _ = self.pending.popitem(last=False)
+      fold(prediction_key)
+
+
+class PullActivityQueue(object):
+  """App Engine pull queue of records, tagged by market."""
+
+  def __init__(self, queue_name='activity', worker_queue_name='activity-fold',
+               worker_url='/tasks/activity', clock=time.time):
+    from google.appengine.api import taskqueue
+    self._taskqueue = taskqueue
+    self._queue = taskqueue.Queue(queue_name)
+    self._worker_queue_name = worker_queue_name
+    self._worker_url = worker_url
+    self._clock = clock
+
+  def add(self, prediction_key, payload):
+    self._queue.add(self._taskqueue.Task(
+        payload=payload, method='PULL', tag=prediction_key.urlsafe()))
+
+  def lease(self, prediction_key, max_tasks):
+    """Returns up to max_tasks (payload, task) pairs in queue order."""
+    tasks = self._queue.lease_tasks_by_tag(
+        LEASE_SECONDS, max_tasks, tag=prediction_key.urlsafe())
+    return [(task.payload, task) for task in tasks]
+
+  def delete(self, handles):
+    self._queue.delete_tasks(handles)
+
+  def release(self, prediction_key, leased):
+    for _, task in leased:
+      self._queue.modify_task_lease(task, 0)
+
+  def notify(self, prediction_key):
+    """Makes sure a worker for the market runs after this record was added."""
+    prediction_id = prediction_key.urlsafe()
+    bucket = int(self._clock() // FOLD_INTERVAL) + 1
+    try:
+      self._taskqueue.add(
+          url=self._worker_url,
+          params={'prediction_id': prediction_id},
+          name='fold-%s-%d' % (prediction_id, bucket),
+          eta=datetime.datetime.utcfromtimestamp(bucket * FOLD_INTERVAL),
+          queue_name=self._worker_queue_name)
+    except (self._taskqueue.TaskAlreadyExistsError,
+            self._taskqueue.TombstonedTaskError):
+      # The bucket's worker is already scheduled and has not started yet.
+      pass
+
+
+def _default_backend():
+  if os.environ.get('SERVER_SOFTWARE'):
+    return PullActivityQueue()
+  return LocalActivityQueue()
+
+
+backend = _default_backend()
+
+
+def record(prediction_key, trades, new_traders=0):
+  """Queues the committed trades of one market for folding.
+
+  new_traders is how many of the trades were their trader's first in the
+  market. Runs after the trades have committed, so a failure to queue is
+  logged rather than raised.
+  """
+  if not trades:
+    return
+  now = to_timestamp(datetime.datetime.now())
+  payload = json.dumps({
+      'ticks': [[now, trade.price_after] for trade in trades],
+      'volume': sum(abs(trade.cost) for trade in trades),
+      'traders': new_traders})
+  try:
+    backend.add(prediction_key, payload)
+    backend.notify(prediction_key)
+  except Exception:
+    logging.warning('Dropped activity of %d trades for %s', len(trades),
+                    prediction_key.urlsafe(), exc_info=True)
+
+
+def _fold_batch(prediction_key, payloads):
+  ticks = []
+  hours = collections.defaultdict(lambda: [0.00, 0, 0])
+  for payload in payloads:
+    record = json.loads(payload)
+    ticks.extend((datetime.datetime.utcfromtimestamp(when), price)
+                 for when, price in record['ticks'])
+    counts = hours[int(record['ticks'][0][0] // 3600)]
+    counts[0] += record['volume']
+    counts[1] += len(record['ticks'])
+    counts[2] += record['traders']
+  # Ticks of one payload share a time; a stable sort keeps them in fill order.
+  ticks.sort(key=lambda tick: tick[0])
+  # Folding ticks twice is harmless, so the counters go last.
+  rollups.record_ticks(prediction_key, ticks)
+  stats.record_activity(prediction_key,
+                        dict((hour, tuple(c)) for hour, c in hours.items()))
+
+
+def fold(prediction_key):
+  """Folds a market's queued records until its queue is empty.
+
+  A batch that fails is handed back to the queue and the error raised, so the
+  worker task is retried. Returns how many records were folded.
+  """
+  folded = 0
+  while True:
+    leased = backend.lease(prediction_key, MAX_LEASE)
+    if not leased:
+      return folded
+    try:
+      _fold_batch(prediction_key, [payload for payload, _ in leased])
+    except Exception:
+      backend.release(prediction_key, leased)
+      raise
+    backend.delete([handle for _, handle in leased])
+    folded += len(leased)
+
+
+class ActivityHandler(webapp2.RequestHandler):
+
+  def post(self):
+    prediction_key = ndb.Key(urlsafe=self.request.get('prediction_id'))
+    folded = fold(prediction_key)
+    logging.info('Folded %d activity records for %s', folded,
+                 prediction_key.urlsafe())
+    self.response.status = 204
+
+
+app = webapp2.WSGIApplication([('/.*', ActivityHandler),], debug=True)
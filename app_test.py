@@ -26,20 +26,61 @@ if __name__ == '__main__':
 
 import unittest
 import datetime
+import json
+import marshal
+import os
+import StringIO
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
+from google.appengine.datastore import datastore_stub_util
 from google.appengine.ext import ndb
 from google.appengine.ext import testbed
 
+import flask
+import numpy as np
+
+import activity
+import instrument
+import leaderboard
+import loadtest
+import lmsr
+import market_cache
+import profiling
+import rollups
+import sequencer
+import stats
+from models import ActivityShard
 from models import Trade
 from models import Prediction
 from models import Profile
 from models import LedgerRecords
+from models import Price
+from models import PriceHistory
+from models import get_entity
+from models import get_prediction_page
 from models import get_price_for_trade
+from models import get_prices_for_predictions
+from models import quote_trades
+from models import Standing
+from models import standing_key
+from models import value_positions
+from models import history_key
+from models import get_trade_history_page
+from models import ledger_key
 from models import calculate_trade_from_likelihood
+from models import calculate_trades_from_likelihoods
+from models import to_timestamp
 from main import CreateTrade
+from main import CreateTradeAction
+from main import CreateTradesAction
 from main import GetPriceByPredictionId
+from main import app
+import scorer
 from scorer import scoring
+from migrate import backfill_prices
+from migrate import migrate
+import price
 
 # [END imports]
 
@@ -109,6 +150,227 @@ class PriceTestCase(unittest.TestCase):
     priceSale = get_price_for_trade(prediction_key.get(), trade)
     self.assertEqual(-5.124947951362557, priceSale)
 
+  def testPricesForPredictions(self):
+    predictions = [
+        Prediction(contract_one=0.00, contract_two=0.00, liquidity=100,
+                   statement="Test", end_time=datetime.datetime.now()),
+        Prediction(contract_one=30.00, contract_two=10.00, liquidity=50,
+                   statement="Test", end_time=datetime.datetime.now())]
+    prices = get_prices_for_predictions(predictions)
+    for prediction, value in zip(predictions, prices):
+      self.assertAlmostEqual(prediction.GetPriceByPredictionId(), value)
+    self.assertEqual([], get_prices_for_predictions([]))
+
+
+class PredictionPageTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testPagesThroughOrg(self):
+    now = datetime.datetime.now()
+    for i in range(3):
+      Prediction(statement="Test %d" % i, org='a', info='Long info',
+                 end_time=now + datetime.timedelta(days=i)).put()
+    Prediction(statement="Other", org='b', end_time=now).put()
+    first, cursor, more = get_prediction_page(org='a', limit=2)
+    self.assertEqual(['Test 0', 'Test 1'], [p.statement for p in first])
+    self.assertTrue(more)
+    second, _, _ = get_prediction_page(
+        org='a', limit=2, cursor=cursor.urlsafe())
+    self.assertEqual(['Test 2'], [p.statement for p in second])
+
+
+class LmsrTestCase(unittest.TestCase):
+
+  def testPriceDoesNotOverflow(self):
+    self.assertEqual(1.0, lmsr.price(1e6, 0.00, 100))
+    self.assertEqual(0.0, lmsr.price(0.00, 1e6, 100))
+    self.assertAlmostEqual(5.124947951362557,
+                           lmsr.trade_cost(1e6, 1e6, 100, 'CONTRACT_TWO',
+                                           'BUY', 10.00), places=6)
+
+  def testVectorizedQuoteMatchesScalar(self):
+    costs, prices = lmsr.quote(
+        np.array([0.00, 10.00, 5.00]), np.array([0.00, 0.00, 20.00]),
+        np.array([100, 100, 50]),
+        ['CONTRACT_ONE', 'CONTRACT_ONE', 'CONTRACT_TWO'],
+        ['BUY', 'SELL', 'BUY'], [10.00, 10.00, 3.00])
+    self.assertAlmostEqual(5.124947951362557, costs[0])
+    self.assertAlmostEqual(-5.124947951362557, costs[1])
+    self.assertAlmostEqual(
+        lmsr.trade_cost(5.00, 20.00, 50, 'CONTRACT_TWO', 'BUY', 3.00),
+        costs[2])
+    self.assertAlmostEqual(lmsr.price(5.00, 23.00, 50), prices[2])
+
+
+class IdentityMapTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+    self.app = flask.Flask(__name__)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testSameEntityWithinRequest(self):
+    user_key = Profile(balance=100).put()
+    with self.app.test_request_context():
+      profile = get_entity(user_key)
+      self.assertIs(profile, get_entity(user_key))
+      profile.balance = 50
+      profile.put()
+      self.assertNotIn(user_key, flask.g.entities)
+      self.assertEqual(50, get_entity(user_key).balance)
+    with self.app.test_request_context():
+      self.assertFalse(hasattr(flask.g, 'entities'))
+
+
+class MarketCacheTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+    market_cache.backend.clear()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testPutWritesMarketThrough(self):
+    prediction = Prediction(
+        contract_one=0.00, contract_two=0.00, liquidity=100,
+        statement="Test", end_time=datetime.datetime.now())
+    prediction_key = prediction.put()
+    missing_key = ndb.Key('Prediction', 'missing')
+    markets = market_cache.get_markets([prediction_key, missing_key])
+    self.assertEqual(0.5, markets[0].price())
+    self.assertIsNone(markets[1])
+    prediction.contract_one = 10.00
+    prediction.put()
+    self.assertEqual(prediction.GetPriceByPredictionId(),
+                     market_cache.get_market(prediction_key).price())
+
+  def testOlderStateIsRefused(self):
+    prediction = Prediction(
+        contract_one=0.00, contract_two=0.00, liquidity=100,
+        statement="Test", end_time=datetime.datetime.now())
+    prediction_key = prediction.put()
+    stale = market_cache.get_market(prediction_key)
+    prediction.contract_one = 10.00
+    prediction.put()
+    # A reader that missed before the put adds what it loaded afterwards,
+    # and a slower writer writes through the state before it.
+    cache_key = market_cache._cache_key(prediction_key)
+    market_cache.backend.add(cache_key, stale)
+    market_cache.backend.update(cache_key, stale)
+    self.assertEqual(prediction.GetPriceByPredictionId(),
+                     market_cache.get_market(prediction_key).price())
+
+  def testTradeKeepsMarketCached(self):
+    user_key = Profile(id='user', user_id='user', balance=100).put()
+    prediction_key = Prediction(
+        contract_one=0.00, contract_two=0.00, liquidity=100,
+        statement="Test", end_time=datetime.datetime.now()).put()
+    market_cache.get_market(prediction_key)
+    trade = Trade(prediction_id=prediction_key, user_id=user_key,
+                  direction='BUY', contract='CONTRACT_ONE', quantity=10.00)
+    CreateTradeAction(prediction_key.get(), user_key.get(), trade)
+    cached = market_cache.backend.get(market_cache._cache_key(prediction_key))
+    self.assertEqual(prediction_key.get().GetPriceByPredictionId(),
+                     cached.price())
+
+
+class QuoteTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+    market_cache.backend.clear()
+    self.client = app.test_client()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testQuoteLadderMatchesTrades(self):
+    prediction = Prediction(
+        contract_one=10.00, contract_two=0.00, liquidity=100,
+        statement="Test", end_time=datetime.datetime.now())
+    costs, prices = quote_trades(
+        prediction, ['CONTRACT_ONE', 'CONTRACT_TWO'], 'SELL', [10.00, 5.00])
+    for contract, quantity, cost in zip(
+        ['CONTRACT_ONE', 'CONTRACT_TWO'], [10.00, 5.00], costs):
+      trade = Trade(direction='SELL', contract=contract, quantity=quantity)
+      self.assertAlmostEqual(get_price_for_trade(prediction, trade), cost)
+    self.assertAlmostEqual(0.5, prices[0])
+
+  def testQuoteEndpointDoesNotWrite(self):
+    prediction_key = Prediction(
+        contract_one=0.00, contract_two=0.00, liquidity=100,
+        statement="Test", end_time=datetime.datetime.now()).put()
+    response = self.client.get(
+        '/predictions/%s/quote?quantity=10&quantity=20&target=0.75'
+        % prediction_key.urlsafe())
+    self.assertEqual(200, response.status_code)
+    result = json.loads(response.data)
+    self.assertEqual(2, len(result['quotes']))
+    self.assertAlmostEqual(5.124947951362557, result['quotes'][0]['cost'])
+    self.assertAlmostEqual(100 * np.log(3), result['target']['quantity'])
+    self.assertEqual(0.00, prediction_key.get().contract_one)
+    self.assertEqual(0, Trade.query().count())
+    response = self.client.get(
+        '/predictions/%s/quote?target=2' % prediction_key.urlsafe())
+    self.assertEqual(400, response.status_code)
+
+
+class ValuationTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+    market_cache.backend.clear()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testValuesPositionsAtMarket(self):
+    prediction = Prediction(
+        contract_one=30.00, contract_two=10.00, liquidity=50,
+        statement="Test", end_time=datetime.datetime.now())
+    prediction_key = prediction.put()
+    positions = [
+        LedgerRecords(prediction_id=prediction_key.urlsafe(),
+                      contract_one=4.00, contract_two=2.00),
+        LedgerRecords(prediction_id=ndb.Key('Prediction', 1).urlsafe(),
+                      contract_one=1.00, contract_two=0.00)]
+    valuations, total = value_positions(positions)
+    price = prediction.GetPriceByPredictionId()
+    self.assertEqual("Test", valuations[0].market.statement)
+    self.assertAlmostEqual(price, valuations[0].price)
+    self.assertAlmostEqual(4 * price + 2 * (1 - price), valuations[0].value)
+    self.assertIsNone(valuations[1])
+    self.assertAlmostEqual(valuations[0].value, total)
+    self.assertEqual(([], 0.0), value_positions([]))
+
 
 class TradeTestCase(unittest.TestCase):
 
@@ -118,6 +380,7 @@ class TradeTestCase(unittest.TestCase):
     self.testbed.init_datastore_v3_stub()
     self.testbed.init_memcache_stub()
     ndb.get_context().clear_cache()
+    market_cache.backend.clear()
 
   def tearDown(self):
     self.testbed.deactivate()
@@ -133,14 +396,498 @@ class TradeTestCase(unittest.TestCase):
                                                        profile)
     self.assertEqual(29.789603833999628, trade_likeliness.quantity)
 
+  def testRebalanceSharesBankroll(self):
+    keys = [Prediction(contract_one=0.00, contract_two=0.00, liquidity=100,
+                       statement="Test",
+                       end_time=datetime.datetime.now()).put()
+            for _ in range(3)]
+    user_key = Profile(balance=100).put()
+    LedgerRecords(key=ledger_key(user_key, keys[2]), contract_one=5.00,
+                  contract_two=0.00).put()
+    profile = user_key.get()
+    single = calculate_trade_from_likelihood(90, keys[0].get(), profile)
+    trades = calculate_trades_from_likelihoods(
+        {keys[0]: 90, keys[1]: 50, keys[2]: 10}, profile)
+    trades = dict((t.prediction_id, t) for t in trades)
+    self.assertEqual(set([keys[0], keys[2]]), set(trades))
+    self.assertEqual(('BUY', 'CONTRACT_ONE'),
+                     (trades[keys[0]].direction, trades[keys[0]].contract))
+    self.assertAlmostEqual(single.quantity, trades[keys[0]].quantity)
+    self.assertEqual(('SELL', 'CONTRACT_ONE', 5.00),
+                     (trades[keys[2]].direction, trades[keys[2]].contract,
+                      trades[keys[2]].quantity))
+    # Two full Kelly bets of 80% each are scaled to half the bankroll each.
+    trades = calculate_trades_from_likelihoods(
+        {keys[0]: 90, keys[1]: 10}, profile)
+    for trade in trades:
+      self.assertAlmostEqual(
+          10.00, get_price_for_trade(trade.prediction_id.get(), trade))
+
+  def testRebalanceAtCertainPrice(self):
+    prediction_key = Prediction(
+        contract_one=10000.00, contract_two=0.00, liquidity=1,
+        statement="Test", end_time=datetime.datetime.now()).put()
+    self.assertEqual(1.0, prediction_key.get().GetPriceByPredictionId())
+    profile = Profile(balance=100).put().get()
+    trades = calculate_trades_from_likelihoods({prediction_key: 50}, profile)
+    self.assertEqual(1, len(trades))
+    self.assertEqual(('BUY', 'CONTRACT_TWO'),
+                     (trades[0].direction, trades[0].contract))
+    self.assertTrue(0 < trades[0].quantity < float('inf'))
 
-class ScoringTestCase(unittest.TestCase):
+
+class TradeActionTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    # Cross-group transactions need the high replication policy.
+    self.testbed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1))
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testBuyThenOversell(self):
+    prediction_key = Prediction(
+        contract_one=0.00, contract_two=0.00, liquidity=100,
+        statement="Test", end_time=datetime.datetime.now()).put()
+    user_key = Profile(id='user', user_id='user', balance=100).put()
+    trade = Trade(
+        prediction_id=prediction_key,
+        user_id=user_key,
+        direction='BUY',
+        contract='CONTRACT_ONE',
+        quantity=10.00)
+    self.assertIsNone(
+        CreateTradeAction(prediction_key.get(), user_key.get(), trade))
+    self.assertEqual(10.00, prediction_key.get().contract_one)
+    self.assertAlmostEqual(100 - 5.124947951362557, user_key.get().balance)
+    self.assertEqual(
+        10.00, ledger_key(user_key, prediction_key).get().contract_one)
+    oversell = Trade(
+        prediction_id=prediction_key,
+        user_id=user_key,
+        direction='SELL',
+        contract='CONTRACT_ONE',
+        quantity=20.00)
+    self.assertEqual(
+        'error',
+        CreateTradeAction(prediction_key.get(), user_key.get(), oversell))
+    self.assertEqual(10.00, prediction_key.get().contract_one)
+    self.assertEqual(1, Trade.query().count())
+
+  def testTradesRecordFillAndPnl(self):
+    prediction_key = Prediction(
+        contract_one=0.00, contract_two=0.00, liquidity=100,
+        statement="Test", end_time=datetime.datetime.now()).put()
+    user_key = Profile(id='user', user_id='user', balance=100).put()
+    for direction, quantity in [('BUY', 10.00), ('SELL', 4.00)]:
+      CreateTradeAction(prediction_key.get(), user_key.get(), Trade(
+          prediction_id=prediction_key, user_id=user_key,
+          direction=direction, contract='CONTRACT_ONE', quantity=quantity))
+    buy, sell = Trade.query().order(Trade.creation_time).fetch()
+    self.assertAlmostEqual(5.124947951362557, buy.cost)
+    self.assertEqual(0.5, buy.price_before)
+    self.assertAlmostEqual(lmsr.price(10.00, 0.00, 100), buy.price_after)
+    self.assertEqual(buy.price_after, sell.price_before)
+    self.assertEqual((6.00, 0.00),
+                     (sell.contract_one_after, sell.contract_two_after))
+    position = ledger_key(user_key, prediction_key).get()
+    self.assertAlmostEqual(buy.cost * 0.6, position.cost_one)
+    self.assertAlmostEqual(-sell.cost - buy.cost * 0.4,
+                           position.realized_pnl)
+
+
+class InstrumentationTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+    market_cache.backend.clear()
+    instrument.reset()
+    self.client = app.test_client()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testCountsRpcsByRoute(self):
+    prediction_key = Prediction(
+        contract_one=0.00, contract_two=0.00, liquidity=100,
+        statement="Test", end_time=datetime.datetime.now()).put()
+    ndb.get_context().clear_cache()
+    market_cache.backend.clear()
+    response = self.client.get(
+        '/predictions/%s/quote?quantity=10' % prediction_key.urlsafe())
+    self.assertIn('datastore;dur=', response.headers['Server-Timing'])
+    response.close()
+    route = instrument.histograms()['/predictions/<string:prediction_id>/quote']
+    self.assertEqual(1, route['requests'])
+    self.assertEqual(1, route['calls']['datastore_v3.Get'])
+    self.assertEqual(sum(route['calls'].values()), route['rpcs']['total'])
+    self.assertIsNone(instrument.current())
+
+  def testOverlappingRpcsCountedOnce(self):
+    now = [10.000]
+    self.addCleanup(setattr, instrument, '_clock', instrument._clock)
+    instrument._clock = lambda: now[0]
+    stats = instrument._state.stats = instrument.RequestStats()
+    self.addCleanup(setattr, instrument._state, 'stats', None)
+    first, second, third = object(), object(), object()
+    instrument._pre_call('memcache', 'Get', first, None)
+    now[0] = 10.010
+    instrument._pre_call('memcache', 'Get', second, None)
+    now[0] = 10.020
+    instrument._post_call('memcache', 'Get', first, None)
+    now[0] = 10.030
+    instrument._post_call('memcache', 'Get', second, None)
+    now[0] = 10.100
+    instrument._pre_call('memcache', 'Get', third, None)
+    now[0] = 10.105
+    instrument._post_call('memcache', 'Get', third, None)
+    self.assertEqual(3, stats.rpcs())
+    self.assertAlmostEqual(35.0, stats.rpc_ms)
+
+  def testTransactionGetsCountedApart(self):
+    instrument._install_hooks()
+    prediction_key = Prediction(
+        contract_one=0.00, contract_two=0.00, liquidity=100,
+        statement="Test", end_time=datetime.datetime.now()).put()
+    ndb.get_context().clear_cache()
+    stats = instrument._state.stats = instrument.RequestStats()
+    self.addCleanup(setattr, instrument._state, 'stats', None)
+    prediction_key.get()
+    ndb.transaction(prediction_key.get)
+    self.assertEqual([1], stats.gets.values())
+    self.assertEqual(1, stats.transaction_gets)
+
+
+class ProfilingTestCase(unittest.TestCase):
+
+  ROUTE = '/predictions/<string:prediction_id>/quote'
 
   def setUp(self):
     self.testbed = testbed.Testbed()
     self.testbed.activate()
     self.testbed.init_datastore_v3_stub()
     self.testbed.init_memcache_stub()
+    self.testbed.init_user_stub()
+    ndb.get_context().clear_cache()
+    profiling.reset()
+    self.client = app.test_client()
+    self.prediction_key = Prediction(
+        contract_one=0.00, contract_two=0.00, liquidity=100,
+        statement="Test", end_time=datetime.datetime.now()).put()
+
+  def tearDown(self):
+    profiling.set_settings([], 0)
+    profiling.reset()
+    self.testbed.deactivate()
+
+  def quote(self, **headers):
+    self.client.get(
+        '/predictions/%s/quote?quantity=10' % self.prediction_key.urlsafe(),
+        headers=headers).close()
+
+  def testSamplesChosenRoutes(self):
+    self.quote()
+    self.assertEqual({}, profiling.profiled_counts())
+    profiling.set_settings([self.ROUTE], 1)
+    self.quote()
+    self.quote()
+    self.client.get('/faq').close()
+    self.assertEqual({self.ROUTE: 2}, profiling.profiled_counts())
+    stats = marshal.loads(profiling.dump(self.ROUTE))
+    self.assertTrue(any(name == 'GetQuote' for _, _, name in stats))
+
+  def testHeaderOnlyHonouredForAdmins(self):
+    profiling.set_settings([self.ROUTE], 0)
+    self.quote(**{'X-Profile': '1'})
+    self.assertEqual({}, profiling.profiled_counts())
+    self.testbed.setup_env(USER_IS_ADMIN='1', overwrite=True)
+    self.quote(**{'X-Profile': '1'})
+    self.assertEqual({self.ROUTE: 1}, profiling.profiled_counts())
+
+  def testDownloadsDump(self):
+    profiling.set_settings([self.ROUTE], 1)
+    self.quote()
+    response = self.client.get('/admin/profiler/dump?route=' + self.ROUTE)
+    self.assertEqual(200, response.status_code)
+    self.assertIn('attachment', response.headers['Content-Disposition'])
+    self.assertTrue(marshal.loads(response.data))
+    response = self.client.get('/admin/profiler/dump?route=/faq')
+    self.assertEqual(404, response.status_code)
+
+
+class BatchTradeTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.setup_env(
+        USER_EMAIL='user@example.com', USER_ID='user', overwrite=True)
+    self.testbed.init_user_stub()
+    self.testbed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1))
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+    self.client = app.test_client()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testFillsAndRejectsPerTrade(self):
+    first_key, second_key = [
+        Prediction(contract_one=0.00, contract_two=0.00, liquidity=100,
+                   statement="Test", end_time=datetime.datetime.now()).put()
+        for _ in range(2)]
+    user_key = Profile(id='user', user_id='user', balance=100).put()
+    orders = [
+        dict(prediction_id=first_key.urlsafe(), direction='BUY',
+             contract='CONTRACT_ONE', quantity=10),
+        dict(prediction_id=second_key.urlsafe(), direction='SELL',
+             contract='CONTRACT_TWO', quantity=5),
+        dict(prediction_id=first_key.urlsafe(), direction='SELL',
+             contract='CONTRACT_ONE', quantity=4),
+        dict(prediction_id='bogus', direction='BUY',
+             contract='CONTRACT_ONE', quantity=1)]
+    response = self.client.post(
+        '/trades/batch', data=json.dumps(dict(trades=orders)),
+        content_type='application/json')
+    self.assertEqual(200, response.status_code)
+    results = json.loads(response.data)['trades']
+    self.assertEqual(['FILLED', 'REJECTED', 'FILLED', 'REJECTED'],
+                     [r['status'] for r in results])
+    self.assertAlmostEqual(5.124947951362557, results[0]['cost'])
+    self.assertEqual(6.00, first_key.get().contract_one)
+    self.assertEqual(0.00, second_key.get().contract_two)
+    self.assertEqual(
+        6.00, ledger_key(user_key, first_key).get().contract_one)
+    self.assertAlmostEqual(
+        100 - results[0]['cost'] - results[2]['cost'],
+        user_key.get().balance)
+    self.assertEqual(2, Trade.query(ancestor=user_key).count())
+
+  def testRebalanceWithoutProfile(self):
+    prediction_key = Prediction(
+        contract_one=0.00, contract_two=0.00, liquidity=100,
+        statement="Test", end_time=datetime.datetime.now()).put()
+    response = self.client.post(
+        '/trades/rebalance',
+        data=json.dumps(dict(likelihoods={prediction_key.urlsafe(): 90})),
+        content_type='application/json')
+    self.assertEqual(404, response.status_code)
+
+  def testSequencingModeQueuesTrades(self):
+    sequencer.backend = sequencer.LocalTradeQueue()
+    app.config['SEQUENCE_TRADES'] = True
+    self.addCleanup(app.config.__setitem__, 'SEQUENCE_TRADES', False)
+    prediction_key = Prediction(
+        contract_one=0.00, contract_two=0.00, liquidity=100,
+        statement="Test", end_time=datetime.datetime.now()).put()
+    user_key = Profile(id='user', user_id='user', balance=100).put()
+    orders = [
+        dict(prediction_id=prediction_key.urlsafe(), direction='BUY',
+             contract='CONTRACT_ONE', quantity=10),
+        dict(prediction_id='bogus', direction='BUY',
+             contract='CONTRACT_ONE', quantity=1)]
+    response = self.client.post(
+        '/trades/batch', data=json.dumps(dict(trades=orders)),
+        content_type='application/json')
+    self.assertEqual(202, response.status_code)
+    results = json.loads(response.data)['trades']
+    self.assertEqual(['PENDING', 'REJECTED'], [r['status'] for r in results])
+    self.assertEqual(0.00, prediction_key.get().contract_one)
+    self.assertEqual(1, sequencer.drain(prediction_key))
+    self.assertEqual(
+        'FILLED', ndb.Key(urlsafe=results[0]['ticket_id']).get().status)
+    self.assertEqual(10.00, prediction_key.get().contract_one)
+
+  def testQueuedFormTradeLinksTicket(self):
+    sequencer.backend = sequencer.LocalTradeQueue()
+    app.config['SEQUENCE_TRADES'] = True
+    self.addCleanup(app.config.__setitem__, 'SEQUENCE_TRADES', False)
+    prediction_key = Prediction(
+        contract_one=0.00, contract_two=0.00, liquidity=100,
+        statement="Test", end_time=datetime.datetime.now()).put()
+    Profile(id='user', user_id='user', balance=100).put()
+    response = self.client.post('/trades/create', data=dict(
+        prediction_id=prediction_key.urlsafe(), is_likelihood='false',
+        direction='BUY', contract='CONTRACT_ONE', quantity='10'))
+    self.assertEqual(302, response.status_code)
+    with self.client.session_transaction() as session:
+      _, message = session['_flashes'][0]
+    ticket_url = message.split('href="')[1].split('"')[0]
+    response = self.client.get(ticket_url)
+    self.assertEqual('PENDING', json.loads(response.data)['status'])
+
+
+class TradeHistoryTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.setup_env(
+        USER_EMAIL='user@example.com', USER_ID='user', overwrite=True)
+    self.testbed.init_user_stub()
+    self.testbed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1))
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+    self.client = app.test_client()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testStreamsFilteredPages(self):
+    prediction_key = Prediction(
+        contract_one=0.00, contract_two=0.00, liquidity=100,
+        statement="Test", end_time=datetime.datetime.now()).put()
+    user_key = Profile(id='user', user_id='user', balance=100).put()
+    for direction, quantity in [('BUY', 10.00), ('SELL', 4.00),
+                                ('BUY', 2.00)]:
+      CreateTradeAction(prediction_key.get(), user_key.get(), Trade(
+          prediction_id=prediction_key, user_id=user_key,
+          direction=direction, contract='CONTRACT_ONE', quantity=quantity))
+    trades, cursor, more = get_trade_history_page(prediction_key, limit=2)
+    self.assertEqual([10.00, 4.00], [t.quantity for t in trades])
+    self.assertTrue(more)
+    trades, _, _ = get_trade_history_page(
+        prediction_key, limit=2, cursor=cursor.urlsafe())
+    self.assertEqual([2.00], [t.quantity for t in trades])
+    response = self.client.get(
+        '/predictions/%s/trades?direction=BUY&user=me'
+        % prediction_key.urlsafe())
+    rows = [json.loads(line) for line in response.data.splitlines()]
+    self.assertEqual([10.00, 2.00], [row['quantity'] for row in rows])
+    self.assertAlmostEqual(5.124947951362557, rows[0]['cost'])
+    response = self.client.get(
+        '/predictions/%s/trades?format=csv&direction=SELL'
+        % prediction_key.urlsafe())
+    lines = response.data.splitlines()
+    self.assertEqual('time,direction,contract,quantity,cost,price_before,'
+                     'price_after', lines[0])
+    self.assertEqual(2, len(lines))
+    self.assertIn(',SELL,CONTRACT_ONE,4.0,', lines[1])
+    response = self.client.get(
+        '/predictions/%s/trades?direction=HOLD' % prediction_key.urlsafe())
+    self.assertEqual(400, response.status_code)
+
+  def testPagesWithCursor(self):
+    prediction_key = Prediction(
+        contract_one=0.00, contract_two=0.00, liquidity=100,
+        statement="Test", end_time=datetime.datetime.now()).put()
+    user_key = Profile(id='user', user_id='user', balance=100).put()
+    for quantity in [1.00, 2.00, 3.00]:
+      CreateTradeAction(prediction_key.get(), user_key.get(), Trade(
+          prediction_id=prediction_key, user_id=user_key,
+          direction='BUY', contract='CONTRACT_ONE', quantity=quantity))
+    url = '/predictions/%s/trades?format=csv&limit=2' % prediction_key.urlsafe()
+    response = self.client.get(url)
+    lines = response.data.splitlines()
+    self.assertEqual(3, len(lines))
+    self.assertTrue(lines[0].startswith('time,'))
+    cursor = response.headers['X-Next-Cursor']
+    response = self.client.get(url + '&cursor=' + cursor)
+    lines = response.data.splitlines()
+    self.assertEqual(1, len(lines))
+    self.assertIn(',BUY,CONTRACT_ONE,3.0,', lines[0])
+    self.assertNotIn('X-Next-Cursor', response.headers)
+    response = self.client.get(url + '&cursor=bogus')
+    self.assertEqual(400, response.status_code)
+
+
+class SequencerTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1))
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+    sequencer.backend = sequencer.LocalTradeQueue()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testDrainAppliesBatchInOrder(self):
+    prediction_key = Prediction(
+        contract_one=0.00, contract_two=0.00, liquidity=100,
+        statement="Test", end_time=datetime.datetime.now()).put()
+    alice = Profile(id='alice', user_id='alice', balance=100).put()
+    bob = Profile(id='bob', user_id='bob', balance=100).put()
+    tickets = [
+        sequencer.enqueue(Trade(prediction_id=prediction_key, user_id=alice,
+                                direction='BUY', contract='CONTRACT_ONE',
+                                quantity=10.00)),
+        sequencer.enqueue(Trade(prediction_id=prediction_key, user_id=bob,
+                                direction='BUY', contract='CONTRACT_ONE',
+                                quantity=5.00)),
+        sequencer.enqueue(Trade(prediction_id=prediction_key, user_id=bob,
+                                direction='SELL', contract='CONTRACT_TWO',
+                                quantity=5.00)),
+    ]
+    self.assertEqual('PENDING', tickets[0].get().status)
+    self.assertEqual(3, sequencer.drain(prediction_key))
+    first, second, third = [t.get() for t in tickets]
+    self.assertEqual('FILLED', first.status)
+    self.assertAlmostEqual(5.124947951362557, first.fill_price)
+    self.assertEqual('FILLED', second.status)
+    self.assertAlmostEqual(
+        lmsr.trade_cost(10.00, 0.00, 100, 'CONTRACT_ONE', 'BUY', 5.00),
+        second.fill_price)
+    self.assertEqual('REJECTED', third.status)
+    self.assertEqual(15.00, prediction_key.get().contract_one)
+    self.assertEqual(2, Trade.query().count())
+    self.assertEqual(0, sequencer.drain(prediction_key))
+
+  def testTicketAfterDrainInSameSecondGetsWorker(self):
+    self.testbed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.abspath(__file__)))
+    stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    now = [1000.2]
+    sequencer.backend = sequencer.PullTradeQueue(clock=lambda: now[0])
+    prediction_key = Prediction(
+        contract_one=0.00, contract_two=0.00, liquidity=100,
+        statement="Test", end_time=datetime.datetime.now()).put()
+    alice = Profile(id='alice', user_id='alice', balance=100).put()
+    first = sequencer.enqueue(Trade(
+        prediction_id=prediction_key, user_id=alice, direction='BUY',
+        contract='CONTRACT_ONE', quantity=1.00))
+    self.assertEqual(1, sequencer.drain(prediction_key))
+    now[0] = 1000.7
+    second = sequencer.enqueue(Trade(
+        prediction_id=prediction_key, user_id=alice, direction='BUY',
+        contract='CONTRACT_ONE', quantity=1.00))
+    self.assertEqual('FILLED', first.get().status)
+    self.assertEqual('PENDING', second.get().status)
+    # The one worker for that second starts only once the second is over.
+    workers = stub.get_filtered_tasks(queue_names=['sequencer'])
+    self.assertEqual(1, len(workers))
+    self.assertGreater(workers[0].eta_posix, now[0])
+    self.assertEqual(1, sequencer.drain(prediction_key))
+    self.assertEqual('FILLED', second.get().status)
+
+
+class ScoringTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1))
+    self.testbed.init_memcache_stub()
 
     ndb.get_context().clear_cache()
 
@@ -156,14 +903,12 @@ class ScoringTestCase(unittest.TestCase):
         outcome='CONTRACT_ONE',
         statement='Test',
         end_time=datetime.datetime.now()).put()
-    user_key = Profile(
-        balance=100,
-        user_ledger=[
-            LedgerRecords(
-                prediction_id=prediction_key.urlsafe(),
-                contract_one=10.00,
-                contract_two=0.00)
-        ]).put()
+    user_key = Profile(balance=100).put()
+    LedgerRecords(
+        key=ledger_key(user_key, prediction_key),
+        prediction_id=prediction_key.urlsafe(),
+        contract_one=10.00,
+        contract_two=0.00).put()
     trade_key = Trade(
         prediction_id=prediction_key,
         user_id=user_key,
@@ -174,8 +919,534 @@ class ScoringTestCase(unittest.TestCase):
     audit = scoring()
     self.assertEqual(10, audit[0]['earned'])
 
+  def testPaysEachTraderOnceAcrossPages(self):
+    prediction_key = Prediction(
+        outcome='CONTRACT_TWO',
+        statement='Test',
+        end_time=datetime.datetime.now()).put()
+    user_keys = []
+    for i in range(scorer.PAGE_SIZE + 5):
+      user_key = Profile(id='user%d' % i, balance=100).put()
+      LedgerRecords(
+          key=ledger_key(user_key, prediction_key),
+          prediction_id=prediction_key.urlsafe(),
+          contract_one=0.00,
+          contract_two=2.00).put()
+      for _ in range(2):
+        Trade(prediction_id=prediction_key, user_id=user_key,
+              direction='BUY', contract='CONTRACT_TWO', quantity=1).put()
+      user_keys.append(user_key)
+    # A deadline in the past pays one page and stops.
+    audit, finished = scorer.score_prediction(prediction_key, deadline=0)
+    self.assertEqual(scorer.PAGE_SIZE, len(audit))
+    self.assertFalse(finished)
+    self.assertFalse(prediction_key.get().resolved)
+    audit, finished = scorer.score_prediction(prediction_key)
+    self.assertEqual(5, len(audit))
+    self.assertTrue(finished)
+    self.assertTrue(prediction_key.get().resolved)
+    self.assertEqual([], scoring())
+    for user_key in user_keys:
+      self.assertEqual(102, user_key.get().balance)
+
+
+class ShardedScoringTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1))
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+    self.shard_size = scorer.SHARD_SIZE
+    scorer.SHARD_SIZE = 2
+    scorer.executor = scorer.LocalExecutor()
+
+  def tearDown(self):
+    scorer.SHARD_SIZE = self.shard_size
+    self.testbed.deactivate()
+
+  def testShardsPayOnceAndResolve(self):
+    prediction_key = Prediction(
+        outcome='CONTRACT_ONE',
+        statement='Test',
+        end_time=datetime.datetime.now()).put()
+    user_keys = []
+    for i in range(5):
+      user_key = Profile(id='user%d' % i, balance=100).put()
+      LedgerRecords(
+          key=ledger_key(user_key, prediction_key),
+          prediction_id=prediction_key.urlsafe(),
+          contract_one=3.00,
+          contract_two=0.00).put()
+      Trade(prediction_id=prediction_key, user_id=user_key,
+            direction='BUY', contract='CONTRACT_ONE', quantity=3).put()
+      user_keys.append(user_key)
+    self.assertEqual([prediction_key], scorer.fan_out())
+    scorer.executor.run()
+    self.assertTrue(prediction_key.get().resolved)
+    # Retrying the plan and its shards must not pay anyone again.
+    scorer.plan_shards(prediction_key.urlsafe())
+    for shard in range(3):
+      scorer.score_shard(prediction_key.urlsafe(), str(shard))
+    scorer.executor.run()
+    for user_key in user_keys:
+      self.assertEqual(103, user_key.get().balance)
+
+  def testSwitchingModesMidPredictionPaysOnce(self):
+    prediction_key = Prediction(
+        outcome='CONTRACT_ONE',
+        statement='Test',
+        end_time=datetime.datetime.now()).put()
+    user_keys = []
+    for i in range(scorer.PAGE_SIZE + 5):
+      user_key = Profile(id='user%02d' % i, balance=100).put()
+      LedgerRecords(
+          key=ledger_key(user_key, prediction_key),
+          prediction_id=prediction_key.urlsafe(),
+          contract_one=3.00,
+          contract_two=0.00).put()
+      Trade(prediction_id=prediction_key, user_id=user_key,
+            direction='BUY', contract='CONTRACT_ONE', quantity=3).put()
+      user_keys.append(user_key)
+    # Serial scoring pays one page, then sharded scoring is switched on.
+    audit, finished = scorer.score_prediction(prediction_key, deadline=0)
+    self.assertFalse(finished)
+    scorer.plan_shards(prediction_key.urlsafe())
+    scorer.executor.run()
+    self.assertTrue(prediction_key.get().resolved)
+    self.assertIsNone(scorer._shard_list_key(prediction_key).get())
+    for user_key in user_keys:
+      self.assertEqual(103, user_key.get().balance)
+
+
+class LeaderboardTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1))
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+    leaderboard.executor = leaderboard.LocalExecutor()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def trade(self, prediction_key, user_key, contract, quantity):
+    CreateTradeAction(prediction_key.get(), user_key.get(), Trade(
+        prediction_id=prediction_key, user_id=user_key, direction='BUY',
+        contract=contract, quantity=quantity))
+
+  def testTradesRevaluesAndPayouts(self):
+    prediction_key = Prediction(
+        contract_one=0.00, contract_two=0.00, liquidity=100, org='acme',
+        statement="Test", end_time=datetime.datetime.now()).put()
+    alice = Profile(id='alice', user_email='alice@example.com',
+                    balance=100).put()
+    bob = Profile(id='bob', user_email='bob@example.com', balance=100).put()
+    self.trade(prediction_key, alice, 'CONTRACT_ONE', 10.00)
+    # The trade records Alice's position outside her entity group.
+    overall = standing_key(alice).get()
+    self.assertIsNone(standing_key(alice).parent())
+    self.assertEqual('alice', overall.name)
+    self.assertEqual(alice.get().balance, overall.cash)
+    self.assertAlmostEqual(10 * lmsr.price(10.00, 0.00, 100),
+                           overall.holdings)
+    org = standing_key(alice, 'acme').get()
+    self.assertAlmostEqual(-5.124947951362557, org.cash)
+    self.assertAlmostEqual(org.cash + org.holdings, org.net_worth)
+    # Bob's trade lowers the price of Alice's shares once revalued, which
+    # only reprices the market's holdings.
+    self.trade(prediction_key, bob, 'CONTRACT_TWO', 30.00)
+    price = prediction_key.get().GetPriceByPredictionId()
+    self.assertNotAlmostEqual(10 * price, standing_key(alice).get().holdings)
+    leaderboard.executor.run()
+    self.assertAlmostEqual(10 * price, standing_key(alice).get().holdings)
+    standings, _, _ = leaderboard.get_leaderboard()
+    self.assertEqual(['bob', 'alice'], [s.name for s in standings])
+    standings, _, _ = leaderboard.get_leaderboard('acme')
+    self.assertEqual(['bob', 'alice'], [s.name for s in standings])
+    self.assertLess(standings[1].net_worth, 0)
+    # Paying out turns Alice's holdings into cash.
+    prediction = prediction_key.get()
+    prediction.outcome = 'CONTRACT_ONE'
+    prediction.put()
+    scoring()
+    overall = standing_key(alice).get()
+    self.assertEqual(0.00, overall.holdings)
+    self.assertEqual(alice.get().balance, overall.cash)
+    self.assertAlmostEqual(10 - 5.124947951362557,
+                           standing_key(alice, 'acme').get().net_worth)
+    # Revaluing or scoring again changes nothing, and a rebuild from scratch
+    # agrees with the standings kept incrementally.
+    self.assertEqual(2, leaderboard.revalue(prediction_key))
+    scoring()
+    kept = [(s.key, s.cash, s.holdings) for s in Standing.query()]
+    self.assertEqual(4, len(kept))
+    self.assertEqual(4, leaderboard.rebuild([alice, bob]))
+    for key, cash, holdings in kept:
+      self.assertAlmostEqual(cash, key.get().cash)
+      self.assertAlmostEqual(holdings, key.get().holdings)
+
+  def testBatchRecordsEveryMarket(self):
+    first_key, second_key = [
+        Prediction(contract_one=0.00, contract_two=0.00, liquidity=100,
+                   org=org, statement="Test",
+                   end_time=datetime.datetime.now()).put()
+        for org in ('acme', 'globex')]
+    alice = Profile(id='alice', user_email='alice@example.com',
+                    balance=100).put()
+    CreateTradesAction(alice, [
+        Trade(prediction_id=key, user_id=alice, direction='BUY',
+              contract='CONTRACT_ONE', quantity=10.00)
+        for key in (first_key, second_key)])
+    overall = standing_key(alice).get()
+    self.assertAlmostEqual(alice.get().balance, overall.cash)
+    self.assertAlmostEqual(20 * first_key.get().GetPriceByPredictionId(),
+                           overall.holdings)
+    self.assertAlmostEqual(
+        -5.124947951362557, standing_key(alice, 'globex').get().cash)
+
+
+class StatsTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1))
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testCompactsActivityIntoBoard(self):
+    now = datetime.datetime.now()
+    busy_key, quiet_key = [
+        Prediction(contract_one=0.00, contract_two=0.00, liquidity=100,
+                   statement="Test", end_time=now).put()
+        for _ in range(2)]
+    rollups.record_ticks(busy_key, [(now - datetime.timedelta(hours=30), 0.4)])
+    user_keys = [Profile(id=name, user_id=name, balance=100).put()
+                 for name in ('alice', 'bob')]
+    for user_key, quantity in zip(user_keys + user_keys[:1], [10, 5, 2]):
+      CreateTradeAction(busy_key.get(), user_key.get(), Trade(
+          prediction_id=busy_key, user_id=user_key, direction='BUY',
+          contract='CONTRACT_ONE', quantity=float(quantity)))
+    volume = sum(t.cost for t in Trade.query())
+    # An hour on, the trades' hour is folded into the totals.
+    next_hour = stats._hour(now) + 1
+    stats._compact_page([busy_key.get(), quiet_key.get()], next_hour)
+    busy = busy_key.get()
+    self.assertAlmostEqual(volume, busy.volume)
+    self.assertEqual((3, 2), (busy.trade_count, busy.trader_count))
+    self.assertAlmostEqual(volume, busy.volume_24h)
+    self.assertEqual(3, busy.trades_24h)
+    self.assertAlmostEqual(busy.GetPriceByPredictionId() - 0.4,
+                           busy.price_change_24h)
+    self.assertEqual(0, quiet_key.get().trades_24h)
+    predictions, _, _ = get_prediction_page(sort='trending')
+    self.assertEqual([busy_key, quiet_key], [p.key for p in predictions])
+    # A day later the hour leaves the window without being counted twice.
+    dropped = stats._compact_page([busy_key.get()], next_hour + 24)
+    self.assertEqual(len(dropped), ActivityShard.query().count())
+    busy = busy_key.get()
+    self.assertEqual((3, 0), (busy.trade_count, busy.trades_24h))
+
+  def testCompactionSurvivesCollidingMarkets(self):
+    now = datetime.datetime.now()
+    prediction_key = Prediction(
+        contract_one=0.00, contract_two=0.00, liquidity=100,
+        statement="Test", end_time=now).put()
+    stats.record_activity(prediction_key, {stats._hour(now): (5.0, 2, 1)})
+    real = stats.run_in_transaction
+    calls = []
+
+    def collide(callback, failures):
+      calls.append(callback)
+      if len(calls) <= failures:
+        raise datastore_errors.TransactionFailedError()
+      return real(callback)
+
+    # A market that keeps colliding is left, shards and all, for next time.
+    stats.run_in_transaction = lambda callback: collide(callback, 2)
+    try:
+      self.assertEqual(
+          [], stats._compact_page([prediction_key.get()],
+                                  stats._hour(now) + 25))
+      self.assertEqual(0, prediction_key.get().trade_count)
+      # One that only collides as part of the page is compacted on its own.
+      del calls[:]
+      stats.run_in_transaction = lambda callback: collide(callback, 1)
+      dropped = stats._compact_page([prediction_key.get()],
+                                    stats._hour(now) + 25)
+    finally:
+      stats.run_in_transaction = real
+    self.assertEqual(1, len(dropped))
+    self.assertEqual(2, prediction_key.get().trade_count)
+
+
+class RollupsTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1))
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testFoldsTicksIntoBars(self):
+    prediction_key = ndb.Key('Prediction', 1)
+    start = datetime.datetime(2017, 5, 1, 12, 0)
+    minute = datetime.timedelta(minutes=1)
+    rollups.record_ticks(prediction_key, [(start, 0.5), (start + minute, 0.7)])
+    rollups.record_ticks(prediction_key, [(start + 2 * minute, 0.4),
+                                          (start + 6 * minute, 0.6)])
+    begin = (start - datetime.datetime(1970, 1, 1)).total_seconds()
+    bars = rollups.get_bars(prediction_key, '5m', begin, begin + 3600)
+    self.assertEqual(
+        [{'time': begin, 'open': 0.5, 'high': 0.7, 'low': 0.4, 'close': 0.4},
+         {'time': begin + 300, 'open': 0.6, 'high': 0.6, 'low': 0.6,
+          'close': 0.6}], bars)
+    hourly = rollups.get_bars(prediction_key, '1h', begin, begin + 3600)
+    self.assertEqual(
+        [{'time': begin, 'open': 0.5, 'high': 0.7, 'low': 0.4, 'close': 0.6}],
+        hourly)
+    self.assertEqual('5m', rollups.pick_resolution(begin, begin + 3600))
+    self.assertEqual('1d', rollups.pick_resolution(begin, begin + 3e7))
+
+  def testOutOfOrderTicksKeepOpenAndClose(self):
+    prediction_key = ndb.Key('Prediction', 1)
+    start = datetime.datetime(2017, 5, 1, 12, 0)
+    minute = datetime.timedelta(minutes=1)
+    rollups.record_ticks(prediction_key, [(start + 2 * minute, 0.6)])
+    rollups.record_ticks(prediction_key, [(start + minute, 0.4),
+                                          (start + 3 * minute, 0.7)])
+    rollups.record_ticks(prediction_key, [(start, 0.5),
+                                          (start + 2 * minute, 0.6)])
+    begin = (start - datetime.datetime(1970, 1, 1)).total_seconds()
+    self.assertEqual(
+        [{'time': begin, 'open': 0.5, 'high': 0.7, 'low': 0.4, 'close': 0.7}],
+        rollups.get_bars(prediction_key, '5m', begin, begin + 300))
+
+  def testDailyBarsFallBackToHistory(self):
+    prediction_key = ndb.Key('Prediction', 1)
+    history = PriceHistory(key=history_key(
+        prediction_key, datetime.datetime(2017, 4, 1)))
+    for day, value in [(29, 0.4), (30, 0.5)]:
+      history.add(datetime.datetime(2017, 4, day), value)
+    history.put()
+    history = PriceHistory(key=history_key(
+        prediction_key, datetime.datetime(2017, 5, 1)))
+    history.add(datetime.datetime(2017, 5, 1), 0.6)
+    history.put()
+    rollups.record_ticks(prediction_key, [
+        (datetime.datetime(2017, 4, 30, 12), 0.7),
+        (datetime.datetime(2017, 4, 30, 13), 0.8)])
+    begin = to_timestamp(datetime.datetime(2017, 4, 29))
+    day = 24 * 60 * 60
+    self.assertEqual(
+        [{'time': begin, 'open': 0.4, 'high': 0.4, 'low': 0.4, 'close': 0.4},
+         {'time': begin + day, 'open': 0.7, 'high': 0.8, 'low': 0.7,
+          'close': 0.8},
+         {'time': begin + 2 * day, 'open': 0.6, 'high': 0.6, 'low': 0.6,
+          'close': 0.6}],
+        rollups.get_bars(prediction_key, '1d', begin, begin + 3 * day))
+    self.assertEqual(
+        [], rollups.get_bars(prediction_key, '1h', begin, begin + day))
+
+  def testBatchClosesAtLastFill(self):
+    activity.backend = activity.LocalActivityQueue()
+    prediction_key = ndb.Key('Prediction', 1)
+    trades = [Trade(cost=1.00, price_after=price)
+              for price in (0.6, 0.7, 0.4, 0.5)]
+    activity.record(prediction_key, trades)
+    end = to_timestamp(datetime.datetime.now()) + 1
+    bars = rollups.get_bars(prediction_key, '5m', end - 600, end)
+    self.assertEqual(1, len(bars))
+    self.assertEqual((0.6, 0.7, 0.4, 0.5),
+                     (bars[0]['open'], bars[0]['high'], bars[0]['low'],
+                      bars[0]['close']))
+
+  def testTradesAreFoldedIntoBars(self):
+    activity.backend = activity.LocalActivityQueue()
+    prediction_key = Prediction(
+        contract_one=0.00, contract_two=0.00, liquidity=100,
+        statement="Test", end_time=datetime.datetime.now()).put()
+    user_key = Profile(id='alice', user_id='alice', balance=100).put()
+    CreateTradeAction(prediction_key.get(), user_key.get(), Trade(
+        prediction_id=prediction_key, user_id=user_key, direction='BUY',
+        contract='CONTRACT_ONE', quantity=10.00))
+    end = to_timestamp(datetime.datetime.now()) + 1
+    bars = rollups.get_bars(prediction_key, '1h', end - 7200, end)
+    self.assertEqual(1, len(bars))
+    self.assertAlmostEqual(prediction_key.get().GetPriceByPredictionId(),
+                           bars[0]['close'])
+
+
+class SnapshotTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1))
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+    self.page_size = price.PAGE_SIZE
+    price.PAGE_SIZE = 2
+
+  def tearDown(self):
+    price.PAGE_SIZE = self.page_size
+    self.testbed.deactivate()
+
+  def testResumesWithoutDuplicates(self):
+    for i in range(3):
+      Prediction(contract_one=float(i), statement='Test %d' % i,
+                 end_time=datetime.datetime.now()).put()
+    Prediction(statement='Resolved', outcome='CONTRACT_ONE', resolved=True,
+               end_time=datetime.datetime.now()).put()
+    # A deadline in the past writes one page and stops.
+    run = price.price(deadline=0)
+    self.assertFalse(run.done)
+    self.assertEqual(2, PriceHistory.query().count())
+    run = price.price()
+    self.assertTrue(run.done)
+    self.assertEqual(3, run.written)
+    price.price()
+    histories = PriceHistory.query().fetch()
+    self.assertEqual(3, len(histories))
+    for history in histories:
+      self.assertEqual(1, len(history.points()))
+
+  def testTradesBetweenPagesSkipNothing(self):
+    keys = [Prediction(contract_one=float(i), statement='Test %d' % i,
+                       end_time=datetime.datetime.now()).put()
+            for i in range(3)]
+    run = price.price(deadline=0, day='2017-05-01')
+    self.assertFalse(run.done)
+    # Trades reorder the markets by price, and the run crosses midnight.
+    for i, key in enumerate(keys):
+      prediction = key.get()
+      prediction.contract_one = 10.0 - i
+      prediction.put()
+    run = price.price(day='2017-05-01')
+    self.assertTrue(run.done)
+    self.assertEqual('2017-05-01', run.key.id())
+    self.assertEqual(3, run.written)
+    histories = PriceHistory.query().fetch()
+    self.assertEqual(3, len(histories))
+    for history in histories:
+      self.assertEqual(1, len(history.points()))
+
+
+class MigrateTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testMovesEmbeddedLedger(self):
+    prediction_key = Prediction(
+        statement='Test', end_time=datetime.datetime.now()).put()
+    user_key = Profile(
+        balance=100,
+        user_ledger=[
+            LedgerRecords(
+                prediction_id=prediction_key.urlsafe(),
+                contract_one=10.00,
+                contract_two=0.00)
+        ]).put()
+    self.assertEqual((1, None), migrate())
+    self.assertEqual([], user_key.get().user_ledger)
+    self.assertEqual(
+        10.00, ledger_key(user_key, prediction_key).get().contract_one)
+    # Running again is a no-op.
+    self.assertEqual((0, None), migrate())
+
+  def testBackfillsPriceHistory(self):
+    prediction_key = Prediction(
+        statement='Test', end_time=datetime.datetime.now()).put()
+    for day, value in [(3, 0.4), (1, 0.5), (2, 0.6)]:
+      Price(prediction_id=prediction_key,
+            date=datetime.datetime(2017, 5, day), value=value).put()
+    self.assertEqual((3, None), backfill_prices())
+    self.assertEqual((3, None), backfill_prices())
+    history = history_key(
+        prediction_key, datetime.datetime(2017, 5, 1)).get()
+    self.assertEqual([(datetime.datetime(2017, 5, 1), 0.5),
+                      (datetime.datetime(2017, 5, 2), 0.6),
+                      (datetime.datetime(2017, 5, 3), 0.4)], history.points())
+
+
+class LoadTestTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1))
+    self.testbed.init_memcache_stub()
+    self.testbed.init_taskqueue_stub()
+    self.testbed.init_user_stub()
+    ndb.get_context().clear_cache()
+    self.load = loadtest.LoadTest(seed=1)
+
+  def tearDown(self):
+    activity.backend = activity.LocalActivityQueue()
+    self.testbed.deactivate()
+
+  def testDrivesEveryKindOfRequest(self):
+    self.load.seed(markets=2, users=2)
+    samples = self.load.run(50)
+    self.assertEqual(set(loadtest.DEFAULT_MIX), set(samples))
+    self.assertEqual(50, sum(len(s) for s in samples.values()))
+    for ms, rpcs, ok in samples['market']:
+      self.assertTrue(ok)
+      self.assertGreater(rpcs, 0)
+
+  def testReportsQueuedBackgroundWork(self):
+    self.load.seed(markets=2, users=2)
+    samples = self.load.run(20, {'trade': 1})
+    background = self.load.background()
+    self.assertEqual(0, background['sequencer tickets'])
+    # Trades queue their activity rather than folding it in the request.
+    self.assertGreater(background['activity folds'], 0)
+    self.assertEqual(0, ActivityShard.query().count())
+    out = StringIO.StringIO()
+    loadtest.report(samples, 1.0, background, out=out)
+    self.assertIn('not run or timed', out.getvalue())
+    self.assertIn('sequencer tickets: 0', out.getvalue())
+
+  def testPercentile(self):
+    values = range(1, 101)
+    self.assertEqual(50, loadtest.percentile(values, 50))
+    self.assertEqual(99, loadtest.percentile(values, 99))
+    self.assertEqual(0.0, loadtest.percentile([], 50))
+
 
 # [START main]
 if __name__ == '__main__':
   unittest.main()
 # [END main]
+
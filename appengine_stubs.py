@@ -0,0 +1,2024 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Google, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""App Engine stubs: in-memory stand-ins for the App Engine APIs the app uses.
+
+For running the app on a plain Python 2.7 install, with no SDK, as
+loadtest.py does. install() registers the stand-ins under the SDK's module
+names (google.appengine.ext.ndb, google.appengine.api.users and so on, and
+webapp2 if it is not installed), so it must be called before the app is
+imported. A testbed stand-in lets app_test.py run against them too
+(runner.py --stubs), which checks they behave like the SDK.
+
+The datastore keeps serialized entities in a dict and is strongly consistent.
+Transactions run one at a time under a lock, see only what was committed
+before they began, and enforce the entity group limits. Each datastore,
+memcache or task queue operation is one RPC and runs the API proxy hooks
+instrument.py installs. ndb's auto-batching and memcache caching are not
+modelled, so RPC counts are the stand-in's rather than production's, and
+queries do not check for the composite indexes in index.yaml.
+"""
+
+import base64
+import calendar
+import collections
+import contextlib
+import cPickle as pickle
+import datetime
+import functools
+import json
+import operator
+import os
+import sys
+import threading
+import time
+import types
+import urllib
+
+# Most entity groups a cross-group transaction may touch.
+MAX_ENTITY_GROUPS = 25
+# Allocated ids are the sequence numbers with this many bits reversed.
+SCATTERED_ID_BITS = 52
+
+
+# datastore_errors
+
+
+class Error(Exception):
+  """Base class for datastore errors."""
+
+
+class BadValueError(Error):
+  """A property value or key is not valid."""
+
+
+class BadArgumentError(Error):
+  """An argument is not valid."""
+
+
+class BadRequestError(Error):
+  """The datastore cannot carry out the request."""
+
+
+class BadFilterError(Error):
+  """A query filter is not valid."""
+
+
+class BadQueryError(Error):
+  """A query is not valid."""
+
+
+class TransactionFailedError(Error):
+  """A transaction could not be committed."""
+
+
+class Rollback(Error):
+  """Raised in a transaction to roll it back quietly."""
+
+
+class KindError(BadValueError):
+  """No model class is defined for a kind."""
+
+
+class ComputedPropertyError(Error):
+  """A ComputedProperty was assigned to."""
+
+
+class UnprojectedPropertyError(Error):
+  """A property left out of a projection was read."""
+
+
+# apiproxy_stub_map
+
+
+class _Hooks(object):
+  """An ordered list of hooks, as kept by the SDK's API proxy."""
+
+  def __init__(self):
+    self._hooks = collections.OrderedDict()
+
+  def Append(self, key, function, service=None):
+    if key in self._hooks:
+      return False
+    self._hooks[key] = (function, service)
+    return True
+
+  def Call(self, service, call, request, response):
+    for function, only in self._hooks.values():
+      if only is None or only == service:
+        function(service, call, request, response)
+
+
+class _APIProxy(object):
+
+  def __init__(self):
+    self._pre_call_hooks = _Hooks()
+    self._post_call_hooks = _Hooks()
+
+  def GetPreCallHooks(self):
+    return self._pre_call_hooks
+
+  def GetPostCallHooks(self):
+    return self._post_call_hooks
+
+
+apiproxy = _APIProxy()
+
+
+class _Request(object):
+  """Stands in for an RPC's request protocol buffer."""
+
+  def __init__(self, keys=()):
+    self._keys = [_KeyPb(key) for key in keys]
+
+  def key_list(self):
+    return self._keys
+
+
+class _KeyPb(object):
+
+  def __init__(self, key):
+    self._key = key
+
+  def Encode(self):
+    return self._key.urlsafe()
+
+  def path(self):
+    return self
+
+  def element_list(self):
+    return [_ElementPb(kind, id) for kind, id in self._key.pairs()]
+
+
+class _ElementPb(object):
+
+  def __init__(self, kind, id):
+    self._kind = kind
+    self._id = id
+
+  def type(self):
+    return self._kind
+
+  def has_name(self):
+    return isinstance(self._id, basestring)
+
+  def name(self):
+    return self._id
+
+  def id(self):
+    return self._id
+
+
+@contextlib.contextmanager
+def _rpc(service, call, request=None):
+  """Runs the block as one RPC, between the API proxy's hooks."""
+  request = request or _Request()
+  apiproxy.GetPreCallHooks().Call(service, call, request, None)
+  try:
+    yield
+  finally:
+    apiproxy.GetPostCallHooks().Call(service, call, request, None)
+
+
+# ndb: keys
+
+
+def _kind_name(kind):
+  if isinstance(kind, type) and issubclass(kind, Model):
+    return kind._get_kind()
+  if not isinstance(kind, basestring):
+    raise TypeError('Key kind must be a string or Model class; received %r' %
+                    (kind,))
+  return kind
+
+
+class Key(object):
+  """An immutable datastore key: a path of (kind, id) pairs.
+
+  Takes a flat list of kinds and ids, optionally a parent, or urlsafe. An id
+  of None as the last pair makes an incomplete key.
+  """
+
+  def __init__(self, *args, **kwds):
+    urlsafe = kwds.pop('urlsafe', None)
+    parent = kwds.pop('parent', None)
+    pairs = kwds.pop('pairs', None)
+    flat = kwds.pop('flat', None)
+    if kwds:
+      raise TypeError('Unexpected Key arguments: %s' % ', '.join(kwds))
+    if urlsafe is not None:
+      if args or parent or pairs or flat:
+        raise TypeError('urlsafe cannot be combined with other arguments')
+      pairs = _decode_key(urlsafe)
+    elif pairs is None:
+      flat = list(args or flat or ())
+      if len(flat) % 2:
+        raise TypeError('Key() must have an even number of positional '
+                        'arguments.')
+      pairs = zip(flat[::2], flat[1::2])
+    pairs = [(_kind_name(kind), id) for kind, id in pairs]
+    if parent is not None:
+      if parent.id() is None:
+        raise BadArgumentError('Expected a complete parent key; received %r' %
+                               (parent,))
+      pairs = list(parent.pairs()) + pairs
+    if not pairs:
+      raise TypeError('Key() must have at least one pair')
+    for i, (_, id) in enumerate(pairs):
+      if id is None and i == len(pairs) - 1:
+        continue
+      if isinstance(id, bool) or not (
+          isinstance(id, (int, long)) and id > 0 or
+          isinstance(id, basestring) and id):
+        raise BadArgumentError('Key id must be a positive integer or a '
+                               'non-empty string; received %r' % (id,))
+    self._pairs = tuple(pairs)
+
+  def pairs(self):
+    return self._pairs
+
+  def flat(self):
+    return tuple(part for pair in self._pairs for part in pair)
+
+  def kind(self):
+    return self._pairs[-1][0]
+
+  def id(self):
+    return self._pairs[-1][1]
+
+  def string_id(self):
+    id = self.id()
+    return id if isinstance(id, basestring) else None
+
+  def integer_id(self):
+    id = self.id()
+    return id if isinstance(id, (int, long)) else None
+
+  def parent(self):
+    if len(self._pairs) == 1:
+      return None
+    return Key(pairs=self._pairs[:-1])
+
+  def root(self):
+    return Key(pairs=self._pairs[:1])
+
+  def urlsafe(self):
+    return base64.urlsafe_b64encode(json.dumps(self._pairs)).rstrip('=')
+
+  def get(self, **options):
+    return _get([self])[0]
+
+  def get_async(self, **options):
+    return _future(lambda: _get([self])[0])
+
+  def delete(self, **options):
+    _delete([self])
+
+  def delete_async(self, **options):
+    return _future(lambda: _delete([self]))
+
+  def _order(self):
+    return tuple((kind, (0, id) if isinstance(id, (int, long)) else (1, id))
+                 for kind, id in self._pairs)
+
+  def __eq__(self, other):
+    if not isinstance(other, Key):
+      return NotImplemented
+    return self._pairs == other._pairs
+
+  def __ne__(self, other):
+    if not isinstance(other, Key):
+      return NotImplemented
+    return self._pairs != other._pairs
+
+  def __lt__(self, other):
+    return self._order() < other._order()
+
+  def __le__(self, other):
+    return self._order() <= other._order()
+
+  def __gt__(self, other):
+    return self._order() > other._order()
+
+  def __ge__(self, other):
+    return self._order() >= other._order()
+
+  def __hash__(self):
+    return hash(self._pairs)
+
+  def __repr__(self):
+    return 'Key(%s)' % ', '.join(repr(part) for part in self.flat())
+
+
+def _decode_key(urlsafe):
+  try:
+    urlsafe = str(urlsafe)
+    pairs = json.loads(base64.urlsafe_b64decode(
+        urlsafe + '=' * (-len(urlsafe) % 4)))
+    return [(str(kind), id) for kind, id in pairs]
+  except Exception:
+    raise BadValueError('Invalid urlsafe key %r' % (urlsafe,))
+
+
+# ndb: futures and tasklets
+
+
+class Future(object):
+  """The outcome of an operation; the stand-ins complete every one at once."""
+
+  def __init__(self, result=None):
+    self._result = result
+    self._exc_info = None
+
+  def set_result(self, result):
+    self._result = result
+
+  def set_exception(self, exception, tb=None):
+    self._exc_info = (type(exception), exception, tb)
+
+  def done(self):
+    return True
+
+  def wait(self):
+    pass
+
+  def get_exception(self):
+    return self._exc_info[1] if self._exc_info else None
+
+  def check_success(self):
+    self.get_result()
+
+  def get_result(self):
+    if self._exc_info:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+
+def _future(function):
+  """Returns a Future holding function's result or exception."""
+  future = Future()
+  try:
+    future.set_result(function())
+  except Exception as e:
+    future.set_exception(e, sys.exc_info()[2])
+  return future
+
+
+class Return(StopIteration):
+  """Raised by a tasklet to return a value."""
+
+
+def _resolve(yielded):
+  if isinstance(yielded, Future):
+    return yielded.get_result()
+  if isinstance(yielded, (list, tuple)):
+    return [_resolve(y) for y in yielded]
+  raise BadArgumentError('A tasklet yielded %r, not a Future' % (yielded,))
+
+
+def _drive(generator):
+  """Runs a tasklet's generator to the end; returns what it returned."""
+  value, exc_info = None, None
+  while True:
+    try:
+      if exc_info:
+        yielded = generator.throw(*exc_info)
+      else:
+        yielded = generator.send(value)
+    except StopIteration as e:
+      return e.args[0] if e.args else None
+    value, exc_info = None, None
+    try:
+      value = _resolve(yielded)
+    except Exception:
+      exc_info = sys.exc_info()
+
+
+def tasklet(func):
+  """Decorates a generator yielding Futures into a function returning one."""
+
+  @functools.wraps(func)
+  def run(*args, **kwds):
+    def call():
+      try:
+        result = func(*args, **kwds)
+      except Return as e:
+        return e.args[0] if e.args else None
+      if isinstance(result, types.GeneratorType):
+        return _drive(result)
+      return result
+    return _future(call)
+
+  return run
+
+
+# ndb: contexts and transactions
+
+
+class TransactionOptions(object):
+  """Propagation options of transaction and transactional."""
+  NESTED = 1
+  MANDATORY = 2
+  ALLOWED = 3
+  INDEPENDENT = 4
+
+
+class Context(object):
+  """Per-thread state: the in-context entity cache and any transaction."""
+
+  def __init__(self, transaction=None):
+    self._cache = {}
+    self.transaction = transaction
+
+  def clear_cache(self):
+    self._cache.clear()
+
+  def in_transaction(self):
+    return self.transaction is not None
+
+
+class _Transaction(object):
+  """The writes and entity groups of a transaction in progress."""
+
+  def __init__(self, xg):
+    self.xg = xg
+    self.groups = set()
+    self.writes = collections.OrderedDict()
+
+  def touch(self, keys):
+    self.groups.update(key.root() for key in keys)
+    if not self.xg and len(self.groups) > 1:
+      raise BadRequestError('cross-group transactions need to be explicitly '
+                            'specified (xg=True)')
+    if len(self.groups) > MAX_ENTITY_GROUPS:
+      raise BadRequestError('operating on too many entity groups in a single '
+                            'transaction.')
+
+
+_state = threading.local()
+
+
+def _contexts():
+  if not hasattr(_state, 'contexts'):
+    _state.contexts = [Context()]
+  return _state.contexts
+
+
+def get_context():
+  return _contexts()[-1]
+
+
+def in_transaction():
+  return get_context().in_transaction()
+
+
+def transaction(callback, retries=3, xg=False, propagation=None, **options):
+  """Runs callback in a transaction and returns its result.
+
+  Transactions hold the datastore lock throughout, so they never collide and
+  retries is unused.
+  """
+  if in_transaction():
+    if propagation in (TransactionOptions.ALLOWED,
+                       TransactionOptions.MANDATORY):
+      return callback()
+    if propagation != TransactionOptions.INDEPENDENT:
+      raise BadRequestError('Nested transactions are not supported.')
+  elif propagation == TransactionOptions.MANDATORY:
+    raise BadRequestError('Requires an existing transaction.')
+  with _datastore.lock:
+    with _rpc('datastore_v3', 'BeginTransaction'):
+      context = Context(_Transaction(xg))
+    _contexts().append(context)
+    try:
+      result = callback()
+    except:
+      exc_info = sys.exc_info()
+      _contexts().pop()
+      with _rpc('datastore_v3', 'Rollback'):
+        pass
+      if issubclass(exc_info[0], Rollback):
+        return None
+      raise exc_info[0], exc_info[1], exc_info[2]
+    _contexts().pop()
+    with _rpc('datastore_v3', 'Commit'):
+      for key, stored in context.transaction.writes.items():
+        _datastore.write(key, stored)
+    get_context()._cache.update(context._cache)
+    return result
+
+
+def transactional(func=None, **options):
+  """Decorates a function to run in a transaction, joining any already open."""
+  if func is None:
+    return lambda func: transactional(func, **options)
+  options.setdefault('propagation', TransactionOptions.ALLOWED)
+
+  @functools.wraps(func)
+  def run(*args, **kwds):
+    return transaction(lambda: func(*args, **kwds), **options)
+
+  return run
+
+
+# ndb: storage
+
+
+_Stored = collections.namedtuple('_Stored', ['values', 'indexed'])
+
+
+class _Datastore(object):
+  """The committed entities, by kind and key."""
+
+  def __init__(self):
+    self.lock = threading.RLock()
+    self.clear()
+
+  def clear(self):
+    with self.lock:
+      self.kinds = collections.defaultdict(dict)
+      self.last_id = 0
+
+  def read(self, key):
+    return self.kinds[key.kind()].get(key)
+
+  def write(self, key, stored):
+    if stored is None:
+      self.kinds[key.kind()].pop(key, None)
+    else:
+      self.kinds[key.kind()][key] = stored
+
+  def allocate_id(self):
+    """Returns a new id, scattered over the id space as the datastore's are.
+
+    Small ids such as 1 are never allocated, so they can stand for missing
+    entities.
+    """
+    with self.lock:
+      self.last_id += 1
+      return int(format(self.last_id, '0%db' % SCATTERED_ID_BITS)[::-1], 2)
+
+
+_datastore = _Datastore()
+
+
+def _check_complete(keys):
+  for key in keys:
+    if not isinstance(key, Key):
+      raise BadArgumentError('Expected a Key; received %r' % (key,))
+    if key.id() is None:
+      raise BadRequestError('Incomplete key %r' % (key,))
+
+
+def _get(keys):
+  context = get_context()
+  _check_complete(keys)
+  missing = [key for key in collections.OrderedDict.fromkeys(keys)
+             if key not in context._cache]
+  if missing:
+    if context.transaction:
+      context.transaction.touch(missing)
+    with _rpc('datastore_v3', 'Get', _Request(missing)):
+      with _datastore.lock:
+        for key in missing:
+          stored = _datastore.read(key)
+          context._cache[key] = stored and Model._lookup_model(
+              key.kind())._from_stored(key, stored.values)
+  return [context._cache[key] for key in keys]
+
+
+def _put(entities):
+  context = get_context()
+  for entity in entities:
+    if entity._projection:
+      raise BadRequestError('Cannot put a projected entity')
+    entity._prepare_for_put()
+    entity._pre_put_hook()
+  for entity in entities:
+    if entity._key is None:
+      entity._key = Key(entity._get_kind(), _datastore.allocate_id())
+    elif entity._key.id() is None:
+      entity._key = Key(pairs=entity._key.pairs()[:-1] + (
+          (entity._key.kind(), _datastore.allocate_id()),))
+  keys = [entity._key for entity in entities]
+  if not keys:
+    return keys
+  if context.transaction:
+    context.transaction.touch(keys)
+  with _rpc('datastore_v3', 'Put'):
+    with _datastore.lock:
+      for entity in entities:
+        stored = entity._to_stored()
+        if context.transaction:
+          context.transaction.writes[entity._key] = stored
+        else:
+          _datastore.write(entity._key, stored)
+        context._cache[entity._key] = entity
+  for entity in entities:
+    entity._post_put_hook(Future(entity._key))
+  return keys
+
+
+def _delete(keys):
+  context = get_context()
+  _check_complete(keys)
+  if not keys:
+    return
+  models = [_kind_map.get(key.kind()) for key in keys]
+  for model, key in zip(models, keys):
+    if model is not None:
+      model._pre_delete_hook(key)
+  if context.transaction:
+    context.transaction.touch(keys)
+  with _rpc('datastore_v3', 'Delete', _Request(keys)):
+    with _datastore.lock:
+      for key in keys:
+        if context.transaction:
+          context.transaction.writes[key] = None
+        else:
+          _datastore.write(key, None)
+        context._cache[key] = None
+  for model, key in zip(models, keys):
+    if model is not None:
+      model._post_delete_hook(key, Future())
+
+
+def get_multi(keys, **options):
+  return _get(keys)
+
+
+def get_multi_async(keys, **options):
+  try:
+    return [Future(entity) for entity in _get(keys)]
+  except Exception as e:
+    futures = [Future() for _ in keys]
+    for future in futures:
+      future.set_exception(e, sys.exc_info()[2])
+    return futures
+
+
+def put_multi(entities, **options):
+  return _put(entities)
+
+
+def put_multi_async(entities, **options):
+  return [Future(key) for key in _put(entities)]
+
+
+def delete_multi(keys, **options):
+  _delete(keys)
+  return [None] * len(keys)
+
+
+def delete_multi_async(keys, **options):
+  _delete(keys)
+  return [Future() for _ in keys]
+
+
+# ndb: properties
+
+
+class Property(object):
+  """A typed attribute of a Model that is stored with its entities."""
+
+  _default_indexed = True
+
+  def __init__(self, name=None, indexed=None, repeated=False, required=False,
+               default=None, choices=None, validator=None, verbose_name=None):
+    self._name = name
+    self._code_name = name
+    self._indexed = self._default_indexed if indexed is None else indexed
+    self._repeated = repeated
+    self._required = required
+    self._default = default
+    self._choices = choices and frozenset(choices)
+    self._validator = validator
+
+  def _fix_up(self, cls, code_name):
+    self._code_name = code_name
+    if self._name is None:
+      self._name = code_name
+
+  def __get__(self, entity, unused_cls=None):
+    if entity is None:
+      return self
+    return self._get_value(entity)
+
+  def _get_value(self, entity):
+    if entity._projection and self._name not in entity._projection:
+      raise UnprojectedPropertyError(
+          'Property %s is not in the projection' % self._name)
+    if self._name in entity._values:
+      return entity._values[self._name]
+    if self._repeated:
+      return entity._values.setdefault(self._name, [])
+    return self._default
+
+  def __set__(self, entity, value):
+    if self._repeated:
+      if not isinstance(value, (list, tuple)):
+        raise BadValueError('Expected list or tuple, got %r' % (value,))
+      value = [self._do_validate(v) for v in value]
+    elif value is not None:
+      value = self._do_validate(value)
+    entity._values[self._name] = value
+
+  def __delete__(self, entity):
+    entity._values.pop(self._name, None)
+
+  def _do_validate(self, value):
+    value = self._validate(value)
+    if self._choices is not None and value not in self._choices:
+      raise BadValueError('Value %r for property %s is not an allowed choice' %
+                          (value, self._name))
+    if self._validator is not None:
+      value = self._validator(self, value)
+    return value
+
+  def _validate(self, value):
+    return value
+
+  def _prepare_for_put(self, entity):
+    pass
+
+  def _is_initialized(self, entity):
+    value = self._get_value(entity)
+    return not self._required or (value is not None and value != [])
+
+  def _to_storable(self, entity):
+    value = self._get_value(entity)
+    return list(value) if self._repeated else value
+
+  def _from_storable(self, value):
+    return list(value) if self._repeated else value
+
+  def _comparison(self, op, value):
+    if not self._indexed:
+      raise BadFilterError('Cannot query for unindexed property %s' %
+                           self._name)
+    if value is not None:
+      value = self._do_validate(value)
+    return FilterNode(self._name, op, value)
+
+  def __eq__(self, value):
+    return self._comparison('=', value)
+
+  def __ne__(self, value):
+    return self._comparison('!=', value)
+
+  def __lt__(self, value):
+    return self._comparison('<', value)
+
+  def __le__(self, value):
+    return self._comparison('<=', value)
+
+  def __gt__(self, value):
+    return self._comparison('>', value)
+
+  def __ge__(self, value):
+    return self._comparison('>=', value)
+
+  __hash__ = object.__hash__
+
+  def __neg__(self):
+    return PropertyOrder(self._name, True)
+
+  def __pos__(self):
+    return PropertyOrder(self._name, False)
+
+
+class ModelKey(Property):
+  """The key of a Model, which queries can filter and order on."""
+
+  def __init__(self):
+    super(ModelKey, self).__init__(name='__key__')
+
+  def _fix_up(self, cls, code_name):
+    pass
+
+  def _get_value(self, entity):
+    return entity._key
+
+  def __set__(self, entity, value):
+    if value is not None:
+      self._validate(value)
+      if value.kind() != entity._get_kind():
+        raise KindError('Expected Key kind to be %s; received %s' %
+                        (entity._get_kind(), value.kind()))
+    entity._key = value
+
+  def _validate(self, value):
+    if not isinstance(value, Key):
+      raise BadValueError('Expected Key, got %r' % (value,))
+    return value
+
+
+class BooleanProperty(Property):
+
+  def _validate(self, value):
+    if not isinstance(value, bool):
+      raise BadValueError('Expected bool, got %r' % (value,))
+    return value
+
+
+class IntegerProperty(Property):
+
+  def _validate(self, value):
+    if not isinstance(value, (int, long)):
+      raise BadValueError('Expected integer, got %r' % (value,))
+    return int(value)
+
+
+class FloatProperty(Property):
+
+  def _validate(self, value):
+    if not isinstance(value, (int, long, float)):
+      raise BadValueError('Expected float, got %r' % (value,))
+    return float(value)
+
+
+class StringProperty(Property):
+
+  def _validate(self, value):
+    if not isinstance(value, basestring):
+      raise BadValueError('Expected string, got %r' % (value,))
+    return value
+
+
+class TextProperty(StringProperty):
+  _default_indexed = False
+
+
+class BlobProperty(Property):
+  _default_indexed = False
+
+  def _validate(self, value):
+    if not isinstance(value, str):
+      raise BadValueError('Expected str, got %r' % (value,))
+    return value
+
+
+class DateTimeProperty(Property):
+  """A naive datetime; auto_now and auto_now_add set it to utcnow on put."""
+
+  def __init__(self, name=None, auto_now=False, auto_now_add=False, **kwds):
+    super(DateTimeProperty, self).__init__(name=name, **kwds)
+    self._auto_now = auto_now
+    self._auto_now_add = auto_now_add
+
+  def _validate(self, value):
+    if not isinstance(value, datetime.datetime):
+      raise BadValueError('Expected datetime, got %r' % (value,))
+    if value.tzinfo is not None:
+      raise BadValueError('DatetimeProperty %s can only support naive '
+                          'datetimes' % self._name)
+    return value
+
+  def _prepare_for_put(self, entity):
+    if self._auto_now or (self._auto_now_add and
+                          self._get_value(entity) is None):
+      self.__set__(entity, datetime.datetime.utcnow())
+
+
+class KeyProperty(Property):
+
+  def __init__(self, name=None, kind=None, **kwds):
+    super(KeyProperty, self).__init__(name=name, **kwds)
+    self._kind = kind and _kind_name(kind)
+
+  def _validate(self, value):
+    if not isinstance(value, Key):
+      raise BadValueError('Expected Key, got %r' % (value,))
+    if self._kind is not None and value.kind() != self._kind:
+      raise BadValueError('Expected Key with kind=%r, got %r' %
+                          (self._kind, value))
+    return value
+
+
+class StructuredProperty(Property):
+  """Entities of another Model stored inside this one; not queryable."""
+
+  def __init__(self, modelclass, name=None, **kwds):
+    super(StructuredProperty, self).__init__(name=name, **kwds)
+    self._modelclass = modelclass
+
+  def _validate(self, value):
+    if not isinstance(value, self._modelclass):
+      raise BadValueError('Expected %s instance, got %r' %
+                          (self._modelclass.__name__, value))
+    return value
+
+  def _to_storable(self, entity):
+    value = self._get_value(entity)
+    if self._repeated:
+      return [v._to_stored().values for v in value]
+    return value and value._to_stored().values
+
+  def _from_storable(self, value):
+    if self._repeated:
+      return [self._modelclass._from_stored(None, v) for v in value]
+    return value and self._modelclass._from_stored(None, value)
+
+  def _comparison(self, op, value):
+    raise BadFilterError('Cannot query on StructuredProperty %s' % self._name)
+
+
+class ComputedProperty(Property):
+  """A read-only property whose value is func(entity), stored on put."""
+
+  def __init__(self, func, name=None, indexed=None, repeated=False):
+    super(ComputedProperty, self).__init__(name=name, indexed=indexed,
+                                           repeated=repeated)
+    self._func = func
+
+  def _get_value(self, entity):
+    if entity._projection:
+      return super(ComputedProperty, self)._get_value(entity)
+    return self._func(entity)
+
+  def __set__(self, entity, value):
+    raise ComputedPropertyError('Cannot assign to a ComputedProperty')
+
+  def __delete__(self, entity):
+    raise ComputedPropertyError('Cannot delete a ComputedProperty')
+
+
+# ndb: models
+
+
+_kind_map = {}
+
+
+class MetaModel(type):
+  """Names a Model's properties and registers its kind."""
+
+  def __init__(cls, name, bases, classdict):
+    super(MetaModel, cls).__init__(name, bases, classdict)
+    cls._properties = {}
+    for base in reversed(cls.__mro__):
+      for code_name, attr in vars(base).items():
+        if isinstance(attr, Property) and not isinstance(attr, ModelKey):
+          attr._fix_up(cls, code_name)
+          cls._properties[attr._name] = attr
+    _kind_map[cls._get_kind()] = cls
+
+
+class Model(object):
+  """A datastore entity with typed properties."""
+
+  __metaclass__ = MetaModel
+
+  key = ModelKey()
+
+  def __init__(self, key=None, id=None, parent=None, **kwds):
+    self._values = {}
+    self._projection = ()
+    self._key = None
+    if key is not None:
+      if id is not None or parent is not None:
+        raise BadArgumentError('Model constructor given key= does not accept '
+                               'id= or parent=.')
+      self.key = key
+    elif id is not None or parent is not None:
+      self._key = Key(self._get_kind(), id, parent=parent)
+    self.populate(**kwds)
+
+  @classmethod
+  def _get_kind(cls):
+    return cls.__name__
+
+  @classmethod
+  def _lookup_model(cls, kind):
+    model = _kind_map.get(kind)
+    if model is None:
+      raise KindError('No model class found for kind %r. Did you forget to '
+                      'import it?' % kind)
+    return model
+
+  def populate(self, **kwds):
+    cls = type(self)
+    for name, value in kwds.items():
+      if not isinstance(getattr(cls, name, None), Property):
+        raise TypeError('Cannot set non-property %s' % name)
+      setattr(self, name, value)
+
+  def has_complete_key(self):
+    return self._key is not None and self._key.id() is not None
+
+  def _prepare_for_put(self):
+    for prop in self._properties.values():
+      prop._prepare_for_put(self)
+      if not prop._is_initialized(self):
+        raise BadValueError('Entity has uninitialized properties: %s' %
+                            prop._name)
+
+  def _to_stored(self):
+    values = {}
+    indexed = {'__key__': self._key}
+    for name, prop in self._properties.items():
+      values[name] = prop._to_storable(self)
+      if prop._indexed and not isinstance(prop, StructuredProperty):
+        indexed[name] = values[name]
+    return _Stored(values, indexed)
+
+  @classmethod
+  def _from_stored(cls, key, values, projection=()):
+    entity = cls()
+    entity._key = key
+    for name, value in values.items():
+      prop = cls._properties.get(name)
+      if prop is None or (isinstance(prop, ComputedProperty) and
+                          not projection):
+        continue
+      entity._values[name] = prop._from_storable(value)
+    entity._projection = tuple(projection)
+    return entity
+
+  def put(self, **options):
+    return _put([self])[0]
+
+  def put_async(self, **options):
+    return _future(lambda: _put([self])[0])
+
+  @classmethod
+  def query(cls, *filters, **kwds):
+    return Query(kind=cls._get_kind(), **kwds).filter(*filters)
+
+  @classmethod
+  def get_by_id(cls, id, parent=None, **options):
+    return Key(cls, id, parent=parent).get()
+
+  @classmethod
+  def get_or_insert(cls, name, parent=None, **kwds):
+    """Gets the entity with id name, creating it from kwds if it is missing."""
+    key = Key(cls, name, parent=parent)
+
+    def txn():
+      entity = key.get()
+      if entity is None:
+        entity = cls(key=key, **kwds)
+        entity.put()
+      return entity
+
+    return transaction(txn, propagation=TransactionOptions.ALLOWED)
+
+  def to_dict(self, include=None, exclude=None):
+    return dict((prop._code_name, getattr(self, prop._code_name))
+                for prop in self._properties.values()
+                if (include is None or prop._code_name in include) and
+                (exclude is None or prop._code_name not in exclude))
+
+  def _pre_put_hook(self):
+    pass
+
+  def _post_put_hook(self, future):
+    pass
+
+  @classmethod
+  def _pre_delete_hook(cls, key):
+    pass
+
+  @classmethod
+  def _post_delete_hook(cls, key, future):
+    pass
+
+  def __eq__(self, other):
+    if type(other) is not type(self):
+      return NotImplemented
+    return (self._key == other._key and
+            self._to_stored().values == other._to_stored().values)
+
+  def __ne__(self, other):
+    equal = self.__eq__(other)
+    return equal if equal is NotImplemented else not equal
+
+  def __hash__(self):
+    raise TypeError('Model is not immutable')
+
+  def __repr__(self):
+    args = ['%s=%r' % (name, self._values[name])
+            for name in sorted(self._values)]
+    if self._key is not None:
+      args.insert(0, 'key=%r' % (self._key,))
+    return '%s(%s)' % (type(self).__name__, ', '.join(args))
+
+
+# ndb: queries
+
+
+def _microseconds(when):
+  return calendar.timegm(when.timetuple()) * 1000000 + when.microsecond
+
+
+def _order_value(value):
+  """Maps a value to one that sorts as the datastore orders values."""
+  if value is None:
+    return (0,)
+  if isinstance(value, bool):
+    return (2, value)
+  if isinstance(value, (int, long)):
+    return (1, value)
+  if isinstance(value, datetime.datetime):
+    return (1, _microseconds(value))
+  if isinstance(value, str):
+    return (4, value.decode('utf-8', 'replace'))
+  if isinstance(value, unicode):
+    return (4, value)
+  if isinstance(value, float):
+    return (5, value)
+  if isinstance(value, Key):
+    return (9, value._order())
+  raise BadValueError('Cannot index %r' % (value,))
+
+
+_OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+class FilterNode(object):
+  """A comparison of one property with a value."""
+
+  def __init__(self, name, op, value):
+    self._name = name
+    self._op = op
+    self._value = _order_value(value)
+
+  def _inequalities(self):
+    return set() if self._op == '=' else set([self._name])
+
+  def _matches(self, indexed):
+    if self._name not in indexed:
+      return False
+    values = indexed[self._name]
+    if not isinstance(values, list):
+      values = [values]
+    compare = _OPERATORS[self._op]
+    return any(compare(_order_value(v), self._value) for v in values)
+
+
+class ConjunctionNode(object):
+
+  def __init__(self, nodes):
+    self._nodes = nodes
+
+  def _inequalities(self):
+    return set().union(*[node._inequalities() for node in self._nodes])
+
+  def _matches(self, indexed):
+    return all(node._matches(indexed) for node in self._nodes)
+
+
+class DisjunctionNode(ConjunctionNode):
+
+  def _matches(self, indexed):
+    return any(node._matches(indexed) for node in self._nodes)
+
+
+def AND(*nodes):
+  return ConjunctionNode(nodes)
+
+
+def OR(*nodes):
+  return DisjunctionNode(nodes)
+
+
+class PropertyOrder(object):
+
+  def __init__(self, name, descending):
+    self.name = name
+    self.descending = descending
+
+
+@functools.total_ordering
+class _Sorted(object):
+  """A sort value, compared the other way round when descending."""
+  __slots__ = ('value', 'descending')
+
+  def __init__(self, value, descending):
+    self.value = value
+    self.descending = descending
+
+  def __eq__(self, other):
+    return self.value == other.value
+
+  def __ne__(self, other):
+    return self.value != other.value
+
+  def __lt__(self, other):
+    if self.descending:
+      return other.value < self.value
+    return self.value < other.value
+
+
+def _tuples(value):
+  if isinstance(value, list):
+    return tuple(_tuples(v) for v in value)
+  return value
+
+
+class Cursor(object):
+  """A position in a query's results, after the result it was taken at."""
+
+  def __init__(self, urlsafe=None, position=None):
+    if urlsafe is not None:
+      try:
+        urlsafe = str(urlsafe)
+        position = _tuples(json.loads(base64.urlsafe_b64decode(
+            urlsafe + '=' * (-len(urlsafe) % 4))))
+        if not isinstance(position, tuple):
+          raise ValueError()
+      except Exception:
+        raise BadValueError('Invalid cursor %r' % (urlsafe,))
+    self._position = position
+
+  def urlsafe(self):
+    return base64.urlsafe_b64encode(json.dumps(self._position)).rstrip('=')
+
+  def __eq__(self, other):
+    return isinstance(other, Cursor) and self._position == other._position
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash(self._position)
+
+
+def _property_name(prop):
+  return prop if isinstance(prop, basestring) else prop._name
+
+
+class Query(object):
+  """A query over one kind; every run scans the kind's entities."""
+
+  def __init__(self, kind=None, ancestor=None, filters=None, orders=(),
+               projection=None, distinct=False):
+    if kind is None:
+      raise BadQueryError('Kindless queries are not supported')
+    self.kind = kind
+    self.ancestor = ancestor
+    self.filters = filters
+    self.orders = tuple(orders)
+    self.projection = tuple(_property_name(p) for p in projection or ())
+    self.distinct = distinct
+
+  def _replace(self, **changes):
+    args = dict(kind=self.kind, ancestor=self.ancestor, filters=self.filters,
+                orders=self.orders, projection=self.projection,
+                distinct=self.distinct)
+    args.update(changes)
+    return Query(**args)
+
+  def filter(self, *nodes):
+    if not nodes:
+      return self
+    if self.filters is not None:
+      nodes = (self.filters,) + nodes
+    return self._replace(
+        filters=nodes[0] if len(nodes) == 1 else ConjunctionNode(nodes))
+
+  def order(self, *props):
+    return self._replace(orders=self.orders + tuple(
+        p if isinstance(p, PropertyOrder) else PropertyOrder(p._name, False)
+        for p in props))
+
+  def _sort_orders(self):
+    inequalities = (self.filters._inequalities() if self.filters is not None
+                    else set())
+    if len(inequalities) > 1:
+      raise BadRequestError('Only one property per query may have inequality '
+                            'filters (%s).' % ', '.join(sorted(inequalities)))
+    orders = list(self.orders)
+    if inequalities:
+      name = inequalities.pop()
+      if not orders:
+        orders = [PropertyOrder(name, False)]
+      elif orders[0].name != name:
+        raise BadRequestError('The first sort property must be the same as '
+                              'the property to which the inequality filter '
+                              'is applied (%s).' % name)
+    return orders
+
+  def _run(self, limit=None, offset=0, start_cursor=None, end_cursor=None,
+           keys_only=False, projection=None, **options):
+    """Returns (results, cursor after the last one, whether there are more)."""
+    context = get_context()
+    projection = tuple(_property_name(p) for p in projection or ()) or (
+        self.projection)
+    if context.transaction:
+      if self.ancestor is None:
+        raise BadRequestError('Only ancestor queries are allowed inside '
+                              'transactions.')
+      context.transaction.touch([self.ancestor])
+    if self.distinct and not projection:
+      raise BadQueryError('A distinct query needs a projection')
+    orders = self._sort_orders()
+    descending = [order.descending for order in orders]
+    if self.distinct:
+      descending += [False] * len(projection)
+    else:
+      descending.append(False)
+    ancestor = self.ancestor and self.ancestor.pairs()
+    rows = []
+    with _rpc('datastore_v3', 'RunQuery'):
+      with _datastore.lock:
+        for key, stored in _datastore.kinds[self.kind].items():
+          if ancestor and key.pairs()[:len(ancestor)] != ancestor:
+            continue
+          indexed = stored.indexed
+          if self.filters is not None and not self.filters._matches(indexed):
+            continue
+          if any(order.name not in indexed for order in orders) or any(
+              name not in indexed for name in projection):
+            continue
+          position = [_order_value(_first(indexed[order.name]))
+                      for order in orders]
+          if self.distinct:
+            position += [_order_value(indexed[name]) for name in projection]
+          else:
+            position.append(key._order())
+          rows.append((tuple(position), key, stored))
+    rows.sort(key=lambda row: _sort_key(row[0], descending))
+    if self.distinct:
+      # Keep the first result with each combination of projected values.
+      distinct = collections.OrderedDict()
+      for row in rows:
+        distinct.setdefault(row[0][-len(projection):], row)
+      rows = distinct.values()
+    if start_cursor is not None and start_cursor._position is not None:
+      after = _sort_key(start_cursor._position, descending)
+      rows = [row for row in rows if _sort_key(row[0], descending) > after]
+    if end_cursor is not None and end_cursor._position is not None:
+      until = _sort_key(end_cursor._position, descending)
+      rows = [row for row in rows if _sort_key(row[0], descending) <= until]
+    rows = rows[offset:]
+    more = limit is not None and len(rows) > limit
+    if limit is not None:
+      rows = rows[:limit]
+    cursor = Cursor(position=rows[-1][0]) if rows else None
+    model = Model._lookup_model(self.kind)
+    results = []
+    for _, key, stored in rows:
+      if keys_only:
+        results.append(key)
+      elif projection:
+        results.append(model._from_stored(
+            key, dict((name, stored.indexed[name]) for name in projection),
+            projection))
+      else:
+        entity = context._cache.get(key)
+        if entity is None:
+          entity = context._cache[key] = model._from_stored(key,
+                                                            stored.values)
+        results.append(entity)
+    return results, cursor, more
+
+  def fetch(self, limit=None, **options):
+    return self._run(limit, **options)[0]
+
+  def fetch_async(self, limit=None, **options):
+    return _future(lambda: self.fetch(limit, **options))
+
+  def fetch_page(self, page_size, **options):
+    """Returns (results, cursor after them or None, whether there are more)."""
+    return self._run(page_size, **options)
+
+  def fetch_page_async(self, page_size, **options):
+    return _future(lambda: self.fetch_page(page_size, **options))
+
+  def count(self, limit=None, **options):
+    options['keys_only'] = True
+    return len(self._run(limit, **options)[0])
+
+  def count_async(self, limit=None, **options):
+    return _future(lambda: self.count(limit, **options))
+
+  def get(self, **options):
+    results = self.fetch(1, **options)
+    return results[0] if results else None
+
+  def iter(self, **options):
+    return iter(self.fetch(**options))
+
+  __iter__ = iter
+
+
+def _first(value):
+  return value[0] if isinstance(value, list) and value else value
+
+
+def _sort_key(position, descending):
+  return tuple(_Sorted(value, desc)
+               for value, desc in zip(position, descending))
+
+
+# users
+
+
+class User(object):
+  """A signed in user."""
+
+  def __init__(self, email=None, _auth_domain=None, _user_id=None):
+    self._email = email
+    self._auth_domain = _auth_domain or 'gmail.com'
+    self._user_id = _user_id
+
+  def email(self):
+    return self._email
+
+  def nickname(self):
+    return self._email
+
+  def user_id(self):
+    return self._user_id
+
+  def auth_domain(self):
+    return self._auth_domain
+
+  def __eq__(self, other):
+    return isinstance(other, User) and (
+        (self._email, self._user_id) == (other._email, other._user_id))
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash((self._email, self._user_id))
+
+  def __repr__(self):
+    return 'users.User(email=%r, _user_id=%r)' % (self._email, self._user_id)
+
+
+def get_current_user():
+  """Returns the user in USER_EMAIL and USER_ID, as the SDK sets them."""
+  email = os.environ.get('USER_EMAIL')
+  if not email:
+    return None
+  return User(email, os.environ.get('AUTH_DOMAIN'),
+              os.environ.get('USER_ID') or None)
+
+
+def is_current_user_admin():
+  return os.environ.get('USER_IS_ADMIN') == '1'
+
+
+def create_login_url(dest_url=None, _auth_domain=None,
+                     federated_identity=None):
+  return '/_ah/login?continue=' + urllib.quote(dest_url or '/')
+
+
+def create_logout_url(dest_url, _auth_domain=None):
+  return '/_ah/login?action=Logout&continue=' + urllib.quote(dest_url or '/')
+
+
+# memcache
+
+DELETE_NETWORK_FAILURE = 0
+DELETE_ITEM_MISSING = 1
+DELETE_SUCCESSFUL = 2
+
+# Expiration times up to this many seconds are relative to now.
+_MAX_RELATIVE_TIME = 30 * 24 * 60 * 60
+
+
+def _expires(seconds, now):
+  if not seconds:
+    return None
+  return now + seconds if seconds <= _MAX_RELATIVE_TIME else seconds
+
+
+class _Memcache(object):
+  """Cached values, kept pickled, and delete locks, by namespace and key.
+
+  Every store gives the key a new CAS id, which gets hands out and cas checks.
+  """
+
+  def __init__(self):
+    self.lock = threading.RLock()
+    self.items = {}
+    self.cas_ids = {}
+    self.next_cas_id = 0
+
+  def store(self, key, value, expires):
+    self.next_cas_id += 1
+    self.items[key] = (pickle.dumps(value, 2), expires, None)
+    self.cas_ids[key] = self.next_cas_id
+
+  def live(self, key, now):
+    """Returns (value, expires) of a key, or None if it is not cached."""
+    item = self.items.get(key)
+    if item is None or item[0] is None or (item[1] is not None and
+                                           item[1] <= now):
+      return None
+    return item
+
+  def locked(self, key, now):
+    item = self.items.get(key)
+    return item is not None and item[2] is not None and item[2] > now
+
+
+_memcache = _Memcache()
+
+
+class Client(object):
+  """A memcache client; every Client shares the one in-memory cache.
+
+  The CAS ids returned by gets are remembered by the Client that read them.
+  """
+
+  def __init__(self):
+    self._cas_ids = {}
+
+  def _key(self, key, key_prefix='', namespace=None):
+    return (namespace or '', key_prefix + key)
+
+  def get(self, key, namespace=None, for_cas=False):
+    return self.get_multi([key], namespace=namespace, for_cas=for_cas).get(key)
+
+  def get_multi(self, keys, key_prefix='', namespace=None, for_cas=False):
+    found = {}
+    with _rpc('memcache', 'Get'):
+      with _memcache.lock:
+        now = time.time()
+        for key in keys:
+          full = self._key(key, key_prefix, namespace)
+          item = _memcache.live(full, now)
+          if item is not None:
+            found[key] = pickle.loads(item[0])
+            if for_cas:
+              self._cas_ids[full] = _memcache.cas_ids.get(full)
+    return found
+
+  def gets(self, key, namespace=None):
+    return self.get(key, namespace=namespace, for_cas=True)
+
+  def _store(self, policy, mapping, seconds, key_prefix, namespace):
+    """Stores values under policy set, add or replace; returns keys not set."""
+    failed = []
+    with _rpc('memcache', 'Set'):
+      with _memcache.lock:
+        now = time.time()
+        for key, value in mapping.items():
+          full = self._key(key, key_prefix, namespace)
+          present = _memcache.live(full, now) is not None
+          if (policy == 'add' and (present or _memcache.locked(full, now)) or
+              policy == 'replace' and not present or
+              policy == 'cas' and not (
+                  present and full in self._cas_ids and
+                  self._cas_ids[full] == _memcache.cas_ids.get(full))):
+            failed.append(key)
+            continue
+          _memcache.store(full, value, _expires(seconds, now))
+          if policy == 'cas':
+            del self._cas_ids[full]
+    return failed
+
+  def set(self, key, value, time=0, min_compress_len=0, namespace=None):
+    return not self._store('set', {key: value}, time, '', namespace)
+
+  def set_multi(self, mapping, time=0, key_prefix='', min_compress_len=0,
+                namespace=None):
+    return self._store('set', mapping, time, key_prefix, namespace)
+
+  def add(self, key, value, time=0, min_compress_len=0, namespace=None):
+    return not self._store('add', {key: value}, time, '', namespace)
+
+  def add_multi(self, mapping, time=0, key_prefix='', min_compress_len=0,
+                namespace=None):
+    return self._store('add', mapping, time, key_prefix, namespace)
+
+  def replace(self, key, value, time=0, min_compress_len=0, namespace=None):
+    return not self._store('replace', {key: value}, time, '', namespace)
+
+  def cas(self, key, value, time=0, min_compress_len=0, namespace=None):
+    """Sets a key only if it is unchanged since this Client's gets of it."""
+    return not self._store('cas', {key: value}, time, '', namespace)
+
+  def delete(self, key, seconds=0, namespace=None):
+    """Deletes a key; for seconds after, add of the key fails but set works."""
+    return self._delete([key], seconds, '', namespace)[0]
+
+  def delete_multi(self, keys, seconds=0, key_prefix='', namespace=None):
+    self._delete(keys, seconds, key_prefix, namespace)
+    return True
+
+  def _delete(self, keys, seconds, key_prefix, namespace):
+    statuses = []
+    with _rpc('memcache', 'Delete'):
+      with _memcache.lock:
+        now = time.time()
+        for key in keys:
+          full = self._key(key, key_prefix, namespace)
+          found = _memcache.live(full, now) is not None
+          statuses.append(DELETE_SUCCESSFUL if found else DELETE_ITEM_MISSING)
+          _memcache.cas_ids.pop(full, None)
+          if seconds:
+            _memcache.items[full] = (None, None, _expires(seconds, now))
+          else:
+            _memcache.items.pop(full, None)
+    return statuses
+
+  def incr(self, key, delta=1, namespace=None, initial_value=None):
+    with _rpc('memcache', 'Increment'):
+      with _memcache.lock:
+        now = time.time()
+        full = self._key(key, '', namespace)
+        item = _memcache.live(full, now)
+        if item is None:
+          if initial_value is None:
+            return None
+          value, expires = initial_value, None
+        else:
+          value, expires = pickle.loads(item[0]), item[1]
+        value = max(0, int(value) + delta)
+        _memcache.store(full, value, expires)
+        return value
+
+  def decr(self, key, delta=1, namespace=None, initial_value=None):
+    return self.incr(key, -delta, namespace, initial_value)
+
+  def flush_all(self):
+    with _rpc('memcache', 'FlushAll'):
+      with _memcache.lock:
+        _memcache.items.clear()
+        _memcache.cas_ids.clear()
+    return True
+
+
+# taskqueue
+
+
+class TaskQueueError(Exception):
+  """Base class for task queue errors."""
+
+
+class TaskAlreadyExistsError(TaskQueueError):
+  """A task of the same name is in the queue."""
+
+
+class TombstonedTaskError(TaskQueueError):
+  """A task of the same name was in the queue and has been deleted."""
+
+
+class Task(object):
+  """A push task, or with method PULL, a pull task."""
+
+  def __init__(self, payload=None, name=None, method='POST', url=None,
+               params=None, headers=None, eta=None, countdown=None, tag=None,
+               **options):
+    if params is not None and payload is None:
+      payload = urllib.urlencode(params)
+    self.payload = payload
+    self.name = name
+    self.method = method
+    self.url = url
+    self.params = params
+    self.headers = headers or {}
+    self.tag = tag
+    self.eta = eta or (datetime.datetime.utcnow() +
+                       datetime.timedelta(seconds=countdown or 0))
+    self.queue_name = None
+    self.was_enqueued = False
+
+  @property
+  def eta_posix(self):
+    return calendar.timegm(self.eta.utctimetuple()) + (
+        self.eta.microsecond / 1e6)
+
+  def add(self, queue_name='default', transactional=False):
+    return Queue(queue_name).add(self, transactional)
+
+
+class _TaskQueues(object):
+  """Tasks by queue and name, and the names of deleted tasks."""
+
+  def __init__(self):
+    self.lock = threading.RLock()
+    self.tasks = collections.defaultdict(collections.OrderedDict)
+    self.tombstones = collections.defaultdict(set)
+    self.last_id = 0
+
+
+_task_queues = _TaskQueues()
+
+
+class Queue(object):
+  """A push or pull queue."""
+
+  def __init__(self, name='default'):
+    self.name = name
+
+  def add(self, task, transactional=False):
+    tasks = task if isinstance(task, (list, tuple)) else [task]
+    with _rpc('taskqueue', 'BulkAdd'):
+      with _task_queues.lock:
+        queue = _task_queues.tasks[self.name]
+        for t in tasks:
+          if t.name in queue:
+            raise TaskAlreadyExistsError(t.name)
+          if t.name in _task_queues.tombstones[self.name]:
+            raise TombstonedTaskError(t.name)
+        for t in tasks:
+          if t.name is None:
+            _task_queues.last_id += 1
+            t.name = 'task%d' % _task_queues.last_id
+          t.queue_name = self.name
+          t.was_enqueued = True
+          queue[t.name] = t
+    return task
+
+  def lease_tasks_by_tag(self, lease_seconds, max_tasks, tag=None,
+                         deadline=10):
+    """Leases tasks due with tag, or with the tag of the first due task."""
+    with _rpc('taskqueue', 'QueryAndOwnTasks'):
+      with _task_queues.lock:
+        now = datetime.datetime.utcnow()
+        due = sorted((t for t in _task_queues.tasks[self.name].values()
+                      if t.eta <= now), key=lambda t: t.eta)
+        if tag is None and due:
+          tag = due[0].tag
+        leased = [t for t in due if t.tag == tag][:max_tasks]
+        for t in leased:
+          t.eta = now + datetime.timedelta(seconds=lease_seconds)
+        return leased
+
+  def lease_tasks(self, lease_seconds, max_tasks, deadline=10):
+    with _rpc('taskqueue', 'QueryAndOwnTasks'):
+      with _task_queues.lock:
+        now = datetime.datetime.utcnow()
+        leased = sorted((t for t in _task_queues.tasks[self.name].values()
+                         if t.eta <= now), key=lambda t: t.eta)[:max_tasks]
+        for t in leased:
+          t.eta = now + datetime.timedelta(seconds=lease_seconds)
+        return leased
+
+  def modify_task_lease(self, task, lease_seconds):
+    with _rpc('taskqueue', 'ModifyTaskLease'):
+      task.eta = datetime.datetime.utcnow() + datetime.timedelta(
+          seconds=lease_seconds)
+
+  def delete_tasks(self, task):
+    tasks = task if isinstance(task, (list, tuple)) else [task]
+    with _rpc('taskqueue', 'Delete'):
+      with _task_queues.lock:
+        for t in tasks:
+          _task_queues.tasks[self.name].pop(t.name, None)
+          _task_queues.tombstones[self.name].add(t.name)
+    return task
+
+  def purge(self):
+    with _task_queues.lock:
+      _task_queues.tasks[self.name].clear()
+
+
+def add_task(*args, **kwds):
+  """taskqueue.add: makes a Task of the arguments and adds it to queue_name."""
+  queue_name = kwds.pop('queue_name', 'default')
+  transactional = kwds.pop('transactional', False)
+  return Task(*args, **kwds).add(queue_name, transactional)
+
+
+def queued_tasks(queue_name='default'):
+  """Returns the tasks in a queue, leased or not, in the order added."""
+  with _task_queues.lock:
+    return list(_task_queues.tasks[queue_name].values())
+
+
+# webapp2
+
+
+class RequestHandler(object):
+
+  def __init__(self, request=None, response=None):
+    self.request = request
+    self.response = response
+
+
+class WSGIApplication(object):
+  """Takes the task handlers' routes; the stand-in does not serve them."""
+
+  def __init__(self, routes=None, debug=False, config=None):
+    self.routes = list(routes or [])
+
+  def __call__(self, environ, start_response):
+    start_response('501 Not Implemented', [('Content-Type', 'text/plain')])
+    return ['Not served by the App Engine stubs.\n']
+
+
+# testbed and datastore_stub_util, for running app_test.py on the stand-ins
+
+
+DATASTORE_SERVICE_NAME = 'datastore_v3'
+MEMCACHE_SERVICE_NAME = 'memcache'
+TASKQUEUE_SERVICE_NAME = 'taskqueue'
+USER_SERVICE_NAME = 'user'
+
+
+class PseudoRandomHRConsistencyPolicy(object):
+  """Accepted for the SDK's sake; the stand-in is always strongly consistent.
+
+  Only probability=1, the SDK's strongly consistent setting, is supported.
+  """
+
+  def __init__(self, probability=1, seed=None):
+    if probability != 1:
+      raise NotImplementedError('eventual consistency is not modelled')
+
+
+class _TaskQueueStub(object):
+  """The part of the SDK's task queue stub that tests read."""
+
+  def get_filtered_tasks(self, url=None, name=None, queue_names=None):
+    with _task_queues.lock:
+      tasks = [t for queue_name, queue in _task_queues.tasks.items()
+               if queue_names is None or queue_name in queue_names
+               for t in queue.values()]
+    return [t for t in tasks
+            if (url is None or t.url == url) and
+            (name is None or t.name == name)]
+
+  def FlushQueue(self, queue_name):
+    Queue(queue_name).purge()
+
+
+class Testbed(object):
+  """Empties the stand-ins on activate and deactivate.
+
+  Every service is always available, so the init_*_stub calls only accept
+  the SDK's arguments.
+  """
+
+  def __init__(self):
+    self._environ = None
+
+  def activate(self):
+    self._environ = dict(os.environ)
+    reset()
+
+  def deactivate(self):
+    os.environ.clear()
+    os.environ.update(self._environ)
+    reset()
+
+  def setup_env(self, overwrite=False, **kwds):
+    for name, value in kwds.items():
+      if overwrite or name.upper() not in os.environ:
+        os.environ[name.upper()] = str(value)
+
+  def init_datastore_v3_stub(self, consistency_policy=None, **kwds):
+    pass
+
+  def init_memcache_stub(self, **kwds):
+    pass
+
+  def init_taskqueue_stub(self, root_path=None, **kwds):
+    pass
+
+  def init_user_stub(self, **kwds):
+    pass
+
+  def get_stub(self, service_name):
+    if service_name != TASKQUEUE_SERVICE_NAME:
+      raise NotImplementedError(service_name)
+    return _TaskQueueStub()
+
+
+# The stand-in modules.
+
+
+def _module(name, **attrs):
+  module = types.ModuleType(name)
+  module.__dict__.update(attrs)
+  return module
+
+
+datastore_errors = _module(
+    'google.appengine.api.datastore_errors', Error=Error,
+    BadValueError=BadValueError, BadArgumentError=BadArgumentError,
+    BadRequestError=BadRequestError, BadFilterError=BadFilterError,
+    BadQueryError=BadQueryError,
+    TransactionFailedError=TransactionFailedError, Rollback=Rollback)
+
+ndb = _module(
+    'google.appengine.ext.ndb', Key=Key, Model=Model, MetaModel=MetaModel,
+    Property=Property, ModelKey=ModelKey, BooleanProperty=BooleanProperty,
+    IntegerProperty=IntegerProperty, FloatProperty=FloatProperty,
+    StringProperty=StringProperty, TextProperty=TextProperty,
+    BlobProperty=BlobProperty, DateTimeProperty=DateTimeProperty,
+    KeyProperty=KeyProperty, StructuredProperty=StructuredProperty,
+    ComputedProperty=ComputedProperty, Query=Query, Cursor=Cursor,
+    FilterNode=FilterNode, ConjunctionNode=ConjunctionNode,
+    DisjunctionNode=DisjunctionNode, AND=AND, OR=OR, Future=Future,
+    Return=Return, tasklet=tasklet, Context=Context, get_context=get_context,
+    in_transaction=in_transaction, transaction=transaction,
+    transactional=transactional, TransactionOptions=TransactionOptions,
+    get_multi=get_multi, get_multi_async=get_multi_async,
+    put_multi=put_multi, put_multi_async=put_multi_async,
+    delete_multi=delete_multi, delete_multi_async=delete_multi_async,
+    Rollback=Rollback, BadValueError=BadValueError, KindError=KindError,
+    ComputedPropertyError=ComputedPropertyError,
+    UnprojectedPropertyError=UnprojectedPropertyError)
+
+datastore_query = _module('google.appengine.datastore.datastore_query',
+                          Cursor=Cursor)
+
+users = _module(
+    'google.appengine.api.users', User=User,
+    get_current_user=get_current_user,
+    is_current_user_admin=is_current_user_admin,
+    create_login_url=create_login_url, create_logout_url=create_logout_url)
+
+_client = Client()
+memcache = _module(
+    'google.appengine.api.memcache', Client=Client,
+    DELETE_NETWORK_FAILURE=DELETE_NETWORK_FAILURE,
+    DELETE_ITEM_MISSING=DELETE_ITEM_MISSING,
+    DELETE_SUCCESSFUL=DELETE_SUCCESSFUL, get=_client.get,
+    get_multi=_client.get_multi, set=_client.set,
+    set_multi=_client.set_multi, add=_client.add,
+    add_multi=_client.add_multi, replace=_client.replace,
+    delete=_client.delete, delete_multi=_client.delete_multi,
+    incr=_client.incr, decr=_client.decr, flush_all=_client.flush_all)
+
+taskqueue = _module(
+    'google.appengine.api.taskqueue', Error=TaskQueueError,
+    TaskAlreadyExistsError=TaskAlreadyExistsError,
+    TombstonedTaskError=TombstonedTaskError, Task=Task, Queue=Queue,
+    add=add_task)
+
+apiproxy_stub_map = _module('google.appengine.api.apiproxy_stub_map',
+                            apiproxy=apiproxy)
+
+testbed = _module(
+    'google.appengine.ext.testbed', Testbed=Testbed,
+    DATASTORE_SERVICE_NAME=DATASTORE_SERVICE_NAME,
+    MEMCACHE_SERVICE_NAME=MEMCACHE_SERVICE_NAME,
+    TASKQUEUE_SERVICE_NAME=TASKQUEUE_SERVICE_NAME,
+    USER_SERVICE_NAME=USER_SERVICE_NAME)
+
+datastore_stub_util = _module(
+    'google.appengine.datastore.datastore_stub_util',
+    PseudoRandomHRConsistencyPolicy=PseudoRandomHRConsistencyPolicy)
+
+webapp2 = _module('webapp2', RequestHandler=RequestHandler,
+                  WSGIApplication=WSGIApplication)
+
+_MODULES = (datastore_errors, ndb, datastore_query, users, memcache,
+            taskqueue, apiproxy_stub_map, testbed, datastore_stub_util)
+
+
+def reset():
+  """Empties the datastore, memcache and task queues."""
+  _datastore.clear()
+  with _memcache.lock:
+    _memcache.items.clear()
+    _memcache.cas_ids.clear()
+  with _task_queues.lock:
+    _task_queues.tasks.clear()
+    _task_queues.tombstones.clear()
+  get_context().clear_cache()
+
+
+def install():
+  """Registers the stand-ins as the google.appengine modules.
+
+  Call before anything imports the SDK's modules. A real webapp2 is used if
+  one can be imported.
+  """
+  try:
+    import google
+  except ImportError:
+    google = sys.modules['google'] = _module('google', __path__=[])
+  packages = {'google': google}
+  for name in ('google.appengine', 'google.appengine.api',
+               'google.appengine.datastore', 'google.appengine.ext'):
+    parent, _, leaf = name.rpartition('.')
+    packages[name] = sys.modules[name] = _module(name, __path__=[])
+    setattr(packages[parent], leaf, packages[name])
+  for module in _MODULES:
+    parent, _, leaf = module.__name__.rpartition('.')
+    sys.modules[module.__name__] = module
+    setattr(packages[parent], leaf, module)
+  try:
+    __import__('webapp2')
+  except ImportError:
+    sys.modules['webapp2'] = webapp2
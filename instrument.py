@@ -0,0 +1,275 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Google, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Instrument: per-request RPC counts and timings for the Flask app.
+
+API proxy hooks count and time every datastore and memcache call made while a
+request is being served, and warn when the same datastore key is fetched more
+than once outside a transaction. The WSGI middleware adds the totals, with template render time and
+overall latency, to a Server-Timing header and a structured log line, and
+folds them into per-route histograms served at /admin/instrumentation.
+"""
+
+import bisect
+import collections
+import json
+import logging
+import threading
+import time
+
+import jinja2
+
+from flask import request
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+
+# Services whose calls are counted.
+SERVICES = ('datastore_v3', 'memcache')
+# Upper bounds, in milliseconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# Upper bounds of the RPCs per request histogram buckets.
+RPC_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+_HOOK_NAME = 'instrument'
+# Time source of the RPC hooks.
+_clock = time.time
+_state = threading.local()
+_lock = threading.Lock()
+_routes = {}
+
+
+class RequestStats(object):
+  """What one request has done so far."""
+
+  def __init__(self):
+    self.start = time.time()
+    # The matched URL rule; requests matching none are counted together.
+    self.route = '<unmatched>'
+    self.calls = collections.Counter()
+    # Time with at least one RPC in flight, so overlapping async calls are
+    # only counted once.
+    self.rpc_ms = 0.0
+    self.render_ms = 0.0
+    self.gets = collections.Counter()
+    # Keys read inside transactions, which re-read what the request already
+    # has in order to see it as of the transaction.
+    self.transaction_gets = 0
+    # RPCs in flight, by id of their request, and when the first one started.
+    self.pending = set()
+    self.busy_since = None
+
+  def rpcs(self):
+    return sum(self.calls.values())
+
+
+def current():
+  """Returns the RequestStats of the request being served, or None."""
+  return getattr(_state, 'stats', None)
+
+
+def _pre_call(service, call, request_pb, response_pb):
+  stats = current()
+  if stats is None:
+    return
+  stats.calls['%s.%s' % (service, call)] += 1
+  if not stats.pending:
+    stats.busy_since = _clock()
+  stats.pending.add(id(request_pb))
+  if service == 'datastore_v3' and call == 'Get':
+    if ndb.in_transaction():
+      stats.transaction_gets += len(request_pb.key_list())
+      return
+    for key in request_pb.key_list():
+      encoded = key.Encode()
+      stats.gets[encoded] += 1
+      if stats.gets[encoded] == 2:
+        logging.warning('Repeated datastore get of %s in %s',
+                        _describe(key), stats.route)
+
+
+def _post_call(service, call, request_pb, response_pb):
+  stats = current()
+  if stats is None:
+    return
+  if id(request_pb) not in stats.pending:
+    return
+  stats.pending.remove(id(request_pb))
+  if not stats.pending:
+    stats.rpc_ms += (_clock() - stats.busy_since) * 1000
+
+
+def _describe(key):
+  return '/'.join('%s:%s' % (e.type(), e.name() if e.has_name() else e.id())
+                  for e in key.path().element_list())
+
+
+def _install_hooks():
+  """Adds the hooks to the current API proxy; a no-op once they are there."""
+  proxy = apiproxy_stub_map.apiproxy
+  for service in SERVICES:
+    proxy.GetPreCallHooks().Append(_HOOK_NAME + service, _pre_call, service)
+    proxy.GetPostCallHooks().Append(_HOOK_NAME + service, _post_call, service)
+
+
+class _Histogram(object):
+  """Counts of values falling under each of a list of upper bounds."""
+
+  def __init__(self, bounds):
+    self.bounds = bounds
+    self.counts = [0] * (len(bounds) + 1)
+    self.total = 0.0
+
+  def add(self, value):
+    self.counts[bisect.bisect_left(self.bounds, value)] += 1
+    self.total += value
+
+  def to_dict(self):
+    labels = ['<=%s' % b for b in self.bounds] + ['>%s' % self.bounds[-1]]
+    return {'total': self.total,
+            'buckets': collections.OrderedDict(zip(labels, self.counts))}
+
+
+class _RouteStats(object):
+
+  def __init__(self):
+    self.requests = 0
+    self.calls = collections.Counter()
+    self.latency_ms = _Histogram(LATENCY_BUCKETS)
+    self.rpc_ms = _Histogram(LATENCY_BUCKETS)
+    self.render_ms = _Histogram(LATENCY_BUCKETS)
+    self.rpcs = _Histogram(RPC_BUCKETS)
+
+  def to_dict(self):
+    return {'requests': self.requests,
+            'calls': dict(self.calls),
+            'latency_ms': self.latency_ms.to_dict(),
+            'rpc_ms': self.rpc_ms.to_dict(),
+            'render_ms': self.render_ms.to_dict(),
+            'rpcs': self.rpcs.to_dict()}
+
+
+def _record(stats, total_ms):
+  with _lock:
+    route = _routes.setdefault(stats.route, _RouteStats())
+    route.requests += 1
+    route.calls.update(stats.calls)
+    route.latency_ms.add(total_ms)
+    route.rpc_ms.add(stats.rpc_ms)
+    route.render_ms.add(stats.render_ms)
+    route.rpcs.add(stats.rpcs())
+
+
+def histograms():
+  """Returns the per-route histograms recorded by this instance."""
+  with _lock:
+    return dict((route, stats.to_dict()) for route, stats in _routes.items())
+
+
+def reset():
+  """Forgets the recorded histograms."""
+  with _lock:
+    _routes.clear()
+
+
+def server_timing(stats, total_ms):
+  """Returns the Server-Timing header value for a request."""
+  return ('datastore;dur=%.1f;desc="%d rpcs", render;dur=%.1f, '
+          'total;dur=%.1f' % (stats.rpc_ms, stats.rpcs(), stats.render_ms,
+                              total_ms))
+
+
+class InstrumentationMiddleware(object):
+  """WSGI middleware timing each request and the RPCs made serving it."""
+
+  def __init__(self, app):
+    self.app = app
+
+  def __call__(self, environ, start_response):
+    _install_hooks()
+    stats = _state.stats = RequestStats()
+
+    def timed_start_response(status, headers, exc_info=None):
+      total_ms = (time.time() - stats.start) * 1000
+      headers = list(headers) + [
+          ('Server-Timing', server_timing(stats, total_ms))]
+      return start_response(status, headers, exc_info)
+
+    try:
+      body = self.app(environ, timed_start_response)
+    except:
+      self._finish(stats)
+      raise
+    return _ClosingIterator(body, lambda: self._finish(stats))
+
+  def _finish(self, stats):
+    if current() is not stats:
+      return
+    _state.stats = None
+    total_ms = (time.time() - stats.start) * 1000
+    _record(stats, total_ms)
+    logging.info('request_stats %s', json.dumps({
+        'route': stats.route,
+        'total_ms': round(total_ms, 1),
+        'rpc_ms': round(stats.rpc_ms, 1),
+        'render_ms': round(stats.render_ms, 1),
+        'rpcs': stats.rpcs(),
+        'calls': dict(stats.calls),
+        'repeated_gets': sum(1 for n in stats.gets.values() if n > 1),
+        'transaction_gets': stats.transaction_gets}))
+
+
+class _ClosingIterator(object):
+  """Iterates a WSGI body, calling on_close once it is closed."""
+
+  def __init__(self, body, on_close):
+    self._body = body
+    self._on_close = on_close
+
+  def __iter__(self):
+    return iter(self._body)
+
+  def close(self):
+    try:
+      if hasattr(self._body, 'close'):
+        self._body.close()
+    finally:
+      self._on_close()
+
+
+class TimedTemplate(jinja2.Template):
+  """A Jinja template that adds its render time to the request's stats."""
+
+  def render(self, *args, **kwargs):
+    started = time.time()
+    try:
+      return super(TimedTemplate, self).render(*args, **kwargs)
+    finally:
+      stats = current()
+      if stats is not None:
+        stats.render_ms += (time.time() - started) * 1000
+
+
+def _name_route():
+  stats = current()
+  if stats is not None and request.url_rule is not None:
+    stats.route = request.url_rule.rule
+
+
+def install(app):
+  """Instruments a Flask app; call before it renders any template."""
+  app.jinja_env.template_class = TimedTemplate
+  app.before_request(_name_route)
+  app.wsgi_app = InstrumentationMiddleware(app.wsgi_app)
@@ -0,0 +1,338 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Google, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Leaderboard: materialized net worth standings, overall and per org.
+
+Standings are root entities kept up to date incrementally. Each user's
+position in a market is mirrored by a Holding, which remembers what it adds to
+the user's standings, so a change to one market is applied to them as a
+difference. Trades and the sequencer record the positions they leave, and
+scoring the payouts it makes, right after they commit. A price move is
+applied by a revalue task, which reprices only that market's Holdings, at most
+once every REVALUE_INTERVAL seconds per market; the ranking may be that far
+behind. None of this touches the traders' entity groups, so it does not
+contend with their trades.
+"""
+
+import webapp2
+
+import collections
+import datetime
+import logging
+import os
+import time
+
+from models import Holding, LedgerRecords, Standing
+from models import display_name, holding_key, run_in_transaction
+from models import standing_key
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+# Holdings updated per transaction. Each brings its user's overall and org
+# standings, and a cross-group transaction may touch at most 25 groups.
+PAGE_SIZE = 8
+# Seconds of price moves on a market gathered into one revaluation.
+REVALUE_INTERVAL = 10
+
+
+def mark(position, price):
+  """Returns what a position is worth at a contract one price."""
+  return position.contract_one * price + position.contract_two * (1 - price)
+
+
+def _standing(standings, user_key, org, name=None):
+  """Returns the user's Standing in org from standings, adding it if new."""
+  key = standing_key(user_key, org)
+  if standings.get(key) is None:
+    standings[key] = Standing(key=key, org=org)
+  if name is not None:
+    standings[key].name = name
+  return standings[key]
+
+
+def _load_standings(holdings):
+  """Gets the overall and org Standings of some holdings, keyed by key."""
+  keys = list(collections.OrderedDict.fromkeys(
+      key for h in holdings if h is not None
+      for key in [standing_key(h.user_id)] + (
+          [standing_key(h.user_id, h.org)] if h.org else [])))
+  return dict(zip(keys, ndb.get_multi(keys)))
+
+
+def _apply(holding, standings):
+  """Applies the change in what a holding adds to its user's standings.
+
+  Positions in markets with an outcome are worth nothing, as they have been or
+  are being paid out; an org's cash is the holding's basis and any payout.
+  """
+  value = 0.00 if holding.closed else mark(holding, holding.price)
+  cash = holding.basis + holding.payout
+  overall = _standing(standings, holding.user_id, '')
+  overall.holdings += value - holding.value
+  if holding.org:
+    org = _standing(standings, holding.user_id, holding.org)
+    org.holdings += value - holding.value
+    org.cash += cash - holding.cash
+  holding.value, holding.cash = value, cash
+
+
+def _set_balance(standings, profile, as_of):
+  """Sets the overall cash to a balance, unless a later one is already set."""
+  overall = _standing(standings, profile.key, '', display_name(profile))
+  if overall.as_of is None or as_of >= overall.as_of:
+    overall.cash = profile.balance
+    overall.as_of = as_of
+
+
+def _record_page(updates):
+  holdings = ndb.get_multi([holding_key(profile.key, prediction.key)
+                            for profile, prediction, _ in updates])
+  holdings = [h or Holding(key=holding_key(profile.key, prediction.key),
+                           user_id=profile.key, prediction_id=prediction.key,
+                           org=prediction.org or '')
+              for h, (profile, prediction, _) in zip(holdings, updates)]
+  standings = _load_standings(holdings)
+  for holding, (profile, prediction, position) in zip(holdings, updates):
+    when = position.updated_time
+    if holding.as_of is None or when >= holding.as_of:
+      holding.contract_one = position.contract_one
+      holding.contract_two = position.contract_two
+      holding.basis = (position.realized_pnl - position.cost_one -
+                       position.cost_two)
+      holding.as_of = when
+    if holding.priced_at is None or when >= holding.priced_at:
+      holding.price = prediction.GetPriceByPredictionId()
+      holding.priced_at = when
+    holding.closed = holding.closed or prediction.outcome != 'UNKNOWN'
+    _apply(holding, standings)
+    if holding.org:
+      _standing(standings, profile.key, holding.org, display_name(profile))
+    _set_balance(standings, profile, when)
+  ndb.put_multi(holdings + standings.values())
+
+
+def record_positions(updates):
+  """Applies the positions some trades left to the traders' standings.
+
+  updates are (profile, prediction, position) as the trades committed them.
+  Runs after the commit, so a failure is logged rather than raised; the
+  trader's next trade in the market records the position again.
+  """
+  updates = [u for u in updates if None not in u]
+  for i in range(0, len(updates), PAGE_SIZE):
+    page = updates[i:i + PAGE_SIZE]
+    try:
+      run_in_transaction(lambda: _record_page(page))
+    except Exception:
+      logging.warning('Dropped leaderboard update of %d positions', len(page),
+                      exc_info=True)
+
+
+def _payout_page(prediction, payouts, when):
+  holdings = ndb.get_multi([holding_key(profile.key, prediction.key)
+                            for profile, _ in payouts])
+  holdings = [h or Holding(key=holding_key(profile.key, prediction.key),
+                           user_id=profile.key, prediction_id=prediction.key,
+                           org=prediction.org or '')
+              for h, (profile, _) in zip(holdings, payouts)]
+  standings = _load_standings(holdings)
+  for holding, (profile, earned) in zip(holdings, payouts):
+    if holding.paid:
+      continue
+    holding.closed = holding.paid = True
+    holding.payout = earned
+    _apply(holding, standings)
+    _set_balance(standings, profile, when)
+  ndb.put_multi(holdings + standings.values())
+
+
+def record_payouts(prediction_key, payouts):
+  """Applies a market's payouts to the traders' standings.
+
+  payouts are (profile, earned) as scoring committed them; a holding is only
+  paid once. Runs after the commit, so a failure is logged rather than raised.
+  """
+  prediction = prediction_key.get()
+  when = datetime.datetime.now()
+  for i in range(0, len(payouts), PAGE_SIZE):
+    page = payouts[i:i + PAGE_SIZE]
+    try:
+      run_in_transaction(lambda: _payout_page(prediction, page, when))
+    except Exception:
+      logging.warning('Dropped leaderboard payout of %d traders of %s',
+                      len(page), prediction_key.urlsafe(), exc_info=True)
+
+
+def _reprice_page(keys, price, closed, priced_at):
+  holdings = ndb.get_multi(keys)
+  standings = _load_standings(holdings)
+  repriced = []
+  for holding in holdings:
+    if holding is None or (holding.priced_at is not None and
+                           holding.priced_at > priced_at):
+      continue
+    holding.price, holding.priced_at = price, priced_at
+    holding.closed = holding.closed or closed
+    _apply(holding, standings)
+    repriced.append(holding)
+  ndb.put_multi(repriced + standings.values())
+  return len(repriced)
+
+
+def revalue(prediction_key):
+  """Marks every Holding of a market at its current price.
+
+  Only the market's contribution to each holder's standings changes. Returns
+  how many Holdings were repriced.
+  """
+  priced_at = datetime.datetime.now()
+  prediction = prediction_key.get()
+  if prediction is None:
+    return 0
+  price = prediction.GetPriceByPredictionId()
+  closed = prediction.outcome != 'UNKNOWN'
+  query = Holding.query(Holding.prediction_id == prediction_key)
+  repriced, cursor, more = 0, None, True
+  while more:
+    keys, cursor, more = query.fetch_page(
+        PAGE_SIZE, start_cursor=cursor, keys_only=True)
+    if keys:
+      repriced += run_in_transaction(
+          lambda: _reprice_page(keys, price, closed, priced_at))
+  return repriced
+
+
+def rebuild(user_keys):
+  """Recomputes and writes the Holdings and Standings of some traders.
+
+  For backfills: profiles and positions are read outside any transaction (an
+  ancestor query is strongly consistent) and everything is written from
+  scratch. Returns how many Standings were written.
+  """
+  profile_futures = ndb.get_multi_async(user_keys)
+  position_futures = [LedgerRecords.query(ancestor=user_key).fetch_async()
+                      for user_key in user_keys]
+  profiles = [f.get_result() for f in profile_futures]
+  positions = [f.get_result() for f in position_futures]
+  prediction_keys = list(set(
+      ndb.Key(urlsafe=position.prediction_id)
+      for held in positions for position in held))
+  predictions = dict(zip(prediction_keys, ndb.get_multi(prediction_keys)))
+  now = datetime.datetime.now()
+  holdings = []
+  standings = collections.OrderedDict()
+  for profile, held in zip(profiles, positions):
+    if profile is None:
+      continue
+    _set_balance(standings, profile, now)
+    for position in held:
+      prediction_key = ndb.Key(urlsafe=position.prediction_id)
+      prediction = predictions.get(prediction_key)
+      holding = Holding(
+          key=holding_key(profile.key, prediction_key), user_id=profile.key,
+          prediction_id=prediction_key,
+          org=(prediction.org or '') if prediction else '',
+          contract_one=position.contract_one,
+          contract_two=position.contract_two,
+          basis=(position.realized_pnl - position.cost_one -
+                 position.cost_two),
+          as_of=position.updated_time, priced_at=now, closed=True)
+      if prediction is not None:
+        holding.price = prediction.GetPriceByPredictionId()
+        holding.closed = prediction.outcome != 'UNKNOWN'
+        if prediction.resolved:
+          holding.paid = True
+          holding.payout = (position.contract_one
+                            if prediction.outcome == 'CONTRACT_ONE'
+                            else position.contract_two)
+      _apply(holding, standings)
+      if holding.org:
+        _standing(standings, profile.key, holding.org, display_name(profile))
+      holdings.append(holding)
+  ndb.put_multi(holdings + standings.values())
+  return len(standings)
+
+
+def get_leaderboard(org='', limit=50, cursor=None):
+  """Get one page of Standings by net worth, overall or for an org.
+
+  Returns (standings, next_cursor, more) as ndb.Query.fetch_page does;
+  cursor is the urlsafe string of the previous page's next_cursor.
+  """
+  query = Standing.query(Standing.org == (org or '')).order(
+      -Standing.net_worth)
+  return query.fetch_page(
+      limit, start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+
+
+class TaskQueueExecutor(object):
+  """Runs revaluations as named push tasks, one per market per interval."""
+
+  def schedule(self, prediction_key):
+    prediction_id = prediction_key.urlsafe()
+    try:
+      taskqueue.add(
+          url='/tasks/leaderboard/revalue',
+          params={'prediction_id': prediction_id},
+          name='revalue-%s-%d' % (prediction_id,
+                                  int(time.time() // REVALUE_INTERVAL)),
+          countdown=REVALUE_INTERVAL,
+          queue_name='leaderboard')
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      pass
+
+
+class LocalExecutor(object):
+  """Gathers markets to revalue in-process, on run()."""
+
+  def __init__(self):
+    self.pending = collections.OrderedDict()
+
+  def schedule(self, prediction_key):
+    self.pending[prediction_key] = True
+
+  def run(self):
+    while self.pending:
+      prediction_key, _ = self.pending.popitem(last=False)
+      revalue(prediction_key)
+
+
+def _default_executor():
+  if os.environ.get('SERVER_SOFTWARE'):
+    return TaskQueueExecutor()
+  return LocalExecutor()
+
+
+executor = _default_executor()
+
+
+def schedule_revalue(prediction_key):
+  """Reprice a market's holdings soon, after its price has moved."""
+  executor.schedule(prediction_key)
+
+
+class RevalueHandler(webapp2.RequestHandler):
+
+  def post(self):
+    prediction_key = ndb.Key(urlsafe=self.request.get('prediction_id'))
+    repriced = revalue(prediction_key)
+    logging.info('Repriced %d holdings of %s', repriced,
+                 prediction_key.urlsafe())
+    self.response.status = 204
+
+
+app = webapp2.WSGIApplication([('/.*', RevalueHandler),], debug=True)
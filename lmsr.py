@@ -0,0 +1,134 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Google, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""LMSR: pricing, quoting and sizing for the logarithmic market maker.
+
+Every function takes the market state (contract_one, contract_two, liquidity)
+either as plain floats for a single market or as NumPy arrays for many markets
+at once. All exponentials are taken through log-sum-exp so that large
+quantity/liquidity ratios do not overflow.
+"""
+
+from __future__ import division
+
+import math
+import numbers
+
+import numpy as np
+
+CONTRACT_ONE = 'CONTRACT_ONE'
+CONTRACT_TWO = 'CONTRACT_TWO'
+BUY = 'BUY'
+SELL = 'SELL'
+
+
+class _ScalarMath(object):
+  """The subset of the NumPy API used below, implemented with `math`."""
+  exp = staticmethod(math.exp)
+  log = staticmethod(math.log)
+  log1p = staticmethod(math.log1p)
+  abs = staticmethod(math.fabs)
+  maximum = staticmethod(max)
+
+  @staticmethod
+  def where(condition, x, y):
+    return x if condition else y
+
+
+def _backend(*values):
+  """Returns the math backend and the values converted for that backend."""
+  if all(isinstance(v, (numbers.Number, basestring)) for v in values):
+    return _ScalarMath, values
+  return np, tuple(np.asarray(v) for v in values)
+
+
+def _logsumexp(xp, x, y):
+  m = xp.maximum(x, y)
+  return m + xp.log1p(xp.exp(-xp.abs(x - y)))
+
+
+def trade_deltas(contract, direction, quantity):
+  """Returns the change to (contract_one, contract_two) made by a trade."""
+  xp, (contract, direction, quantity) = _backend(contract, direction, quantity)
+  delta = xp.where(direction == BUY, 1.0, -1.0) * quantity
+  is_one = contract == CONTRACT_ONE
+  return xp.where(is_one, delta, 0.0), xp.where(is_one, 0.0, delta)
+
+
+def cost(contract_one, contract_two, liquidity):
+  """Returns the value of the LMSR cost function for a market state."""
+  xp, (q1, q2, b) = _backend(contract_one, contract_two, liquidity)
+  return b * _logsumexp(xp, q1 / b, q2 / b)
+
+
+def price(contract_one, contract_two, liquidity):
+  """Returns the instantaneous price (probability) of contract one."""
+  xp, (q1, q2, b) = _backend(contract_one, contract_two, liquidity)
+  d = (q2 - q1) / b
+  e = xp.exp(-xp.abs(d))
+  return xp.where(d >= 0, e / (1 + e), 1 / (1 + e))
+
+
+def trade_cost(contract_one, contract_two, liquidity, contract, direction,
+               quantity):
+  """Returns what a trade costs; negative when the trade pays out."""
+  d1, d2 = trade_deltas(contract, direction, quantity)
+  return (cost(contract_one + d1, contract_two + d2, liquidity) -
+          cost(contract_one, contract_two, liquidity))
+
+
+def quote(contract_one, contract_two, liquidity, contract, direction,
+          quantity):
+  """Returns (cost, price of contract one after the trade) for a trade."""
+  d1, d2 = trade_deltas(contract, direction, quantity)
+  new_one = contract_one + d1
+  new_two = contract_two + d2
+  return (cost(new_one, new_two, liquidity) -
+          cost(contract_one, contract_two, liquidity),
+          price(new_one, new_two, liquidity))
+
+
+def quantity_for_cost(contract_one, contract_two, liquidity, contract, amount):
+  """Returns how many shares of `contract` can be bought for `amount`."""
+  xp, (q1, q2, b, contract, amount) = _backend(
+      contract_one, contract_two, liquidity, contract, amount)
+  is_one = contract == CONTRACT_ONE
+  primary = xp.where(is_one, q1, q2)
+  secondary = xp.where(is_one, q2, q1)
+  # Shift by the market state, which is what grows without bound.
+  m = xp.maximum(primary, secondary) / b
+  return b * (m + xp.log(
+      xp.exp((primary / b) + (amount / b) - m) +
+      xp.exp((secondary / b) + (amount / b) - m) -
+      xp.exp((secondary / b) - m))) - primary
+
+
+def quantity_for_price(contract_one, contract_two, liquidity, target):
+  """Returns the change to contract one that moves its price to `target`.
+
+  A negative result means the market gets there by selling contract one (or,
+  equivalently, buying the same amount of contract two).
+  """
+  xp, (q1, q2, b, target) = _backend(
+      contract_one, contract_two, liquidity, target)
+  return q2 + b * (xp.log(target) - xp.log1p(-target)) - q1
+
+
+def kelly_bet(price, probability, bankroll):
+  """Returns the Kelly criterion stake given a price and a belief."""
+  _, (price, probability, bankroll) = _backend(price, probability, bankroll)
+  odds = (1 - price) / price
+  return bankroll * ((odds * probability - (1 - probability)) / odds)
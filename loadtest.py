@@ -0,0 +1,248 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Google, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Offline load test: drives main.app with a mixed workload in one process.
+
+The app is served through werkzeug's test Client against the in-memory
+datastore, memcache, users and task queue of appengine_stubs.py, so it runs
+on a plain Python 2.7 install with jinja2, markupsafe and numpy (the
+libraries app.yaml asks for): no SDK, dev_appserver, network or Cloud
+project is needed. It seeds markets and users, then issues a weighted mix of
+board views, market views, trades, likelihood trades and profile views, and
+reports requests per second, latency percentiles and RPCs per request (from
+the Server-Timing header) for each.
+
+Stub latency is not production latency, and an RPC is one stand-in
+operation; compare RPC counts and relative timings between runs rather than
+absolute numbers. Work queued for the background (activity folding,
+leaderboard revaluations, and trades in sequencing mode) is not run, so its
+write load is not in the numbers; the report says how much was left.
+
+Example invocation:
+
+    $ python loadtest.py --markets 20 --users 50 -n 2000
+"""
+
+import argparse
+import collections
+import datetime
+import math
+import os
+import random
+import re
+import sys
+import time
+
+# Relative weight of each kind of request in the default mix.
+DEFAULT_MIX = collections.OrderedDict([
+    ('board', 30),
+    ('market', 30),
+    ('trade', 15),
+    ('likelihood', 10),
+    ('profile', 15),
+])
+PERCENTILES = (50, 90, 99)
+
+_RPCS = re.compile(r'desc="(\d+) rpcs"')
+
+
+def percentile(sorted_values, pct):
+  """Returns the nearest-rank percentile of an already sorted list."""
+  if not sorted_values:
+    return 0.0
+  rank = int(math.ceil(pct / 100.0 * len(sorted_values)))
+  return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+class LoadTest(object):
+  """Seeds the datastore and drives the app against it.
+
+  Uses whichever App Engine APIs are importable: the stand-ins once
+  appengine_stubs.install() has run, or the SDK's with a testbed active.
+  Activity is queued for folding, as on App Engine, rather than folded inside
+  each trade request.
+  """
+
+  def __init__(self, seed=0):
+    from google.appengine.ext import ndb
+    os.environ.setdefault('SECRET_KEY', 'LOADTEST_SECRET')
+    import activity
+    import main
+    activity.backend = activity.LocalActivityQueue(inline=False)
+    self.ndb = ndb
+    self.client = main.app.test_client()
+    self.random = random.Random(seed)
+    self.markets = []
+    self.users = []
+
+  def login(self, user_id):
+    os.environ.update(USER_EMAIL='%s@example.com' % user_id, USER_ID=user_id,
+                      USER_IS_ADMIN='0')
+
+  def seed(self, markets, users):
+    """Creates the markets and, through /users/create, the users."""
+    from models import Prediction
+    end_time = datetime.datetime.now() + datetime.timedelta(days=30)
+    self.markets = [
+        Prediction(statement='Load test market %d' % i, contract_one=0.0,
+                   contract_two=0.0, liquidity=100, end_time=end_time,
+                   org='org%d' % (i % 3)).put().urlsafe()
+        for i in range(markets)]
+    self.users = ['loaduser%d' % i for i in range(users)]
+    for user_id in self.users:
+      self.login(user_id)
+      self.client.get('/users/create').close()
+
+  def board(self):
+    return self.client.get('/predictions')
+
+  def market(self):
+    return self.client.get('/predictions/' + self.random.choice(self.markets))
+
+  def trade(self):
+    return self.client.post('/trades/create', data=dict(
+        prediction_id=self.random.choice(self.markets),
+        is_likelihood='false',
+        direction='BUY',
+        contract=self.random.choice(('CONTRACT_ONE', 'CONTRACT_TWO')),
+        quantity=str(self.random.randint(1, 5))))
+
+  def likelihood(self):
+    return self.client.post('/trades/create', data=dict(
+        prediction_id=self.random.choice(self.markets),
+        is_likelihood='true',
+        likelihood=str(self.random.randint(5, 95))))
+
+  def profile(self):
+    return self.client.get('/users/me')
+
+  def run(self, requests, mix=DEFAULT_MIX):
+    """Issues requests drawn from the mix; returns {kind: [(ms, rpcs, ok)]}."""
+    kinds = list(mix)
+    bounds = []
+    total = 0
+    for kind in kinds:
+      total += mix[kind]
+      bounds.append(total)
+    samples = collections.defaultdict(list)
+    for _ in range(requests):
+      pick = self.random.uniform(0, total)
+      kind = kinds[min(i for i, b in enumerate(bounds) if pick <= b)]
+      self.login(self.random.choice(self.users))
+      # Each request starts with an empty in-context cache, as it would on
+      # its own App Engine request.
+      self.ndb.get_context().clear_cache()
+      started = time.time()
+      response = getattr(self, kind)()
+      response.get_data()
+      response.close()
+      elapsed_ms = (time.time() - started) * 1000
+      match = _RPCS.search(response.headers.get('Server-Timing', ''))
+      samples[kind].append((elapsed_ms, int(match.group(1)) if match else 0,
+                            response.status_code < 400))
+    return samples
+
+  def background(self):
+    """Returns how much queued background work is left, by kind of work.
+
+    Nothing runs it here, so its RPCs and latency are not in the samples.
+    """
+    import activity
+    import leaderboard
+    from models import TradeTicket
+    return collections.OrderedDict([
+        ('activity folds', len(getattr(activity.backend, 'pending', ()))),
+        ('leaderboard revaluations',
+         len(getattr(leaderboard.executor, 'pending', ()))),
+        ('sequencer tickets',
+         TradeTicket.query(TradeTicket.status == 'PENDING').count()),
+    ])
+
+
+def report(samples, elapsed, background=None, out=sys.stdout):
+  """Writes a table of throughput, latency percentiles and RPCs per kind.
+
+  background is what LoadTest.background() returned; the work it counts is
+  listed as left out of the numbers.
+  """
+  header = ['kind', 'requests', 'errors', 'req/s'] + [
+      'p%d ms' % p for p in PERCENTILES] + ['rpcs/req']
+  rows = []
+  everything = []
+  for kind in list(DEFAULT_MIX) + sorted(set(samples) - set(DEFAULT_MIX)):
+    if kind not in samples:
+      continue
+    everything.extend(samples[kind])
+    rows.append(_row(kind, samples[kind], elapsed))
+  rows.append(_row('all', everything, elapsed))
+  widths = [max(len(str(r[i])) for r in [header] + rows)
+            for i in range(len(header))]
+  for row in [header] + rows:
+    out.write('  '.join(str(v).rjust(w) for v, w in zip(row, widths)) + '\n')
+  out.write('\nBackground work queued and not run or timed:\n')
+  for kind, count in (background or {}).items():
+    out.write('  %s: %d\n' % (kind, count))
+
+
+def _row(kind, samples, elapsed):
+  latencies = sorted(ms for ms, _, _ in samples)
+  rpcs = sum(n for _, n, _ in samples)
+  return ([kind, len(samples), sum(1 for _, _, ok in samples if not ok),
+           '%.1f' % (len(samples) / elapsed)] +
+          ['%.1f' % percentile(latencies, p) for p in PERCENTILES] +
+          ['%.1f' % (rpcs / float(len(samples) or 1))])
+
+
+def _parse_mix(value):
+  mix = collections.OrderedDict()
+  for part in value.split(','):
+    kind, _, weight = part.partition('=')
+    if kind not in DEFAULT_MIX:
+      raise argparse.ArgumentTypeError('unknown request kind %r' % kind)
+    mix[kind] = float(weight or 1)
+  return mix
+
+
+def main(markets, users, requests, mix, seed):
+  import appengine_stubs
+  appengine_stubs.install()
+  import appengine_config
+  (appengine_config)
+
+  load = LoadTest(seed)
+  load.seed(markets, users)
+  started = time.time()
+  samples = load.run(requests, mix)
+  report(samples, time.time() - started, load.background())
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--markets', type=int, default=20,
+                      help='Number of markets to seed.')
+  parser.add_argument('--users', type=int, default=50,
+                      help='Number of users to seed.')
+  parser.add_argument('-n', '--requests', type=int, default=1000,
+                      help='Number of requests to issue after seeding.')
+  parser.add_argument('--mix', type=_parse_mix, default=DEFAULT_MIX,
+                      help='Weights such as board=3,trade=1; kinds are %s.' %
+                      ', '.join(DEFAULT_MIX))
+  parser.add_argument('--seed', type=int, default=0,
+                      help='Seed for the random workload.')
+  args = parser.parse_args()
+  main(args.markets, args.users, args.requests, args.mix, args.seed)
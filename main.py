@@ -17,31 +17,80 @@
 
 from flask import Flask
 from google.appengine.ext import ndb
+from google.appengine.api import datastore_errors
 from google.appengine.api import users
 
+import collections
+import csv
 import datetime
+import json
 import math
 import logging
 import os
+import re
+import StringIO
+
+import activity
+import instrument
+import leaderboard
+import lmsr
+import market_cache
+import numpy as np
+import profiling
+import rollups
+import sequencer
 from flask import render_template
 from flask import redirect
 from flask import request
 from flask import jsonify
 from flask import flash
+from flask import Markup
+from flask import Response
 
 from models import Prediction
 from models import Trade
 from models import LedgerRecords
 from models import Profile
-from models import Price
+from models import ApplyTrade
+from models import TRADE_HISTORY_PAGE
+from models import get_entity
+from models import get_prediction_page
 from models import get_price_for_trade
+from models import get_prices_for_predictions
+from models import get_trade_history_page
+from models import ledger_key
+from models import quote_trades
+from models import remember_entity
+from models import run_in_transaction
+from models import to_timestamp
+from models import value_positions
 from models import verification_of_trade
 from models import check_if_user_profile
 from models import calculate_trade_from_likelihood
+from models import calculate_trades_from_likelihoods
 
 app = Flask(__name__)
 app.config['DEBUG'] = True
 app.secret_key = os.environ['SECRET_KEY']
+profiling.install(app)
+instrument.install(app)
+# Queue trades for the per-market sequencer instead of writing them inline.
+app.config['SEQUENCE_TRADES'] = os.environ.get('SEQUENCE_TRADES') == 'true'
+
+# Number of predictions shown per page of the predictions board.
+BOARD_PAGE_SIZE = 50
+MAX_BOARD_PAGE_SIZE = 200
+# Limits on a /trades/batch request. Each market is its own entity group and
+# a cross-group transaction may touch at most 25, one of them the profile.
+MAX_BATCH_TRADES = 100
+MAX_BATCH_MARKETS = 24
+# Most trades returned by one page of the trade history export.
+MAX_TRADE_HISTORY_PAGE = 5000
+# Columns of the trade history export, in CSV order.
+TRADE_HISTORY_FIELDS = ('time', 'direction', 'contract', 'quantity', 'cost',
+                        'price_before', 'price_after')
+# Most trades priced by one quote request.
+MAX_QUOTES = 100
 
 
 @app.route('/')
@@ -58,53 +107,156 @@ def CheckSignIn():
 
 @app.route('/predictions', methods=['GET'])
 def GetPredictions():
-  """Returns all of the predictions (and can filter by org)."""
-  org_filter = request.args.get('org', False)
-  if org_filter:
-    predictions = Prediction.query(Prediction.org == org_filter).fetch()
-  else:
-    predictions = Prediction.query().fetch()
-  for prediction in predictions:
+  """Returns a page of the predictions (and can filter by org and sort)."""
+  org_filter = request.args.get('org', None)
+  resolved_filter = request.args.get('resolved', None)
+  if resolved_filter is not None:
+    resolved_filter = resolved_filter == 'true'
+  try:
+    limit = max(1, min(int(request.args.get('limit', BOARD_PAGE_SIZE)),
+                       MAX_BOARD_PAGE_SIZE))
+    predictions, next_cursor, more = get_prediction_page(
+        org_filter, resolved_filter, limit, request.args.get('cursor'),
+        request.args.get('sort'))
+  except (ValueError, datastore_errors.BadValueError):
+    return render_template('404.html'), 404
+  prices = get_prices_for_predictions(predictions)
+  for prediction, price in zip(predictions, prices):
     # TODO(goldhaber): add these to the datastore
     prediction.url = 'predictions/' + prediction.key.urlsafe()
-    prediction.price = GetPriceByPredictionId(prediction.key.urlsafe()) * 100
-  return render_template('predictions.html', predictions=predictions)
+    prediction.price = price * 100
+  return render_template(
+      'predictions.html',
+      predictions=predictions,
+      org=org_filter,
+      resolved=request.args.get('resolved', None),
+      sort=request.args.get('sort', None),
+      limit=limit,
+      next_cursor=next_cursor.urlsafe() if more and next_cursor else None)
 
 
 @app.route('/predictions/<string:prediction_id>/price', methods=['GET'])
 def GetPriceByPredictionId(prediction_id):
   """Returns the current market price of contract one for a prediction_id."""
   prediction_key = ndb.Key(urlsafe=prediction_id)
-  pred = prediction_key.get()
-  price = math.pow(math.e, (pred.contract_one / pred.liquidity)) / (
-      math.pow(math.e, (pred.contract_two / pred.liquidity)) + math.pow(
-          math.e, (pred.contract_two / pred.liquidity)))
-  return float(price)
+  return market_cache.get_market(prediction_key).price()
+
+
+@app.route('/predictions/<string:prediction_id>/quote', methods=['GET'])
+def GetQuote(prediction_id):
+  """Quotes trades against a prediction without making them.
+
+  Takes repeated contract, direction and quantity arguments (a single value
+  applies to every trade) and returns the cost and resulting price of each.
+  An optional target probability also returns the contract one quantity that
+  would move the market there. Nothing is written.
+  """
+  try:
+    market = market_cache.get_market(ndb.Key(urlsafe=prediction_id))
+  except Exception:
+    market = None
+  if market is None:
+    return jsonify(error='not found'), 404
+  contracts = request.args.getlist('contract') or ['CONTRACT_ONE']
+  directions = request.args.getlist('direction') or ['BUY']
+  try:
+    quantities = [float(q) for q in request.args.getlist('quantity')]
+    target = request.args.get('target', None, type=float)
+    if 'target' in request.args and target is None:
+      raise ValueError('target must be a number')
+    if not set(contracts) <= set(['CONTRACT_ONE', 'CONTRACT_TWO']):
+      raise ValueError('contract must be CONTRACT_ONE or CONTRACT_TWO')
+    if not set(directions) <= set(['BUY', 'SELL']):
+      raise ValueError('direction must be BUY or SELL')
+    if not all(0 <= q < float('inf') for q in quantities):
+      raise ValueError('quantity must be a non-negative number')
+    if target is not None and not 0 < target < 1:
+      raise ValueError('target must be between 0 and 1')
+    if max(len(contracts), len(directions), len(quantities)) > MAX_QUOTES:
+      raise ValueError('At most %d quotes per request' % MAX_QUOTES)
+    quotes = []
+    if quantities:
+      # Broadcast once, here: each quote lists its own arguments, and
+      # mismatched lengths raise ValueError.
+      contracts, directions, quantities = np.broadcast_arrays(
+          np.asarray(contracts), np.asarray(directions),
+          np.asarray(quantities))
+      costs, prices = quote_trades(market, contracts, directions, quantities)
+      quotes = [dict(contract=c, direction=d, quantity=q, cost=cost,
+                     price=p) for c, d, q, cost, p in
+                zip(contracts.tolist(), directions.tolist(),
+                    quantities.tolist(), costs, prices)]
+  except ValueError as e:
+    return jsonify(error=str(e)), 400
+  result = dict(price=market.price(), quotes=quotes)
+  if target is not None:
+    delta = float(lmsr.quantity_for_price(
+        market.contract_one, market.contract_two, market.liquidity, target))
+    # Selling contract one moves the price like buying contract two.
+    contract = 'CONTRACT_ONE' if delta >= 0 else 'CONTRACT_TWO'
+    cost, _ = quote_trades(market, [contract], ['BUY'], [abs(delta)])
+    result['target'] = dict(probability=target, contract_one=delta,
+                            contract=contract, direction='BUY',
+                            quantity=abs(delta), cost=cost[0])
+  return jsonify(**result)
 
 @app.route('/predictions/<string:prediction_id>/pricelist', methods=['GET'])
 def GetPrices(prediction_id):
-    prices = Price.query(Price.prediction_id == ndb.Key(urlsafe=prediction_id)).order(-Price.date).fetch(30)
-    print(str(prices))
-    prices = [{'price': p.value, 'date': {'year': p.date.year, 'month': p.date.month, 'day': p.date.day}} for p in prices]
-    return prices
+  """Returns OHLC price bars for a prediction.
+
+  Takes optional from and to (seconds since the epoch; the last 30 days by
+  default) and a resolution (5m, 1h, 1d or 1w; by default the finest that
+  fits in a few hundred bars).
+  """
+  try:
+    prediction_key = ndb.Key(urlsafe=prediction_id)
+    end = float(request.args.get(
+        'to', to_timestamp(datetime.datetime.now())))
+    start = float(request.args.get('from', end - 30 * 24 * 60 * 60))
+    resolution = request.args.get(
+        'resolution', rollups.pick_resolution(start, end))
+    bars = rollups.get_bars(prediction_key, resolution, start, end)
+  except Exception as e:
+    return jsonify(error=str(e)), 400
+  return jsonify(resolution=resolution, bars=bars)
+
+
+def GetBarsAsync(prediction_key):
+  """Fetches the last 30 days of price bars of a prediction for charting."""
+  end = to_timestamp(datetime.datetime.now())
+  start = end - 30 * 24 * 60 * 60
+  return rollups.get_bars_async(prediction_key,
+                                rollups.pick_resolution(start, end), start, end)
+
 
 @app.route('/predictions/<string:prediction_id>', methods=['GET'])
 def GetPredictionById(prediction_id):
   """Returns a prediction by prediction_id."""
   try:
     prediction_key = ndb.Key(urlsafe=prediction_id)
-    prediction = prediction_key.get()
-    portfolio = GetUserPortfolioByAuth(prediction_id)
+    user_key = ndb.Key('Profile', users.get_current_user().user_id())
+    # The reads are independent, so issue them concurrently.
+    futures = [prediction_key.get_async(), user_key.get_async(),
+               ledger_key(user_key, prediction_key).get_async(),
+               GetBarsAsync(prediction_key)]
+    prediction, profile, position, bars = [
+        f.get_result() for f in futures]
+    remember_entity(prediction)
+    remember_entity(profile)
+    portfolio = [position] if position else []
   except:
     return render_template('404.html')
+  if prediction is None:
+    return render_template('404.html')
   return render_template(
       'prediction.html',
       prediction=prediction,
-      price=GetPriceByPredictionId(prediction_id),
-      pricelist=GetPrices(prediction_id),
+      price=prediction.GetPriceByPredictionId(),
+      bars=bars,
       prediction_id=prediction_id,
       portfolio=portfolio)
 
+
 @app.route('/predictions/create', methods=['GET'])
 def CreatePrediction():
   return render_template('prediction_create.html')
@@ -136,25 +288,48 @@ def GetUserByAuth():
   """Returns current users profile."""
   user_key = users.get_current_user().user_id()
   user_key = ndb.Key('Profile', user_key)
-  profile = user_key.get()
-  for ledger in profile.user_ledger:
-    try:
-      price = GetPriceByPredictionId(ledger.prediction_id)
-      ledger.value = math.fabs((price * ledger.contract_one) - (
-          price * ledger.contract_two))
-      ledger.prediction_statement = ndb.Key(
-          urlsafe=ledger.prediction_id).get().statement
-    except:
+  profile = get_entity(user_key)
+  positions = LedgerRecords.query(ancestor=user_key).fetch()
+  valuations, total = value_positions(positions)
+  for ledger, valuation in zip(positions, valuations):
+    if valuation is None:
       ledger.value = 404
       ledger.prediction_statement = 'ERROR'
-  return render_template('profile.html', profile=profile)
+      continue
+    ledger.value = valuation.value
+    ledger.unrealized_pnl = valuation.unrealized_pnl
+    ledger.prediction_statement = valuation.market.statement
+  return render_template('profile.html', profile=profile, positions=positions,
+                         total=total)
+
+
+@app.route('/users/me/valuation', methods=['GET'])
+def GetUserValuationByAuth():
+  """Returns the market value of each of the users positions as JSON."""
+  user_key = ndb.Key('Profile', users.get_current_user().user_id())
+  profile = get_entity(user_key)
+  positions = LedgerRecords.query(ancestor=user_key).fetch()
+  valuations, total = value_positions(positions)
+  return jsonify(
+      balance=profile.balance if profile else 0,
+      total=total,
+      positions=[dict(prediction_id=ledger.prediction_id,
+                      statement=valuation.market.statement,
+                      contract_one=ledger.contract_one,
+                      contract_two=ledger.contract_two,
+                      price=valuation.price,
+                      value=valuation.value,
+                      realized_pnl=ledger.realized_pnl,
+                      unrealized_pnl=valuation.unrealized_pnl)
+                 for ledger, valuation in zip(positions, valuations)
+                 if valuation is not None])
 
 
 @app.route('/users/me/balance', methods=['GET'])
 def GetUserBalanceByAuth():
   """Returns current users balance."""
   user_key = ndb.Key('Profile', users.get_current_user().user_id())
-  profile = user_key.get()
+  profile = get_entity(user_key)
   return str(profile.balance)
 
 # TODO(goldhaber): change to GetUserPortfolioByAuth By Prediction ID
@@ -162,12 +337,11 @@ def GetUserBalanceByAuth():
 def GetUserPortfolioByAuth(prediction_id):
   """Returns current users porfolio by prediction_id."""
   user_key = ndb.Key('Profile', users.get_current_user().user_id())
-  profile = user_key.get()
   portfolio = []
   if prediction_id:
-    portfolio = [
-        i for i in profile.user_ledger if i.prediction_id == prediction_id
-    ]
+    position = ledger_key(user_key, ndb.Key(urlsafe=prediction_id)).get()
+    if position is not None:
+      portfolio = [position]
   return portfolio
 
 @app.route('/trades/create', methods=['POST'])
@@ -175,16 +349,15 @@ def CreateTrade():
   """Creates a trade for the user."""
   user_id = users.get_current_user().user_id()
   user_key = ndb.Key('Profile', user_id)
-  current_user = user_key.get()
+  current_user = get_entity(user_key)
   prediction_key = ndb.Key(urlsafe=request.form['prediction_id'])
-  prediction = prediction_key.get()
+  prediction = get_entity(prediction_key)
   if request.form['is_likelihood'] == 'true':
     user_id = users.get_current_user().user_id()
     user_key = ndb.Key('Profile', user_id)
-    current_user = user_key.get()
+    current_user = get_entity(user_key)
     trade = calculate_trade_from_likelihood(
         float(request.form['likelihood']), prediction, current_user)
-    print trade
   else:
     trade = Trade(
         prediction_id=prediction_key,
@@ -192,6 +365,13 @@ def CreateTrade():
         direction=request.form['direction'],
         contract=request.form['contract'],
         quantity=float(request.form['quantity']))
+  if app.config['SEQUENCE_TRADES']:
+    ticket_key = sequencer.enqueue(trade)
+    if request.accept_mimetypes.best == 'application/json':
+      return jsonify(ticket_id=ticket_key.urlsafe(), status='PENDING'), 202
+    flash(Markup('Your prediction is queued: <a href="%s">check on it</a>.')
+          % ('/trades/tickets/' + ticket_key.urlsafe()))
+    return redirect('/predictions/' + trade.prediction_id.urlsafe())
   err = CreateTradeAction(prediction, current_user, trade)
   #TODO replace with error
   if err != 'error':
@@ -199,76 +379,235 @@ def CreateTrade():
   return redirect('/predictions/' + trade.prediction_id.urlsafe())
 
 def CreateTradeAction(prediction, current_user, trade):
+  """Makes a trade in one transaction against fresh market and user state.
+
+  Returns 'error' if the trade is not allowed or keeps colliding with other
+  trades on the same market.
+  """
   verification_of_trade(trade)
-  price = get_price_for_trade(prediction, trade)
-  # TODO(goldhaber):replace flag
-  new_ledger_record = False
-  if trade.direction == 'BUY':
-    if current_user.balance >= price:
-      current_user.balance -= price
-      # TODO(goldhaber): check results and/or better formatting
-      current_user_portfolio = [
-          i for i in current_user.user_ledger
-          if i.prediction_id == trade.prediction_id.urlsafe()
-      ]
-      if len(current_user_portfolio) == 0:
-        ledger_records = LedgerRecords()
-        ledger_records.prediction_id = trade.prediction_id.urlsafe()
-        ledger_records.user_id = current_user.user_id
-        if trade.contract == 'CONTRACT_ONE':
-          ledger_records.contract_one = trade.quantity
-          ledger_records.contract_two = 0.00
-        else:
-          ledger_records.contract_two = trade.quantity
-          ledger_records.contract_one = 0.00
-        current_user.user_ledger.append(ledger_records)
-        new_ledger_record = True
-      else:
-        ledger_record_to_update = current_user_portfolio[0]
-        if trade.contract == 'CONTRACT_ONE':
-          ledger_record_to_update.contract_one += trade.quantity
-        else:
-          ledger_record_to_update.contract_two += trade.quantity
-      if trade.contract == 'CONTRACT_ONE':
-        prediction.contract_one += trade.quantity
-      else:
-        prediction.contract_two += trade.quantity
-    else:
-      # TODO(goldhaber): throw error
+
+  def txn():
+    fresh_prediction, fresh_user, position = ndb.get_multi(
+        [prediction.key, current_user.key,
+         ledger_key(current_user.key, prediction.key)])
+    entities = ApplyTrade(fresh_prediction, fresh_user, trade, position)
+    if entities == 'error':
       return 'error'
-  else:
-    current_user_portfolio = [
-        i for i in current_user.user_ledger
-        if i.prediction_id == trade.prediction_id.urlsafe()
-    ]
-    if (trade.contract == 'CONTRACT_ONE' and
-        current_user_portfolio[0].contract_one >= trade.quantity) or (
-            trade.contract == 'CONTRACT_TWO' and
-            current_user_portfolio[0].contract_two >= trade.quantity):
-      ledger_record_to_update = current_user_portfolio[0]
-      if trade.contract == 'CONTRACT_ONE':
-        ledger_record_to_update.contract_one -= trade.quantity
-        prediction.contract_one -= trade.quantity
-      else:
-        ledger_record_to_update.contract_two -= trade.quantity
-        prediction.contract_two -= trade.quantity
-      current_user.balance -= price
+    ndb.put_multi(entities)
+    return entities, position is None
+
+  try:
+    result = run_in_transaction(txn)
+  except datastore_errors.TransactionFailedError:
+    logging.warning('Trade on %s abandoned after repeated collisions',
+                    prediction.key.urlsafe())
+    return 'error'
+  if result == 'error':
+    return 'error'
+  (trade, fresh_user, fresh_prediction, position), first_trade = result
+  market_cache.update(fresh_prediction)
+  activity.record(prediction.key, [trade], int(first_trade))
+  leaderboard.record_positions([(fresh_user, fresh_prediction, position)])
+  leaderboard.schedule_revalue(prediction.key)
+
+
+@app.route('/trades/batch', methods=['POST'])
+def CreateTrades():
+  """Makes a JSON batch of trades, possibly across markets, for the user.
+
+  Takes {"trades": [{"prediction_id", "direction", "contract", "quantity"}]}
+  and returns one result per trade, in request order: FILLED with its cost
+  and the market price after it, or REJECTED with an error. In sequencing
+  mode the valid trades are queued instead, each on its own, and returned
+  PENDING with their ticket ids and status 202.
+  """
+  user_key = ndb.Key('Profile', users.get_current_user().user_id())
+  orders = (request.get_json(silent=True) or {}).get('trades')
+  if not isinstance(orders, list) or not orders:
+    return jsonify(error='trades must be a non-empty list'), 400
+  if len(orders) > MAX_BATCH_TRADES:
+    return jsonify(error='At most %d trades per batch' % MAX_BATCH_TRADES), 400
+  results = [None] * len(orders)
+  valid = []
+  for i, order in enumerate(orders):
+    try:
+      trade = Trade(
+          parent=user_key,
+          prediction_id=ndb.Key(urlsafe=order['prediction_id']),
+          user_id=user_key,
+          direction=order['direction'],
+          contract=order['contract'],
+          quantity=float(order['quantity']))
+      if (trade.prediction_id.kind() != 'Prediction' or
+          trade.direction not in ('BUY', 'SELL') or
+          trade.contract not in ('CONTRACT_ONE', 'CONTRACT_TWO') or
+          not 0 < trade.quantity < float('inf')):
+        raise ValueError()
+    except Exception:
+      results[i] = dict(status='REJECTED', error='invalid trade')
+      continue
+    valid.append((i, trade))
+  markets = set(trade.prediction_id for _, trade in valid)
+  if len(markets) > MAX_BATCH_MARKETS:
+    return jsonify(
+        error='At most %d markets per batch' % MAX_BATCH_MARKETS), 400
+  if app.config['SEQUENCE_TRADES']:
+    queued = QueueTradesAction([trade for _, trade in valid])
+    for (i, trade), result in zip(valid, queued):
+      results[i] = result
+      results[i]['prediction_id'] = trade.prediction_id.urlsafe()
+    return jsonify(trades=results), 202
+  try:
+    fills = CreateTradesAction(user_key, [trade for _, trade in valid])
+  except datastore_errors.TransactionFailedError:
+    return jsonify(error='markets are busy, try again'), 503
+  for (i, trade), fill in zip(valid, fills):
+    if fill == 'error':
+      results[i] = dict(status='REJECTED', error='trade not allowed')
     else:
-      return 'error'
-  trade.put()
-  if new_ledger_record:
-    ledger_records.put()
-  current_user.put()
-  prediction.put()
+      results[i] = dict(status='FILLED', cost=fill[0], price=fill[1])
+    results[i]['prediction_id'] = trade.prediction_id.urlsafe()
+  return jsonify(trades=results)
+
+
+@app.route('/trades/rebalance', methods=['POST'])
+def RebalancePortfolio():
+  """Kelly-sizes trades for many markets from the user's beliefs.
+
+  Takes {"likelihoods": {prediction_id: percent}, "execute": bool}. Returns
+  the trades, and when execute is set makes them as one batch and returns
+  the result of each as well (queued and PENDING, with status 202, in
+  sequencing mode).
+  """
+  user_key = ndb.Key('Profile', users.get_current_user().user_id())
+  body = request.get_json(silent=True) or {}
+  try:
+    likelihoods = dict(
+        (ndb.Key(urlsafe=prediction_id), float(likelihood))
+        for prediction_id, likelihood in body['likelihoods'].items())
+    if not all(key.kind() == 'Prediction' and 0 <= likelihood <= 100
+               for key, likelihood in likelihoods.items()):
+      raise ValueError()
+  except Exception:
+    return jsonify(
+        error='likelihoods must map prediction ids to percentages'), 400
+  if len(likelihoods) > MAX_BATCH_MARKETS:
+    return jsonify(
+        error='At most %d markets per batch' % MAX_BATCH_MARKETS), 400
+  profile = get_entity(user_key)
+  if profile is None:
+    return jsonify(error='not found'), 404
+  trades = calculate_trades_from_likelihoods(likelihoods, profile)
+  results = [dict(prediction_id=trade.prediction_id.urlsafe(),
+                  direction=trade.direction, contract=trade.contract,
+                  quantity=trade.quantity) for trade in trades]
+  if body.get('execute') and app.config['SEQUENCE_TRADES']:
+    for result, queued in zip(results, QueueTradesAction(trades)):
+      result.update(queued)
+    return jsonify(trades=results), 202
+  if body.get('execute'):
+    try:
+      fills = CreateTradesAction(user_key, trades)
+    except datastore_errors.TransactionFailedError:
+      return jsonify(error='markets are busy, try again'), 503
+    for result, fill in zip(results, fills):
+      if fill == 'error':
+        result.update(status='REJECTED', error='trade not allowed')
+      else:
+        result.update(status='FILLED', cost=fill[0], price=fill[1])
+  return jsonify(trades=results)
+
+
+def QueueTradesAction(trades):
+  """Queues trades for the sequencer; returns a PENDING result for each."""
+  return [dict(status='PENDING', ticket_id=sequencer.enqueue(trade).urlsafe())
+          for trade in trades]
+
+
+def CreateTradesAction(user_key, trades):
+  """Makes a user's trades in one transaction, grouped by market.
+
+  The profile and each market are read and written once whatever the number
+  of trades. Trades on a market are applied in order, and a trade that is not
+  allowed is rejected without affecting the others. Returns (cost, price
+  after the trade) for each trade, or 'error' for rejected ones.
+  """
+  if not trades:
+    return []
+  by_market = collections.OrderedDict()
+  for i, trade in enumerate(trades):
+    verification_of_trade(trade)
+    by_market.setdefault(trade.prediction_id, []).append(i)
+  prediction_keys = by_market.keys()
+
+  def txn():
+    loaded = ndb.get_multi(
+        [user_key] + prediction_keys +
+        [ledger_key(user_key, key) for key in prediction_keys])
+    profile = loaded[0]
+    predictions = loaded[1:len(prediction_keys) + 1]
+    positions = loaded[len(prediction_keys) + 1:]
+    fills = ['error'] * len(trades)
+    first_trades = set()
+    updates = []
+    writes = collections.OrderedDict()
+    for key, prediction, position in zip(
+        prediction_keys, predictions, positions):
+      if prediction is None or profile is None:
+        continue
+      if position is None:
+        first_trades.add(key)
+      for i in by_market[key]:
+        entities = ApplyTrade(prediction, profile, trades[i], position)
+        if entities == 'error':
+          continue
+        position = entities[3]
+        fills[i] = (trades[i].cost, trades[i].price_after)
+        for entity in entities:
+          writes[id(entity)] = entity
+      if any(fills[i] != 'error' for i in by_market[key]):
+        updates.append((profile, prediction, position))
+    ndb.put_multi(writes.values())
+    return fills, first_trades, updates
+
+  fills, first_trades, updates = run_in_transaction(txn)
+  leaderboard.record_positions(updates)
+  for _, prediction, _ in updates:
+    market_cache.update(prediction)
+  for key, indexes in by_market.items():
+    made = [trades[i] for i in indexes if fills[i] != 'error']
+    activity.record(key, made, int(bool(made) and key in first_trades))
+    leaderboard.schedule_revalue(key)
+  return fills
+
+
+@app.route('/trades/tickets/<string:ticket_id>', methods=['GET'])
+def GetTradeTicket(ticket_id):
+  """Returns the status and fill price of a queued trade."""
+  user_key = ndb.Key('Profile', users.get_current_user().user_id())
+  try:
+    ticket_key = ndb.Key(urlsafe=ticket_id)
+  except:
+    return jsonify(error='not found'), 404
+  ticket = None
+  if ticket_key.kind() == 'TradeTicket' and ticket_key.parent() == user_key:
+    ticket = ticket_key.get()
+  if ticket is None:
+    return jsonify(error='not found'), 404
+  return jsonify(
+      ticket_id=ticket_id,
+      prediction_id=ticket.prediction_id.urlsafe(),
+      status=ticket.status,
+      fill_price=ticket.fill_price)
 
 
 @app.route('/trades/sell', methods=['POST'])
 def SellStake():
   user_id = users.get_current_user().user_id()
   user_key = ndb.Key('Profile', user_id)
-  current_user = user_key.get()
+  current_user = get_entity(user_key)
   prediction_key = ndb.Key(urlsafe=request.form['prediction_id'])
-  prediction = prediction_key.get()
+  prediction = get_entity(prediction_key)
   portfolio = GetUserPortfolioByAuth(request.form['prediction_id'])
   for ledger in portfolio:
       if ledger.contract_one > 0:
@@ -288,12 +627,154 @@ def SellStake():
       flash('You sold your stake!')
   return redirect('/users/me')
 
-@app.route('/testtrade/<string:prediction_id>', methods=['GET'])
+@app.route('/predictions/<string:prediction_id>/trades', methods=['GET'])
 def GetTradesForPredictionId(prediction_id):
-    user = users.get_current_user()
-    trades = Trade.query(ndb.AND(Trade.prediction_id == ndb.Key(urlsafe=prediction_id),
-                                 Trade.user_id == ndb.Key('Profile', user.user_id()))).fetch()
-    return str(trades)
+  """Returns a page of the trade history of a prediction as JSON lines or CSV.
+
+  Takes format (ndjson or csv), user=me for only the users own trades,
+  direction, from and to (seconds since the epoch), limit and cursor. When
+  there are more trades the X-Next-Cursor header holds the cursor of the next
+  page, so an export can be fetched, and resumed, a page at a time. Only the
+  first page of a CSV export has the header row.
+  """
+  try:
+    prediction_key = ndb.Key(urlsafe=prediction_id)
+    user_key = None
+    if request.args.get('user') == 'me':
+      user_key = ndb.Key('Profile', users.get_current_user().user_id())
+    elif 'user' in request.args:
+      raise ValueError('user must be me')
+    direction = request.args.get('direction')
+    if direction not in (None, 'BUY', 'SELL'):
+      raise ValueError('direction must be BUY or SELL')
+    start, end = [datetime.datetime.utcfromtimestamp(float(request.args[arg]))
+                  if arg in request.args else None for arg in ('from', 'to')]
+    export = request.args.get('format', 'ndjson')
+    if export not in ('ndjson', 'csv'):
+      raise ValueError('format must be ndjson or csv')
+    limit = max(1, min(int(request.args.get('limit', TRADE_HISTORY_PAGE)),
+                       MAX_TRADE_HISTORY_PAGE))
+    cursor = request.args.get('cursor')
+    trades, next_cursor, more = get_trade_history_page(
+        prediction_key, user_key, direction, start, end, limit, cursor)
+  except Exception as e:
+    return jsonify(error=str(e)), 400
+  rows = [_TradeHistoryRow(trade) for trade in trades]
+  headers = {}
+  if more and next_cursor:
+    headers['X-Next-Cursor'] = next_cursor.urlsafe()
+  if export == 'csv':
+    out = StringIO.StringIO()
+    writer = csv.writer(out)
+    if not cursor:
+      writer.writerow(TRADE_HISTORY_FIELDS)
+    for row in rows:
+      writer.writerow([row[field] for field in TRADE_HISTORY_FIELDS])
+    headers['Content-Disposition'] = 'attachment; filename=trades.csv'
+    return Response(out.getvalue(), mimetype='text/csv', headers=headers)
+  return Response(''.join(json.dumps(row) + '\n' for row in rows),
+                  mimetype='application/x-ndjson', headers=headers)
+
+
+def _TradeHistoryRow(trade):
+  """Returns the TRADE_HISTORY_FIELDS of a trade as a dict."""
+  return dict(
+      time=to_timestamp(trade.creation_time),
+      direction=trade.direction,
+      contract=trade.contract,
+      quantity=trade.quantity,
+      cost=trade.cost,
+      price_before=trade.price_before,
+      price_after=trade.price_after)
+
+
+@app.route('/leaderboard', methods=['GET'])
+def GetLeaderboard():
+  """Returns a page of the leaderboard, overall or for an org."""
+  org_filter = request.args.get('org', '')
+  try:
+    limit = max(1, min(int(request.args.get('limit', BOARD_PAGE_SIZE)),
+                       MAX_BOARD_PAGE_SIZE))
+    standings, next_cursor, more = leaderboard.get_leaderboard(
+        org_filter, limit, request.args.get('cursor'))
+  except (ValueError, datastore_errors.BadValueError):
+    return render_template('404.html'), 404
+  next_cursor = next_cursor.urlsafe() if more and next_cursor else None
+  if request.accept_mimetypes.best == 'application/json':
+    return jsonify(
+        org=org_filter,
+        next_cursor=next_cursor,
+        standings=[dict(name=standing.name, net_worth=standing.net_worth,
+                        cash=standing.cash, holdings=standing.holdings)
+                   for standing in standings])
+  return render_template(
+      'leaderboard.html',
+      standings=standings,
+      org=org_filter,
+      limit=limit,
+      next_cursor=next_cursor)
+
+
+@app.route('/admin/instrumentation', methods=['GET'])
+def GetInstrumentation():
+  """Returns this instance's per-route RPC and latency histograms."""
+  return jsonify(routes=instrument.histograms())
+
+
+@app.route('/admin/profiler', methods=['GET'])
+def GetProfiler():
+  """Returns the profiling settings and this instance's profiled counts."""
+  return jsonify(settings=profiling.get_settings(),
+                 profiled=profiling.profiled_counts())
+
+
+@app.route('/admin/profiler', methods=['POST'])
+def SetProfiler():
+  """Chooses the routes to profile and the sample rate.
+
+  Takes JSON {"routes": ["/trades/create"], "sample_rate": 0.05}; an empty
+  routes list turns profiling off.
+  """
+  body = request.get_json(silent=True) or {}
+  try:
+    if not isinstance(body, dict):
+      raise ValueError('Expected a JSON object')
+    routes = body.get('routes', [])
+    if not isinstance(routes, list):
+      raise ValueError('routes must be a list of URL rules')
+    settings = profiling.set_settings(
+        [str(r) for r in routes], float(body.get('sample_rate', 0)))
+  except (TypeError, ValueError) as e:
+    return jsonify(error=str(e)), 400
+  return jsonify(settings=settings)
+
+
+@app.route('/admin/profiler/reset', methods=['POST'])
+def ResetProfiler():
+  """Forgets this instance's profiles."""
+  profiling.reset()
+  return jsonify(profiled=profiling.profiled_counts())
+
+
+@app.route('/admin/profiler/dump', methods=['GET'])
+def GetProfile():
+  """Downloads the aggregate profile of ?route= as a pstats dump.
+
+  With format=text, returns the top functions by cumulative time instead.
+  """
+  route = request.args.get('route', '')
+  if request.args.get('format') == 'text':
+    text = profiling.report(route)
+    if text is None:
+      return jsonify(error='No profile for %s' % route), 404
+    return Response(text, mimetype='text/plain')
+  data = profiling.dump(route)
+  if data is None:
+    return jsonify(error='No profile for %s' % route), 404
+  filename = re.sub(r'\W+', '_', route).strip('_') or 'root'
+  return Response(data, mimetype='application/octet-stream', headers={
+      'Content-Disposition': 'attachment; filename=%s.prof' % filename})
+
 
 @app.route('/faq', methods=['GET'])
 def GetFaq():
@@ -311,5 +792,5 @@ def inject_balance():
     if not user:
         return dict(balance=0)
     user_key = ndb.Key('Profile', user.user_id())
-    profile = user_key.get()
+    profile = get_entity(user_key)
     return dict(balance=profile.balance)
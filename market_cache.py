@@ -0,0 +1,145 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Google, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Market cache: shared cache of market state and current price.
+
+Prices only change when a Prediction is written, so reads are served from
+memcache (or an in-process SimpleCache when not running on App Engine). Each
+put bumps Prediction.version, and the committed state is written through
+after the put (by the caller, once its transaction commits). A write-through
+replaces the entry with compare-and-set only if it is newer, and a reader
+that missed only adds, so neither can put back an older version.
+"""
+
+import collections
+import os
+import time
+
+import lmsr
+
+from google.appengine.ext import ndb
+from werkzeug.contrib.cache import MemcachedCache
+from werkzeug.contrib.cache import SimpleCache
+
+# Seconds an entry may live; bounds staleness if a write-through is lost.
+MARKET_TIMEOUT = 300
+# Maximum number of entries held by the local SimpleCache backend.
+LOCAL_THRESHOLD = 2000
+# Attempts at a compare-and-set before the write-through gives up.
+CAS_RETRIES = 3
+
+
+class MarketState(collections.namedtuple(
+    'MarketState', ['statement', 'contract_one', 'contract_two',
+                    'liquidity', 'version'])):
+  """The cached fields of a Prediction."""
+
+  def price(self):
+    return float(lmsr.price(self.contract_one, self.contract_two,
+                            self.liquidity))
+
+
+class MemcachedMarketCache(MemcachedCache):
+  """MemcachedCache that can store a MarketState only if it is newer."""
+
+  def update(self, key, state, timeout=None):
+    """Stores state unless a later version is cached; returns if it holds."""
+    from google.appengine.api import memcache
+    if timeout is None:
+      timeout = self.default_timeout
+    key = self.key_prefix + key
+    # CAS ids are kept by the client that read them, so use one per call.
+    client = memcache.Client()
+    for _ in range(CAS_RETRIES):
+      cached = client.gets(key)
+      if cached is not None and cached.version >= state.version:
+        return True
+      if cached is None:
+        if client.add(key, state, time=timeout):
+          return True
+      elif client.cas(key, state, time=timeout):
+        return True
+    return False
+
+
+class LocalMarketCache(SimpleCache):
+  """SimpleCache that can store a MarketState only if it is newer."""
+
+  def add(self, key, value, timeout=None):
+    # SimpleCache.add keeps an expired entry, which would never be refilled.
+    if self._cache.get(key, (0, None))[0] <= time.time():
+      self._cache.pop(key, None)
+    SimpleCache.add(self, key, value, timeout)
+
+  def update(self, key, state, timeout=None):
+    cached = self.get(key)
+    if cached is None or cached.version < state.version:
+      self.set(key, state, timeout)
+    return True
+
+
+def _default_backend():
+  if os.environ.get('SERVER_SOFTWARE'):
+    from google.appengine.api import memcache
+    return MemcachedMarketCache(memcache.Client(),
+                                default_timeout=MARKET_TIMEOUT,
+                                key_prefix='market:')
+  return LocalMarketCache(threshold=LOCAL_THRESHOLD,
+                          default_timeout=MARKET_TIMEOUT)
+
+
+backend = _default_backend()
+
+
+def _cache_key(key):
+  return key.urlsafe()
+
+
+def state_of(prediction):
+  """Returns the MarketState of a loaded Prediction."""
+  return MarketState(prediction.statement, prediction.contract_one,
+                     prediction.contract_two, prediction.liquidity,
+                     prediction.version)
+
+
+def get_markets(keys):
+  """Get the MarketState for each prediction key (None if it is missing).
+
+  Misses are loaded with a single get_multi and written back to the cache.
+  """
+  if not keys:
+    return []
+  cached = backend.get_many(*[_cache_key(k) for k in keys])
+  missing = [k for k, state in zip(keys, cached) if state is None]
+  if missing:
+    loaded = {}
+    for key, prediction in zip(missing, ndb.get_multi(missing)):
+      if prediction is not None:
+        loaded[key] = state_of(prediction)
+        backend.add(_cache_key(key), loaded[key])
+    cached = [state if state is not None else loaded.get(k)
+              for k, state in zip(keys, cached)]
+  return cached
+
+
+def get_market(key):
+  """Get the MarketState for one prediction key (None if it is missing)."""
+  return get_markets([key])[0]
+
+
+def update(prediction):
+  """Write through the state of a Prediction once its put has committed."""
+  backend.update(_cache_key(prediction.key), state_of(prediction))
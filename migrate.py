@@ -0,0 +1,173 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Google, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Migrate: One-off data migrations.
+
+/tasks/migrate_ledger moves positions out of Profile.user_ledger into
+LedgerRecords; /tasks/backfill_prices copies Price rows into PriceHistory,
+where the daily chart reads them; /tasks/backfill_standings rebuilds every
+leaderboard Holding and Standing.
+"""
+
+import webapp2
+
+import logging
+
+import leaderboard
+from models import LedgerRecords, Price, PriceHistory, Profile, Standing
+from models import history_key, ledger_key
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+# Profiles migrated per task.
+PAGE_SIZE = 100
+# Price rows copied per task.
+PRICE_PAGE_SIZE = 500
+
+
+@ndb.transactional
+def migrate_profile(user_key):
+  """Moves one profile's embedded positions; returns how many it moved."""
+  profile = user_key.get()
+  if profile is None or not profile.user_ledger:
+    return 0
+  keys = list(set(
+      ledger_key(user_key, ndb.Key(urlsafe=record.prediction_id))
+      for record in profile.user_ledger))
+  # Positions opened since the new storage went live are added to, not lost.
+  positions = dict(zip(keys, ndb.get_multi(keys)))
+  for record in profile.user_ledger:
+    key = ledger_key(user_key, ndb.Key(urlsafe=record.prediction_id))
+    if positions[key] is None:
+      positions[key] = LedgerRecords(
+          key=key,
+          prediction_id=record.prediction_id,
+          user_id=profile.user_id,
+          contract_one=0.00,
+          contract_two=0.00)
+    positions[key].contract_one += record.contract_one or 0.00
+    positions[key].contract_two += record.contract_two or 0.00
+  moved = len(profile.user_ledger)
+  profile.user_ledger = []
+  ndb.put_multi(list(positions.values()) + [profile])
+  return moved
+
+
+def migrate(cursor=None):
+  """Migrates one page of profiles; returns (moved, next cursor or None)."""
+  keys, next_cursor, more = Profile.query().fetch_page(
+      PAGE_SIZE, start_cursor=cursor, keys_only=True)
+  moved = sum(migrate_profile(key) for key in keys)
+  return moved, next_cursor if more else None
+
+
+def backfill_prices(cursor=None):
+  """Copies one page of Price rows into PriceHistory.
+
+  Histories never hold two prices for the same time, so pages can be re-run.
+  Returns (copied, next cursor or None).
+  """
+  prices, next_cursor, more = Price.query().fetch_page(
+      PRICE_PAGE_SIZE, start_cursor=cursor)
+  histories = {}
+  for p in prices:
+    if p.prediction_id is None or p.date is None:
+      continue
+    histories.setdefault(history_key(p.prediction_id, p.date), []).append(p)
+  keys = list(histories)
+  changed = []
+  for key, history in zip(keys, ndb.get_multi(keys)):
+    history = history or PriceHistory(key=key)
+    added = [history.add(p.date, p.value) for p in histories[key]]
+    if any(added):
+      changed.append(history)
+  ndb.put_multi(changed)
+  return len(prices), next_cursor if more else None
+
+
+def rebuild_standings(user_key):
+  """Recomputes a profile's Holdings and Standings; see leaderboard.rebuild.
+
+  Standings once kept in the profile's entity group are deleted. Returns the
+  number of Standings written.
+  """
+  ndb.delete_multi(Standing.query(ancestor=user_key).fetch(keys_only=True))
+  return leaderboard.rebuild([user_key])
+
+
+def backfill_standings(cursor=None):
+  """Rebuilds one page of profiles' Standings.
+
+  Returns (standings written, next cursor or None).
+  """
+  keys, next_cursor, more = Profile.query().fetch_page(
+      PAGE_SIZE, start_cursor=cursor, keys_only=True)
+  written = sum(rebuild_standings(key) for key in keys)
+  return written, next_cursor if more else None
+
+
+class MigrateLedgerHandler(webapp2.RequestHandler):
+
+  def get(self):
+    self.post()
+
+  def post(self):
+    cursor = self.request.get('cursor')
+    moved, next_cursor = migrate(Cursor(urlsafe=cursor) if cursor else None)
+    logging.info('Moved %d ledger records', moved)
+    if next_cursor:
+      taskqueue.add(url='/tasks/migrate_ledger',
+                    params={'cursor': next_cursor.urlsafe()})
+    self.response.status = 204
+
+
+class BackfillPricesHandler(webapp2.RequestHandler):
+
+  def get(self):
+    self.post()
+
+  def post(self):
+    cursor = self.request.get('cursor')
+    copied, next_cursor = backfill_prices(
+        Cursor(urlsafe=cursor) if cursor else None)
+    logging.info('Copied %d prices', copied)
+    if next_cursor:
+      taskqueue.add(url='/tasks/backfill_prices',
+                    params={'cursor': next_cursor.urlsafe()})
+    self.response.status = 204
+
+
+class BackfillStandingsHandler(webapp2.RequestHandler):
+
+  def get(self):
+    self.post()
+
+  def post(self):
+    cursor = self.request.get('cursor')
+    written, next_cursor = backfill_standings(
+        Cursor(urlsafe=cursor) if cursor else None)
+    logging.info('Rebuilt %d standings', written)
+    if next_cursor:
+      taskqueue.add(url='/tasks/backfill_standings',
+                    params={'cursor': next_cursor.urlsafe()})
+    self.response.status = 204
+
+
+app = webapp2.WSGIApplication([
+    ('/tasks/backfill_prices', BackfillPricesHandler),
+    ('/tasks/backfill_standings', BackfillStandingsHandler),
+    ('/.*', MigrateLedgerHandler),
+], debug=True)
@@ -16,12 +16,78 @@
 
 """Models and shared functions."""
 
+import array
+import bisect
+import calendar
+import collections
+import datetime
 import math
+import random
+import time
 
+import numpy as np
+
+import lmsr
+import market_cache
+
+from flask import g
+from flask import has_request_context
+from google.appengine.api import datastore_errors
 from google.appengine.api import users
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
-class Prediction(ndb.Model):
+# Attempts, and the initial backoff in seconds, for colliding transactions.
+TRANSACTION_ATTEMPTS = 5
+TRANSACTION_BACKOFF = 0.05
+
+
+def _identity_map():
+  """Returns this request's key -> entity map, or None outside a request."""
+  if not has_request_context():
+    return None
+  if not hasattr(g, 'entities'):
+    g.entities = {}
+  return g.entities
+
+
+def get_entity(key):
+  """Get an entity, loading it at most once per request."""
+  entities = _identity_map()
+  if entities is None:
+    return key.get()
+  if key not in entities:
+    entities[key] = key.get()
+  return entities[key]
+
+
+def remember_entity(entity):
+  """Add an entity loaded elsewhere (e.g. with get_async) to the map."""
+  entities = _identity_map()
+  if entities is not None and entity is not None:
+    entities[entity.key] = entity
+  return entity
+
+
+def forget_entity(key):
+  """Drop a key from the map so the next get_entity re-reads it."""
+  entities = _identity_map()
+  if entities is not None:
+    entities.pop(key, None)
+
+
+class RequestCachedModel(ndb.Model):
+  """Base for models read through get_entity; puts invalidate the map."""
+
+  def _post_put_hook(self, future):
+    forget_entity(self.key)
+
+  @classmethod
+  def _post_delete_hook(cls, key, future):
+    forget_entity(key)
+
+
+class Prediction(RequestCachedModel):
   """Prediction model."""
   # Description of the prediction; how will the outcome be evaluated.
   info = ndb.TextProperty()
@@ -46,31 +112,130 @@ class Prediction(ndb.Model):
   resolved = ndb.BooleanProperty(default=False)
   # TODO(goldhaber): Add ACLs to limit visibility and participants
   access_group = ndb.StringProperty()
+  # Activity, folded in from ActivityShards by stats.py. Totals cover the
+  # hours before stats_hour (hours since the epoch); the 24h figures cover
+  # the last 24 hours as of the last compaction.
+  volume = ndb.FloatProperty(default=0.00)
+  trade_count = ndb.IntegerProperty(default=0)
+  trader_count = ndb.IntegerProperty(default=0)
+  stats_hour = ndb.IntegerProperty(default=0, indexed=False)
+  volume_24h = ndb.FloatProperty(default=0.00)
+  trades_24h = ndb.IntegerProperty(default=0)
+  price_change_24h = ndb.FloatProperty(default=0.00)
+  trending = ndb.FloatProperty(default=0.00)
+  # Bumped by every put; orders the states written through to market_cache.
+  version = ndb.IntegerProperty(default=0, indexed=False)
 
   def GetPriceByPredictionId(self):
-    price = math.pow(math.e, (self.contract_one / self.liquidity)) / (
-        math.pow(math.e, (self.contract_two / self.liquidity)) + math.pow(
-            math.e, (self.contract_two / self.liquidity)))
-    return float(price)
+    return float(lmsr.price(self.contract_one, self.contract_two,
+                            self.liquidity))
+
+  def _pre_put_hook(self):
+    super(Prediction, self)._pre_put_hook()
+    self.version = (self.version or 0) + 1
+
+  def _post_put_hook(self, future):
+    super(Prediction, self)._post_put_hook(future)
+    # Inside a transaction the put is not yet committed; the caller writes
+    # the market through once it is.
+    if not ndb.in_transaction() and not future.get_exception():
+      market_cache.update(self)
 
 class LedgerRecords(ndb.Model):
-  """Ledger model - for tracking ownership of shares by a user."""
+  """Ledger model - for tracking ownership of shares by a user.
+
+  Each position is a child of the user's Profile, keyed by the urlsafe
+  prediction key; see ledger_key.
+  """
   prediction_id = ndb.StringProperty()
   user_id = ndb.StringProperty()
   contract_one = ndb.FloatProperty()
   contract_two = ndb.FloatProperty()
+  # What the shares still held of each contract cost, at average cost.
+  cost_one = ndb.FloatProperty(default=0.00)
+  cost_two = ndb.FloatProperty(default=0.00)
+  # Proceeds of sales less what the shares sold cost.
+  realized_pnl = ndb.FloatProperty(default=0.00)
   updated_time = ndb.DateTimeProperty()
 
 
-class Profile(ndb.Model):
+class Profile(RequestCachedModel):
   """Profile model - user model."""
   user_id = ndb.StringProperty()
   user_email = ndb.StringProperty()
   balance = ndb.FloatProperty()
-  # TODO(goldhaber): Change from structured property or properly configure hook
+  # Legacy embedded positions, moved to LedgerRecords entities by migrate.py.
   user_ledger = ndb.StructuredProperty(LedgerRecords, repeated=True)
 
 
+def ledger_key(user_key, prediction_key):
+  """Returns the key of a user's LedgerRecords for a prediction."""
+  return ndb.Key(LedgerRecords, prediction_key.urlsafe(), parent=user_key)
+
+
+class Standing(ndb.Model):
+  """Standing model - a user's materialized place on a leaderboard.
+
+  Keyed by user and org (see standing_key), outside the user's entity group,
+  and written only by leaderboard.py. The overall standing ('' org) holds the
+  user's balance as cash and the value of all their positions. An org's
+  standing holds the cash paid into and out of that org's markets and the
+  value of the positions in them, so its net worth is the user's profit there.
+  """
+  org = ndb.StringProperty(default='')
+  name = ndb.StringProperty()
+  cash = ndb.FloatProperty(default=0.00)
+  holdings = ndb.FloatProperty(default=0.00)
+  net_worth = ndb.ComputedProperty(lambda self: self.cash + self.holdings)
+  # When the balance held as cash by an overall standing was read.
+  as_of = ndb.DateTimeProperty(indexed=False)
+  updated_time = ndb.DateTimeProperty(auto_now=True)
+
+
+def standing_key(user_key, org=''):
+  """Returns the key of a user's Standing in org ('' for overall)."""
+  return ndb.Key(Standing, '%s:org:%s' % (user_key.id(), org or ''))
+
+
+class Holding(ndb.Model):
+  """Holding model - a user's position in one market as the leaderboard has it.
+
+  Keyed by user and market (see holding_key), outside the user's entity group,
+  and written only by leaderboard.py. value and cash are what the holding
+  currently adds to the user's standings' holdings and org cash, so a change
+  to it is applied to them as a delta.
+  """
+  user_id = ndb.KeyProperty(kind=Profile, indexed=False)
+  prediction_id = ndb.KeyProperty(kind=Prediction)
+  org = ndb.StringProperty(default='', indexed=False)
+  contract_one = ndb.FloatProperty(default=0.00, indexed=False)
+  contract_two = ndb.FloatProperty(default=0.00, indexed=False)
+  # Realized P&L less the cost of the shares still held.
+  basis = ndb.FloatProperty(default=0.00, indexed=False)
+  # The position's updated_time the quantities and basis are from.
+  as_of = ndb.DateTimeProperty(indexed=False)
+  # The contract one price the shares are marked at, and when it was read.
+  price = ndb.FloatProperty(default=0.00, indexed=False)
+  priced_at = ndb.DateTimeProperty(indexed=False)
+  # Set once the market has an outcome; its shares are then worth nothing
+  # here, and once paid out the payout counts as org cash.
+  closed = ndb.BooleanProperty(default=False, indexed=False)
+  paid = ndb.BooleanProperty(default=False, indexed=False)
+  payout = ndb.FloatProperty(default=0.00, indexed=False)
+  value = ndb.FloatProperty(default=0.00, indexed=False)
+  cash = ndb.FloatProperty(default=0.00, indexed=False)
+
+
+def holding_key(user_key, prediction_key):
+  """Returns the key of a user's Holding in a prediction."""
+  return ndb.Key(Holding, '%s:%s' % (user_key.id(), prediction_key.urlsafe()))
+
+
+def display_name(profile):
+  """Returns the name a user is shown by on leaderboards."""
+  return (profile.user_email or '').split('@')[0]
+
+
 class Trade(ndb.Model):
   """Trade model - each trade that is made."""
   prediction_id = ndb.KeyProperty(kind=Prediction)
@@ -78,33 +243,267 @@ class Trade(ndb.Model):
   direction = ndb.StringProperty()
   contract = ndb.StringProperty()
   quantity = ndb.FloatProperty()
+  # The fill, as set by ApplyTrade: what the trade cost (negative when it
+  # paid out), the price of contract one either side of it and the market
+  # quantities it left.
+  cost = ndb.FloatProperty()
+  price_before = ndb.FloatProperty()
+  price_after = ndb.FloatProperty()
+  contract_one_after = ndb.FloatProperty()
+  contract_two_after = ndb.FloatProperty()
+  creation_time = ndb.DateTimeProperty(auto_now_add=True)
+
+class TradeTicket(ndb.Model):
+  """TradeTicket model - a trade queued for its market's sequencer.
+
+  Tickets are children of the trader's Profile.
+  """
+  prediction_id = ndb.KeyProperty(kind=Prediction)
+  direction = ndb.StringProperty()
+  contract = ndb.StringProperty()
+  quantity = ndb.FloatProperty()
+  # PENDING until the sequencer has either FILLED or REJECTED the trade.
+  status = ndb.StringProperty(default='PENDING')
+  # What the trade cost when it was filled.
+  fill_price = ndb.FloatProperty()
   creation_time = ndb.DateTimeProperty(auto_now_add=True)
+  filled_time = ndb.DateTimeProperty()
+
+class ScoringProgress(ndb.Model):
+  """ScoringProgress model - how far scorer.py has paid out a prediction.
+
+  Keyed by the prediction's urlsafe key when scored serially. Sharded scoring
+  keeps one record per shard, plus one listing the shards; see scorer.py.
+  """
+  # Urlsafe cursor into the prediction's distinct traders; None at the start.
+  cursor = ndb.StringProperty(indexed=False)
+  # Number of traders paid so far.
+  paid = ndb.IntegerProperty(default=0, indexed=False)
+  # Set once every trader in range has been paid.
+  done = ndb.BooleanProperty(default=False, indexed=False)
+  # The range [start_user, end_user) of trader keys a shard pays; None is open.
+  start_user = ndb.KeyProperty(indexed=False)
+  end_user = ndb.KeyProperty(indexed=False)
+  # On the shard list record, how many shards the prediction was split into
+  # and the first trader key of each.
+  shards = ndb.IntegerProperty(indexed=False)
+  shard_starts = ndb.KeyProperty(repeated=True, indexed=False)
 
 class Price(ndb.Model):
   prediction_id = ndb.KeyProperty(kind=Prediction)
   date = ndb.DateTimeProperty()
   value = ndb.FloatProperty()
 
+
+class PriceHistory(ndb.Model):
+  """PriceHistory model - one month of a prediction's prices, packed.
+
+  Written daily by price.py; the daily and weekly charts fall back to it
+  where trades made no bars (see rollups.get_bars_async). Keyed by
+  history_key. Both properties hold array('d') data in time order;
+  timestamps are seconds since the epoch (UTC).
+  """
+  timestamps = ndb.BlobProperty()
+  values = ndb.BlobProperty()
+
+  def points(self):
+    """Returns the history as a list of (datetime, value) in time order."""
+    timestamps = array.array('d', self.timestamps or '')
+    values = array.array('d', self.values or '')
+    return [(datetime.datetime.utcfromtimestamp(t), v)
+            for t, v in zip(timestamps, values)]
+
+  def add(self, when, value):
+    """Adds a price at datetime when; returns False if one is already there."""
+    timestamps = array.array('d', self.timestamps or '')
+    values = array.array('d', self.values or '')
+    timestamp = to_timestamp(when)
+    i = bisect.bisect_left(timestamps, timestamp)
+    if i < len(timestamps) and timestamps[i] == timestamp:
+      return False
+    timestamps.insert(i, timestamp)
+    values.insert(i, value)
+    self.timestamps = timestamps.tostring()
+    self.values = values.tostring()
+    return True
+
+
+def to_timestamp(when):
+  """Returns a naive UTC datetime as seconds since the epoch."""
+  return calendar.timegm(when.timetuple()) + when.microsecond / 1e6
+
+
+def history_key(prediction_key, when):
+  """Returns the key of a prediction's PriceHistory for when's month."""
+  return ndb.Key(PriceHistory, '%s:%04d-%02d' % (
+      prediction_key.urlsafe(), when.year, when.month))
+
+
+class PriceBars(ndb.Model):
+  """PriceBars model - open/high/low/close bars of one resolution, packed.
+
+  Keyed by rollups.bars_key. Each property holds array('d') data ordered by
+  starts, the bar start times in seconds since the epoch (UTC). open_times and
+  close_times are when the ticks setting each bar's open and close were made.
+  """
+  starts = ndb.BlobProperty()
+  opens = ndb.BlobProperty()
+  highs = ndb.BlobProperty()
+  lows = ndb.BlobProperty()
+  closes = ndb.BlobProperty()
+  open_times = ndb.BlobProperty()
+  close_times = ndb.BlobProperty()
+
+
+class ActivityShard(ndb.Model):
+  """ActivityShard model - one shard of a market's trading in one hour.
+
+  Keyed by stats.shard_key. Trades add to a random shard of the current hour
+  so busy markets do not contend on a single counter; stats.py folds the
+  shards into the Prediction.
+  """
+  volume = ndb.FloatProperty(default=0.00, indexed=False)
+  trades = ndb.IntegerProperty(default=0, indexed=False)
+  # Traders making their first trade in the market.
+  traders = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class SnapshotProgress(ndb.Model):
+  """SnapshotProgress model - how far price.py has got with a day's prices.
+
+  Keyed by the day, as YYYY-MM-DD.
+  """
+  # The date written on every Price of the run.
+  date = ndb.DateTimeProperty(indexed=False)
+  # Urlsafe cursor into the open predictions; None at the start.
+  cursor = ndb.StringProperty(indexed=False)
+  done = ndb.BooleanProperty(default=False, indexed=False)
+  # Number of prices written so far.
+  written = ndb.IntegerProperty(default=0, indexed=False)
+
+# The fields loaded for each market on the predictions board; must match the
+# composite indexes in index.yaml.
+BOARD_PROJECTION = [
+    Prediction.statement, Prediction.contract_one, Prediction.contract_two,
+    Prediction.liquidity
+]
+
+# Orders of the predictions board; see get_prediction_page.
+BOARD_SORTS = (None, 'closing', 'trending', 'volume')
+
+# How far inside (0, 1) calculate_trades_from_likelihoods keeps prices; a
+# market can price at exactly 0 or 1 in floating point, where a contract has
+# no odds to size a Kelly bet with.
+KELLY_PRICE_MARGIN = 1e-9
+
+# The default page of get_trade_history_page.
+TRADE_HISTORY_PAGE = 500
+
+
 # TODO(goldhaber): move into Trade Class
 def get_price_for_trade(prediction, trade):
   """Returns the price of a trade for a prediction."""
-  if trade.contract == 'CONTRACT_ONE':
-    old_quantity = prediction.contract_one
-    old_quantity_other = prediction.contract_two
-  else:
-    old_quantity = prediction.contract_two
-    old_quantity_other = prediction.contract_one
+  return lmsr.trade_cost(prediction.contract_one, prediction.contract_two,
+                         prediction.liquidity, trade.contract,
+                         trade.direction, trade.quantity)
+
+
+def quote_trades(prediction, contracts, directions, quantities):
+  """Prices many hypothetical trades against one market without writing.
+
+  The counterpart of get_price_for_trade for lists: every trade is quoted
+  from the current market state in one vectorized pass, and contracts,
+  directions and quantities broadcast against each other as in any numpy
+  arithmetic. Returns (costs, prices of contract one after each trade) as
+  lists.
+  """
+  costs, prices = lmsr.quote(prediction.contract_one, prediction.contract_two,
+                             prediction.liquidity, np.asarray(contracts),
+                             np.asarray(directions),
+                             np.asarray(quantities, dtype=float))
+  return costs.tolist(), prices.tolist()
+
+
+def ApplyTrade(prediction, current_user, trade, position):
+  """Applies a trade to loaded entities; returns the entities to put.
+
+  position is the user's LedgerRecords for the prediction, or None if they
+  hold none. The trade is filled in with its cost and the market it left, and
+  the position's cost basis and realized P&L are kept up to date. The result
+  is [trade, current_user, prediction, position], or 'error' if the trade is
+  not allowed.
+  """
+  price = get_price_for_trade(prediction, trade)
+  price_before = prediction.GetPriceByPredictionId()
   if trade.direction == 'BUY':
-    new_quantity = old_quantity + trade.quantity
+    if current_user.balance >= price:
+      current_user.balance -= price
+      if position is None:
+        position = LedgerRecords(
+            key=ledger_key(current_user.key, trade.prediction_id),
+            prediction_id=trade.prediction_id.urlsafe(),
+            user_id=current_user.user_id,
+            contract_one=0.00,
+            contract_two=0.00)
+      if trade.contract == 'CONTRACT_ONE':
+        position.contract_one += trade.quantity
+        position.cost_one += price
+        prediction.contract_one += trade.quantity
+      else:
+        position.contract_two += trade.quantity
+        position.cost_two += price
+        prediction.contract_two += trade.quantity
+    else:
+      # TODO(goldhaber): throw error
+      return 'error'
   else:
-    new_quantity = old_quantity - trade.quantity
-  price = (prediction.liquidity * math.log(
-      math.pow(math.e, (new_quantity / prediction.liquidity)) +
-      math.pow(math.e, (old_quantity_other / prediction.liquidity)))) - (
-          prediction.liquidity * math.log(
-              math.pow(math.e, (old_quantity / prediction.liquidity)) +
-              math.pow(math.e, (old_quantity_other / prediction.liquidity))))
-  return price
+    if position is None:
+      return 'error'
+    if (trade.contract == 'CONTRACT_ONE' and
+        position.contract_one >= trade.quantity) or (
+            trade.contract == 'CONTRACT_TWO' and
+            position.contract_two >= trade.quantity):
+      if trade.contract == 'CONTRACT_ONE':
+        basis = _cost_of_shares(position.cost_one, position.contract_one,
+                                trade.quantity)
+        position.contract_one -= trade.quantity
+        position.cost_one -= basis
+        prediction.contract_one -= trade.quantity
+      else:
+        basis = _cost_of_shares(position.cost_two, position.contract_two,
+                                trade.quantity)
+        position.contract_two -= trade.quantity
+        position.cost_two -= basis
+        prediction.contract_two -= trade.quantity
+      current_user.balance -= price
+      position.realized_pnl += -price - basis
+    else:
+      return 'error'
+  position.updated_time = datetime.datetime.now()
+  trade.cost = price
+  trade.price_before = price_before
+  trade.price_after = prediction.GetPriceByPredictionId()
+  trade.contract_one_after = prediction.contract_one
+  trade.contract_two_after = prediction.contract_two
+  return [trade, current_user, prediction, position]
+
+
+def _cost_of_shares(cost, held, quantity):
+  """Returns the average cost of quantity of the held shares."""
+  if not held:
+    return 0.00
+  return cost * quantity / held
+
+
+def run_in_transaction(callback, attempts=TRANSACTION_ATTEMPTS):
+  """Run callback in a cross-group transaction, backing off on collisions."""
+  for attempt in range(attempts):
+    try:
+      return ndb.transaction(callback, xg=True, retries=0)
+    except datastore_errors.TransactionFailedError:
+      if attempt == attempts - 1:
+        raise
+      time.sleep(TRANSACTION_BACKOFF * (2 ** attempt) * (1 + random.random()))
 
 
 def check_if_user_profile(user_id):
@@ -119,6 +518,8 @@ def check_if_user_profile(user_id):
         user_email=users.get_current_user().email())
     profile.key = ndb.Key('Profile', users.get_current_user().user_id())
     profile_key = profile.put()
+    Standing(key=standing_key(profile_key), name=display_name(profile),
+             cash=profile.balance).put()
     return profile
 
 
@@ -131,35 +532,118 @@ def verification_of_trade(trade):
 def GetPriceByPredictionId(prediction_id):
   """Get current price by Prediction Id"""
   prediction_key = ndb.Key(urlsafe=prediction_id)
-  pred = prediction_key.get()
-  price = math.pow(math.e, (pred.contract_one / pred.liquidity)) / (
-      math.pow(math.e, (pred.contract_two / pred.liquidity)) + math.pow(
-          math.e, (pred.contract_two / pred.liquidity)))
-  return float(price)
+  return market_cache.get_market(prediction_key).price()
+
+
+def get_prediction_page(org=None, resolved=None, limit=50, cursor=None,
+                        sort=None):
+  """Get one page of predictions projected to the fields the board shows.
+
+  sort is one of BOARD_SORTS: by end time (the default), closing (not yet
+  ended, soonest first), trending or 24 hour volume. Returns (predictions,
+  next_cursor, more) as ndb.Query.fetch_page does; cursor is the urlsafe
+  string of the previous page's next_cursor.
+  """
+  if sort not in BOARD_SORTS:
+    raise ValueError('Unknown sort %r' % sort)
+  query = Prediction.query()
+  if org:
+    query = query.filter(Prediction.org == org)
+  if resolved is not None:
+    query = query.filter(Prediction.resolved == resolved)
+  if sort == 'trending':
+    query = query.order(-Prediction.trending)
+  elif sort == 'volume':
+    query = query.order(-Prediction.volume_24h)
+  else:
+    if sort == 'closing':
+      query = query.filter(Prediction.end_time >= datetime.datetime.now())
+    query = query.order(Prediction.end_time)
+  return query.fetch_page(
+      limit,
+      start_cursor=Cursor(urlsafe=cursor) if cursor else None,
+      projection=BOARD_PROJECTION)
+
+
+def get_trade_history_page(prediction_key, user_key=None, direction=None,
+                           start=None, end=None, limit=TRADE_HISTORY_PAGE,
+                           cursor=None):
+  """Get one page of a prediction's trades, oldest first.
+
+  start and end are naive UTC datetimes bounding creation_time. Returns
+  (trades, next_cursor, more) as ndb.Query.fetch_page does; cursor is the
+  urlsafe string of the previous page's next_cursor.
+  """
+  query = Trade.query(Trade.prediction_id == prediction_key)
+  if user_key is not None:
+    query = query.filter(Trade.user_id == user_key)
+  if direction is not None:
+    query = query.filter(Trade.direction == direction)
+  if start is not None:
+    query = query.filter(Trade.creation_time >= start)
+  if end is not None:
+    query = query.filter(Trade.creation_time < end)
+  return query.order(Trade.creation_time).fetch_page(
+      limit, start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+
+
+def get_prices_for_predictions(predictions):
+  """Get current prices for already loaded predictions in one pass."""
+  if not predictions:
+    return []
+  prices = lmsr.price(np.array([p.contract_one for p in predictions]),
+                      np.array([p.contract_two for p in predictions]),
+                      np.array([p.liquidity for p in predictions]))
+  return prices.tolist()
+
+
+class PositionValue(collections.namedtuple(
+    'PositionValue', ['market', 'price', 'value', 'unrealized_pnl'])):
+  """A position's MarketState, price of contract one and market value.
+
+  unrealized_pnl is the market value less what the shares held cost.
+  """
+
+
+def value_positions(positions):
+  """Marks LedgerRecords to market with one batched read and pricing pass.
+
+  A position is worth one point per share of the contract that pays out, so
+  it is valued at the price of contract one for its contract one shares and
+  one minus that for its contract two shares. Returns a PositionValue for
+  each position (None where the prediction is missing) and the total value.
+  """
+  markets = market_cache.get_markets(
+      [ndb.Key(urlsafe=position.prediction_id) for position in positions])
+  found = [i for i, market in enumerate(markets) if market is not None]
+  valuations = [None] * len(positions)
+  if not found:
+    return valuations, 0.0
+  prices = lmsr.price(np.array([markets[i].contract_one for i in found]),
+                      np.array([markets[i].contract_two for i in found]),
+                      np.array([markets[i].liquidity for i in found]))
+  values = (np.array([positions[i].contract_one for i in found]) * prices +
+            np.array([positions[i].contract_two for i in found]) *
+            (1 - prices))
+  for i, price, value in zip(found, prices.tolist(), values.tolist()):
+    valuations[i] = PositionValue(
+        markets[i], price, value,
+        value - positions[i].cost_one - positions[i].cost_two)
+  return valuations, float(values.sum())
 
 
 def calculate_trade_from_likelihood(probability, prediction, profile):
   """Calculate the trade using the Kelly Criterion"""
   probability = probability / 100.00
-  print probability
-  price = GetPriceByPredictionId(prediction.key.urlsafe())
-  print price
+  price = prediction.GetPriceByPredictionId()
   bankroll = (profile.balance) / 5
-  bet = (bankroll * (((
-      (1 - price) / price) * (probability) - (1 - probability)) / (
-          (1 - price) / price)))
-  current_user_portfolio = [
-      i for i in profile.user_ledger
-      if i.prediction_id == prediction.key.urlsafe()
-  ]
-  print current_user_portfolio
+  bet = lmsr.kelly_bet(price, probability, bankroll)
+  position = ledger_key(profile.key, prediction.key).get()
   if probability > price:
     contract = 'CONTRACT_ONE'
-    primary = prediction.contract_one
-    secondary = prediction.contract_two
-    if len(current_user_portfolio) > 0:
-      if current_user_portfolio[0].contract_two != 0:
-        quantity = current_user_portfolio[0].contract_two
+    if position is not None:
+      if position.contract_two != 0:
+        quantity = position.contract_two
         direction = 'SELL'
         contract = 'CONTRACT_TWO'
         return Trade(
@@ -170,11 +654,9 @@ def calculate_trade_from_likelihood(probability, prediction, profile):
             contract=contract)
   elif probability < price:
     contract = 'CONTRACT_TWO'
-    primary = prediction.contract_two
-    secondary = prediction.contract_one
-    if len(current_user_portfolio) > 0:
-      if current_user_portfolio[0].contract_one != 0:
-        quantity = current_user_portfolio[0].contract_one
+    if position is not None:
+      if position.contract_one != 0:
+        quantity = position.contract_one
         direction = 'SELL'
         contract = 'CONTRACT_ONE'
         return Trade(
@@ -186,14 +668,68 @@ def calculate_trade_from_likelihood(probability, prediction, profile):
   else:
     return 'No bet if its the same'
   direction = 'BUY'
-  quantity = math.fabs(prediction.liquidity * math.log(
-      math.pow(math.e, ((primary / prediction.liquidity) + (
-          bet / prediction.liquidity))) + math.pow(math.e, ((
-              secondary / prediction.liquidity) + (bet / prediction.liquidity)))
-      - math.pow(math.e, (secondary / prediction.liquidity))) - primary)
+  quantity = math.fabs(lmsr.quantity_for_cost(
+      prediction.contract_one, prediction.contract_two, prediction.liquidity,
+      contract, bet))
   return Trade(
       prediction_id=prediction.key,
       user_id=profile.key,
       quantity=quantity,
       direction=direction,
       contract=contract)
+
+
+def calculate_trades_from_likelihoods(likelihoods, profile):
+  """Calculate the trades for many markets using the Kelly Criterion.
+
+  likelihoods maps prediction keys to believed likelihoods in percent, as
+  taken by calculate_trade_from_likelihood. As for a single market, a position
+  in the contract the belief is against is sold first. The remaining markets
+  are sized in one pass against a single bankroll, scaling every stake down
+  together if the Kelly bets would add up to more than it. Returns the
+  trades, as children of the profile, leaving out markets that are missing
+  or already priced at the belief.
+  """
+  keys = list(likelihoods)
+  markets = market_cache.get_markets(keys)
+  positions = ndb.get_multi([ledger_key(profile.key, key) for key in keys])
+  found = [i for i, market in enumerate(markets) if market is not None]
+  if not found:
+    return []
+  contract_one = np.array([markets[i].contract_one for i in found])
+  contract_two = np.array([markets[i].contract_two for i in found])
+  liquidity = np.array([markets[i].liquidity for i in found])
+  held_one = np.array([positions[i].contract_one if positions[i] else 0.0
+                       for i in found])
+  held_two = np.array([positions[i].contract_two if positions[i] else 0.0
+                       for i in found])
+  probability = np.array([likelihoods[keys[i]] for i in found]) / 100.00
+  price = lmsr.price(contract_one, contract_two, liquidity)
+  favours_one = probability > price
+  sell = np.where(favours_one, held_two != 0, held_one != 0)
+  # Bet on whichever contract the belief favours, at that contract's price.
+  odds_price = np.clip(price, KELLY_PRICE_MARGIN, 1 - KELLY_PRICE_MARGIN)
+  fraction = np.where(sell, 0.0, np.maximum(lmsr.kelly_bet(
+      np.where(favours_one, odds_price, 1 - odds_price),
+      np.where(favours_one, probability, 1 - probability), 1.0), 0.0))
+  if fraction.sum() > 1:
+    fraction /= fraction.sum()
+  buy_contract = np.where(favours_one, 'CONTRACT_ONE', 'CONTRACT_TWO')
+  quantity = np.where(sell, np.where(favours_one, held_two, held_one),
+                      lmsr.quantity_for_cost(
+                          contract_one, contract_two, liquidity, buy_contract,
+                          fraction * profile.balance / 5))
+  trades = []
+  for j, i in enumerate(found):
+    if probability[j] == price[j]:
+      continue
+    if sell[j]:
+      direction = 'SELL'
+      contract = 'CONTRACT_TWO' if favours_one[j] else 'CONTRACT_ONE'
+    else:
+      direction = 'BUY'
+      contract = str(buy_contract[j])
+    trades.append(Trade(parent=profile.key, prediction_id=keys[i],
+                        user_id=profile.key, direction=direction,
+                        contract=contract, quantity=float(quantity[j])))
+  return trades
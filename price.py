@@ -13,34 +13,84 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-"""Pricer: Generates a daily price for each prediction."""
+"""Pricer: Generates a daily price for each prediction.
+
+The prices are the daily chart of the days a market made no price bars (see
+rollups.py).
+"""
 
 import webapp2
 
 import logging
 import datetime
+import time
+
+import market_cache
 
-from models import Prediction, Trade, LedgerRecords, Profile, Price
+from models import Prediction, PriceHistory, SnapshotProgress
+from models import get_prices_for_predictions, history_key
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
+# Open predictions priced and written per batch.
+PAGE_SIZE = 200
+# Seconds a single price() call may run before leaving the rest for later.
+TIME_BUDGET = 480
+
 
-def price():
-  predictions = Prediction.query(
-      ndb.AND(Prediction.outcome == "UNKNOWN", Prediction.resolved == False)).fetch()
-  input_date = datetime.datetime.now()
+def price(deadline=None, day=None):
+  """Writes a day's price for every open prediction, a page at a time.
 
-  for p in predictions:
-    price = Price(prediction_id=p.key,
-                  date=input_date,
-                  value=p.GetPriceByPredictionId())
-    price.put()
+  Each price is appended to the prediction's PriceHistory for the month.
+  Progress is checkpointed after each page and a history never holds two
+  prices for the same time, so a run that stops early resumes without writing
+  duplicates. Predictions are paged in key order, which trades do not change,
+  and priced from the market cache. day is the run's 'YYYY-MM-DD' (today by
+  default), so a continuation finishes the day it started even after
+  midnight. Returns the day's SnapshotProgress.
+  """
+  today = datetime.datetime.now()
+  if day is None:
+    day = today.strftime('%Y-%m-%d')
+  run_key = ndb.Key(SnapshotProgress, day)
+  run = run_key.get() or SnapshotProgress(key=run_key, date=today)
+  query = Prediction.query(
+      ndb.AND(Prediction.outcome == "UNKNOWN", Prediction.resolved == False)
+  ).order(Prediction.key)
+  while not run.done:
+    prediction_keys, next_cursor, more = query.fetch_page(
+        PAGE_SIZE,
+        start_cursor=Cursor(urlsafe=run.cursor) if run.cursor else None,
+        keys_only=True)
+    markets = [(key, market) for key, market in
+               zip(prediction_keys, market_cache.get_markets(prediction_keys))
+               if market is not None]
+    values = get_prices_for_predictions([market for _, market in markets])
+    keys = [history_key(key, run.date) for key, _ in markets]
+    histories = [h or PriceHistory(key=k)
+                 for k, h in zip(keys, ndb.get_multi(keys))]
+    ndb.put_multi([h for h, value in zip(histories, values)
+                   if h.add(run.date, value)])
+    if next_cursor:
+      run.cursor = next_cursor.urlsafe()
+    run.done = not more
+    run.written += len(markets)
+    run.put()
+    if deadline is not None and time.time() >= deadline:
+      break
+  return run
 
 
 class PriceHandler(webapp2.RequestHandler):
 
   def get(self):
-    audit = price()
+    audit = price(time.time() + TIME_BUDGET, self.request.get('date') or None)
     logging.info(str(audit))
+    if not audit.done:
+      # Out of time; carry on with the same day in a fresh request.
+      taskqueue.add(url='/tasks/price', method='GET',
+                    params={'date': audit.key.id()})
     self.response.status = 204
 
 
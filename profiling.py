@@ -0,0 +1,180 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Google, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Profiling: on-demand cProfile sampling of selected routes.
+
+Admins choose routes (Flask URL rules, such as /trades/create) and a sample
+rate at /admin/profiler. Settings are shared through memcache (a SimpleCache
+when not running on App Engine). A sampled request to a chosen route, or one
+from an admin carrying the PROFILE_HEADER, is run under cProfile and its stats
+added to the route's aggregate on this instance, which can be downloaded as a
+pstats dump. Nothing is profiled until a route has been chosen.
+"""
+
+import cProfile
+import marshal
+import os
+import pstats
+import random
+import StringIO
+import threading
+import time
+
+from google.appengine.api import users
+from werkzeug.contrib.cache import MemcachedCache
+from werkzeug.contrib.cache import SimpleCache
+from werkzeug.exceptions import HTTPException
+
+# Request header (as a WSGI environ key) asking for a request to be profiled.
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+# Seconds an instance uses its copy of the settings before re-reading them.
+SETTINGS_TTL = 10
+
+_SETTINGS_KEY = 'settings'
+_lock = threading.Lock()
+_aggregates = {}
+_counts = {}
+_local = {'settings': None, 'read': 0}
+
+
+def _default_backend():
+  if os.environ.get('SERVER_SOFTWARE'):
+    from google.appengine.api import memcache
+    return MemcachedCache(memcache.Client(), default_timeout=0,
+                          key_prefix='profiler:')
+  return SimpleCache(default_timeout=0)
+
+
+backend = _default_backend()
+
+
+def get_settings():
+  """Returns the profiling settings: {'routes': [...], 'sample_rate': p}."""
+  now = time.time()
+  if _local['settings'] is None or now - _local['read'] > SETTINGS_TTL:
+    _local['settings'] = backend.get(_SETTINGS_KEY) or {
+        'routes': [], 'sample_rate': 0.0}
+    _local['read'] = now
+  return _local['settings']
+
+
+def set_settings(routes, sample_rate):
+  """Chooses the routes to profile and the fraction of requests sampled."""
+  if not 0 <= sample_rate <= 1:
+    raise ValueError('sample_rate must be between 0 and 1')
+  settings = {'routes': sorted(set(routes)), 'sample_rate': sample_rate}
+  backend.set(_SETTINGS_KEY, settings)
+  _local['settings'] = settings
+  _local['read'] = time.time()
+  return settings
+
+
+def _add(route, profile):
+  with _lock:
+    if route in _aggregates:
+      _aggregates[route].add(profile)
+    else:
+      _aggregates[route] = pstats.Stats(profile)
+    _counts[route] = _counts.get(route, 0) + 1
+
+
+def profiled_counts():
+  """Returns how many requests to each route this instance has profiled."""
+  with _lock:
+    return dict(_counts)
+
+
+def dump(route):
+  """Returns a route's aggregate as pstats dump data, or None."""
+  with _lock:
+    if route not in _aggregates:
+      return None
+    return marshal.dumps(_aggregates[route].stats)
+
+
+def report(route, limit=50):
+  """Returns a route's aggregate as text, by cumulative time, or None."""
+  with _lock:
+    if route not in _aggregates:
+      return None
+    out = StringIO.StringIO()
+    stats = _aggregates[route]
+    stats.stream = out
+    stats.sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
+
+
+def reset():
+  """Forgets this instance's aggregates."""
+  with _lock:
+    _aggregates.clear()
+    _counts.clear()
+
+
+class SamplingProfilerMiddleware(object):
+  """WSGI middleware profiling a sample of requests to chosen routes."""
+
+  def __init__(self, app, url_map):
+    self.app = app
+    self.url_map = url_map
+
+  def _route(self, environ):
+    try:
+      rule, _ = self.url_map.bind_to_environ(environ).match(return_rule=True)
+    except HTTPException:
+      return None
+    return rule.rule
+
+  def _wanted(self, environ):
+    settings = get_settings()
+    if not settings['routes']:
+      return None
+    route = self._route(environ)
+    if route not in settings['routes']:
+      return None
+    if environ.get(PROFILE_HEADER) and users.is_current_user_admin():
+      return route
+    if random.random() < settings['sample_rate']:
+      return route
+    return None
+
+  def __call__(self, environ, start_response):
+    route = self._wanted(environ)
+    if route is None:
+      return self.app(environ, start_response)
+    # As werkzeug's ProfilerMiddleware, buffer the body so that producing it
+    # is profiled too.
+    body = []
+
+    def run():
+      app_iter = self.app(environ, start_response)
+      try:
+        body.extend(app_iter)
+      finally:
+        if hasattr(app_iter, 'close'):
+          app_iter.close()
+
+    profile = cProfile.Profile()
+    try:
+      profile.runcall(run)
+    finally:
+      _add(route, profile)
+    return body
+
+
+def install(app):
+  """Adds sampling profiling to a Flask app."""
+  app.wsgi_app = SamplingProfilerMiddleware(app.wsgi_app, app.url_map)
@@ -0,0 +1,208 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Google, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Rollups: open/high/low/close price bars at several resolutions.
+
+Every trade records a tick, which is folded into one 5 minute, hourly, daily
+and weekly bar. Ticks are batched per market off the request path (see
+activity.py) and may arrive out of order. Bars are stored BARS_PER_CHUNK to a
+PriceBars entity, so a chart of a few hundred points is one or two gets
+whatever the market's age.
+
+Daily and weekly bars fall back to the daily prices of PriceHistory (see
+price.py) where no trade made a bar, so a market's history from before bars
+were kept, and the days it was not traded, still chart.
+"""
+
+import array
+import bisect
+import collections
+import datetime
+
+from models import PriceBars, history_key, run_in_transaction, to_timestamp
+from google.appengine.ext import ndb
+
+# Bar length in seconds for each resolution, finest first.
+RESOLUTIONS = collections.OrderedDict([
+    ('5m', 5 * 60),
+    ('1h', 60 * 60),
+    ('1d', 24 * 60 * 60),
+    ('1w', 7 * 24 * 60 * 60),
+])
+# Bars held by each PriceBars entity.
+BARS_PER_CHUNK = 512
+# Most bars returned by one get_bars call.
+MAX_BARS = 5000
+# Resolutions whose missing bars are made from PriceHistory's daily prices.
+HISTORY_RESOLUTIONS = ('1d', '1w')
+
+_FIELDS = ('starts', 'opens', 'highs', 'lows', 'closes', 'open_times',
+           'close_times')
+
+
+def bars_key(prediction_key, resolution, chunk):
+  """Returns the key of the PriceBars holding chunk of a resolution."""
+  return ndb.Key(PriceBars, '%s:%s:%d' % (
+      prediction_key.urlsafe(), resolution, chunk))
+
+
+def _chunk(timestamp, resolution):
+  return int(timestamp // (RESOLUTIONS[resolution] * BARS_PER_CHUNK))
+
+
+def _unpack(entity):
+  columns = [array.array('d', getattr(entity, f) or '') for f in _FIELDS]
+  # Bars written before tick times were kept count as made at their start.
+  for times in columns[5:]:
+    if len(times) < len(columns[0]):
+      times.extend(columns[0][len(times):])
+  return columns
+
+
+def _pack(entity, columns):
+  for field, column in zip(_FIELDS, columns):
+    setattr(entity, field, column.tostring())
+
+
+def _fold(columns, timestamp, price, seconds):
+  """Folds one tick into the bar that covers it, in any order of arrival."""
+  starts, opens, highs, lows, closes, open_times, close_times = columns
+  start = timestamp - timestamp % seconds
+  i = bisect.bisect_left(starts, start)
+  if i < len(starts) and starts[i] == start:
+    highs[i] = max(highs[i], price)
+    lows[i] = min(lows[i], price)
+    if timestamp < open_times[i]:
+      opens[i] = price
+      open_times[i] = timestamp
+    if timestamp >= close_times[i]:
+      closes[i] = price
+      close_times[i] = timestamp
+  else:
+    for column, value in zip(columns, (start, price, price, price, price,
+                                       timestamp, timestamp)):
+      column.insert(i, value)
+
+
+def record_ticks(prediction_key, ticks):
+  """Folds (datetime, price) ticks into every resolution in one transaction.
+
+  Folding a tick twice leaves the bars unchanged, so a batch whose write
+  failed can simply be retried.
+  """
+  if not ticks:
+    return
+  ticks = [(to_timestamp(when), price) for when, price in ticks]
+  keys = list(collections.OrderedDict.fromkeys(
+      bars_key(prediction_key, resolution, _chunk(t, resolution))
+      for resolution in RESOLUTIONS for t, _ in ticks))
+
+  def txn():
+    entities = [e or PriceBars(key=k)
+                for k, e in zip(keys, ndb.get_multi(keys))]
+    by_key = dict((e.key, (e, _unpack(e))) for e in entities)
+    for resolution, seconds in RESOLUTIONS.items():
+      for timestamp, price in ticks:
+        key = bars_key(prediction_key, resolution,
+                       _chunk(timestamp, resolution))
+        _fold(by_key[key][1], timestamp, price, seconds)
+    for entity, columns in by_key.values():
+      _pack(entity, columns)
+    ndb.put_multi(entities)
+
+  run_in_transaction(txn)
+
+
+def _history_keys(prediction_key, start, end):
+  """Returns the keys of the PriceHistory months overlapping [start, end)."""
+  first = datetime.datetime.utcfromtimestamp(max(start, 0))
+  last = datetime.datetime.utcfromtimestamp(max(end, 0))
+  year, month = first.year, first.month
+  keys = []
+  while (year, month) <= (last.year, last.month):
+    keys.append(history_key(prediction_key, datetime.datetime(year, month, 1)))
+    year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+  return keys
+
+
+def pick_resolution(start, end, max_points=500):
+  """Returns the finest resolution giving at most max_points bars."""
+  for resolution, seconds in RESOLUTIONS.items():
+    if (end - start) / seconds <= max_points:
+      return resolution
+  return next(reversed(RESOLUTIONS))
+
+
+@ndb.tasklet
+def get_bars_async(prediction_key, resolution, start, end):
+  """Returns the bars of a resolution starting in [start, end) seconds.
+
+  Each bar is a dict of time, open, high, low and close. Daily and weekly
+  bars no trade made are filled from PriceHistory. Raises ValueError for an
+  unknown resolution or a range of more than MAX_BARS bars.
+  """
+  if resolution not in RESOLUTIONS:
+    raise ValueError('Unknown resolution %r' % resolution)
+  if (end - start) / RESOLUTIONS[resolution] > MAX_BARS:
+    raise ValueError('Too many bars requested')
+  keys = [bars_key(prediction_key, resolution, chunk)
+          for chunk in range(_chunk(start, resolution),
+                             _chunk(end, resolution) + 1)]
+  history_keys = []
+  if resolution in HISTORY_RESOLUTIONS:
+    history_keys = _history_keys(prediction_key, start, end)
+  entities, histories = yield (ndb.get_multi_async(keys),
+                               ndb.get_multi_async(history_keys))
+  traded = [bar for entity in entities if entity is not None
+            for bar in zip(*_unpack(entity))]
+  daily = [array.array('d') for _ in _FIELDS]
+  for history in histories:
+    if history is not None:
+      for when, price in history.points():
+        _fold(daily, to_timestamp(when), price, RESOLUTIONS[resolution])
+  starts = set(bar[0] for bar in traded)
+  bars = sorted(traded + [bar for bar in zip(*daily) if bar[0] not in starts])
+  raise ndb.Return([dict(zip(('time', 'open', 'high', 'low', 'close'), bar))
+                    for bar in bars if start <= bar[0] < end])
+
+
+def get_bars(prediction_key, resolution, start, end):
+  """Synchronous get_bars_async."""
+  return get_bars_async(prediction_key, resolution, start, end).get_result()
+
+
+def closes_at(prediction_keys, timestamp, resolution='1h'):
+  """Returns each market's close in the last bar starting by timestamp.
+
+  Looks back no further than the previous chunk; None where there is no such
+  bar.
+  """
+  chunk = _chunk(timestamp, resolution)
+  keys = [bars_key(key, resolution, c)
+          for key in prediction_keys for c in (chunk - 1, chunk)]
+  entities = ndb.get_multi(keys)
+  closes = []
+  for i in range(len(prediction_keys)):
+    close = None
+    for entity in entities[2 * i:2 * i + 2]:
+      if entity is None:
+        continue
+      columns = _unpack(entity)
+      j = bisect.bisect_right(columns[0], timestamp)
+      if j:
+        close = columns[4][j - 1]
+    closes.append(close)
+  return closes
@@ -18,9 +18,14 @@
 This program handles properly importing the App Engine SDK so that test modules
 can use google.appengine.* APIs and the Google App Engine testbed.
 
-Example invocation:
+With --stubs the tests run against the in-memory stand-ins of
+appengine_stubs.py instead, with no SDK, which checks that the stand-ins
+loadtest.py relies on behave like the SDK.
+
+Example invocations:
 
     $ python runner.py ~/google-cloud-sdk
+    $ python runner.py --stubs
 """
 
 import argparse
@@ -47,7 +52,16 @@ def fixup_paths(path):
     sys.path.insert(0, path)
 
 
-def main(sdk_path, test_path, test_pattern):
+def main(sdk_path, test_path, test_pattern, stubs=False):
+    if stubs:
+        import appengine_stubs
+        appengine_stubs.install()
+        os.environ.setdefault('SECRET_KEY', 'TEST_SECRET')
+        import appengine_config
+        (appengine_config)
+        suite = unittest.loader.TestLoader().discover(test_path, test_pattern)
+        return unittest.TextTestRunner(verbosity=2).run(suite)
+
     # If the SDK path points to a Google Cloud SDK installation
     # then we should alter it to point to the GAE platform location.
     if os.path.exists(os.path.join(sdk_path, 'platform/google_appengine')):
@@ -79,8 +93,11 @@ if __name__ == '__main__':
         description=__doc__,
         formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument(
-        'sdk_path',
+        'sdk_path', nargs='?',
         help='The path to the Google App Engine SDK or the Google Cloud SDK.')
+    parser.add_argument(
+        '--stubs', action='store_true',
+        help='Run against the stand-ins in appengine_stubs.py, not an SDK.')
     parser.add_argument(
         '--test-path',
         help='The path to look for tests, defaults to the current directory.',
@@ -91,8 +108,11 @@ if __name__ == '__main__':
         default='*_test.py')
 
     args = parser.parse_args()
+    if not args.sdk_path and not args.stubs:
+        parser.error('give the SDK path, or --stubs')
 
-    result = main(args.sdk_path, args.test_path, args.test_pattern)
+    result = main(args.sdk_path, args.test_path, args.test_pattern,
+                  args.stubs)
 
     if not result.wasSuccessful():
         sys.exit(1)
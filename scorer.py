@@ -13,50 +13,327 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-"""Scorer: Scores all completed predictions."""
+"""Scorer: Scores all completed predictions.
+
+Predictions are scored serially by default. With SHARDED_SCORING set, the cron
+instead starts one task per prediction, which splits the prediction's traders
+into key ranges that are paid by parallel shard tasks; the last shard to
+finish marks the prediction resolved. A prediction is always finished in the
+mode it started in, so flipping SHARDED_SCORING mid-prediction pays nobody
+twice.
+"""
 
 import webapp2
 
+import collections
 import logging
-import datetime
+import os
+import time
 
-from models import Prediction, Trade, LedgerRecords, Profile
+import leaderboard
+from models import Prediction, Trade, ScoringProgress, ledger_key
+from models import run_in_transaction
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
+# Traders paid per transaction; each one is an entity group, plus the
+# progress record and the prediction, of at most 25.
+PAGE_SIZE = 20
+# Seconds a single scoring() call may run before leaving the rest for later.
+TIME_BUDGET = 480
+# Traders paid by each shard in sharded mode.
+SHARD_SIZE = 500
 
-# TODO(goldhaber): this whole function is terrible; rewrite.
-def scoring():
-  #go through all predictions, check if should be scored
-  predictions = Prediction.query(
-      ndb.AND(Prediction.outcome != "UNKNOWN", Prediction.resolved == False)).fetch()
+
+def _pay_page(progress_key, prediction_key, start_cursor, user_keys,
+              next_cursor, done, resolve):
+  """Pays one page of traders and advances the progress record.
+
+  Returns the audit entries, or None if another run already paid the page.
+  """
+  progress = progress_key.get() or ScoringProgress(key=progress_key)
+  prediction = prediction_key.get()
+  if (progress.cursor != start_cursor or progress.done or
+      prediction.resolved):
+    return None
+  loaded = ndb.get_multi(
+      user_keys + [ledger_key(k, prediction_key) for k in user_keys])
+  profiles = loaded[:len(user_keys)]
+  positions = loaded[len(user_keys):]
   audit = []
-  # Get all trades by prediction_id
-  for p in predictions:
-    resolve = p.outcome
-    trades = Trade.query(Trade.prediction_id == p.key).fetch()
-    # Get user id from those trades
-    users = [trade.user_id.get() for trade in trades]
-    for u in users:
-      # check user ledger, map outcome to 1 or 0 based on prediction outcome
-      ledger = [i for i in u.user_ledger if i.prediction_id == p.key.urlsafe()]
-      if resolve == 'CONTRACT_ONE':
-        earned = ledger[0].contract_one
+  for u, position in zip(profiles, positions):
+    if u is None:
+      continue
+    earned = 0.00
+    if position is not None:
+      # map outcome to 1 or 0 based on prediction outcome
+      if prediction.outcome == 'CONTRACT_ONE':
+        earned = position.contract_one
       else:
-        earned = ledger[0].contract_two
-      u.balance += earned
-      audit.append({'user': u, 'earned': earned})
-      u.put()
-    p.resolved = True
-    p.put()
+        earned = position.contract_two
+    u.balance += earned
+    audit.append({'user': u, 'earned': earned})
+  progress.cursor = next_cursor
+  progress.paid += len(audit)
+  progress.done = done
+  entities = [u for u in profiles if u is not None] + [progress]
+  if done and resolve:
+    prediction.resolved = True
+    entities.append(prediction)
+  ndb.put_multi(entities)
+  return audit
+
+
+def _traders(prediction_key, start_user=None, end_user=None):
+  """Query for the distinct traders of a prediction within a key range."""
+  query = Trade.query(Trade.prediction_id == prediction_key,
+                      projection=[Trade.user_id], distinct=True)
+  if start_user is not None:
+    query = query.filter(Trade.user_id >= start_user)
+  if end_user is not None:
+    query = query.filter(Trade.user_id < end_user)
+  return query.order(Trade.user_id)
+
+
+def _score_range(progress_key, prediction_key, query, deadline, resolve):
+  """Pays the traders returned by query page by page; see score_prediction."""
+  audit = []
+  while True:
+    progress = progress_key.get()
+    start_cursor = progress.cursor if progress else None
+    trades, next_cursor, more = query.fetch_page(
+        PAGE_SIZE,
+        start_cursor=Cursor(urlsafe=start_cursor) if start_cursor else None)
+    user_keys = [trade.user_id for trade in trades]
+    next_cursor = next_cursor.urlsafe() if next_cursor else start_cursor
+    paid = run_in_transaction(lambda: _pay_page(
+        progress_key, prediction_key, start_cursor, user_keys, next_cursor,
+        not more, resolve))
+    if paid is not None:
+      audit.extend(paid)
+      leaderboard.record_payouts(
+          prediction_key, [(entry['user'], entry['earned']) for entry in paid])
+    if not more:
+      return audit, True
+    if deadline is not None and time.time() >= deadline:
+      return audit, False
+
+
+def score_prediction(prediction_key, deadline=None):
+  """Pays out a resolved prediction page by page.
+
+  Progress is committed with each page, so an interrupted run resumes where it
+  stopped and never pays a trader twice. A prediction whose sharded scoring
+  has started is handed back to its shards. Returns (audit, finished).
+  """
+  progress_key = ndb.Key(ScoringProgress, prediction_key.urlsafe())
+  if not run_in_transaction(lambda: _claim_serial(prediction_key)):
+    executor.submit('plan', prediction_id=prediction_key.urlsafe())
+    return [], True
+  return _score_range(progress_key, prediction_key, _traders(prediction_key),
+                      deadline, True)
+
+
+def _claim_serial(prediction_key):
+  """Creates the serial progress record unless sharded scoring has begun."""
+  progress_key = ndb.Key(ScoringProgress, prediction_key.urlsafe())
+  progress, shard_list = ndb.get_multi(
+      [progress_key, _shard_list_key(prediction_key)])
+  if progress is not None:
+    return True
+  if shard_list is not None:
+    return False
+  ScoringProgress(key=progress_key).put()
+  return True
+
+
+def score_all(deadline=None):
+  """Scores predictions with an outcome until done or past the deadline.
+
+  Returns (audit, finished).
+  """
+  audit = []
+  for key in _unscored():
+    paid, finished = score_prediction(key, deadline)
+    audit.extend(paid)
+    if not finished:
+      return audit, False
+  return audit, True
+
+
+def scoring():
+  """Scores every prediction with an outcome; returns the payouts made."""
+  audit, _ = score_all()
   return audit
 
 
+def _unscored():
+  return Prediction.query(
+      ndb.AND(Prediction.outcome != "UNKNOWN", Prediction.resolved == False)
+  ).fetch(keys_only=True)
+
+
+def _shard_list_key(prediction_key):
+  return ndb.Key(ScoringProgress, prediction_key.urlsafe() + ':shards')
+
+
+def _shard_key(prediction_key, shard):
+  return ndb.Key(ScoringProgress, '%s:%d' % (prediction_key.urlsafe(), shard))
+
+
+def _claim_shards(prediction_key, starts):
+  """Gets or creates the shard list, unless serial scoring has begun.
+
+  Returns the shard list, or None if the prediction is being scored serially.
+  """
+  shard_list, serial = ndb.get_multi(
+      [_shard_list_key(prediction_key),
+       ndb.Key(ScoringProgress, prediction_key.urlsafe())])
+  if shard_list is not None:
+    return shard_list
+  if serial is not None:
+    return None
+  shard_list = ScoringProgress(key=_shard_list_key(prediction_key),
+                               shards=len(starts), shard_starts=starts)
+  shard_list.put()
+  return shard_list
+
+
+def plan_shards(prediction_id):
+  """Splits a prediction's traders into shards and starts a task for each.
+
+  The split is stored once, in a transaction; concurrent or retried plans
+  reuse it, never overwrite a shard record, and only restart shards that have
+  not finished. A prediction already being scored serially is finished that
+  way instead.
+  """
+  prediction_key = ndb.Key(urlsafe=prediction_id)
+  shard_list = _shard_list_key(prediction_key).get()
+  if shard_list is None:
+    starts = []
+    query = _traders(prediction_key)
+    cursor, more = None, True
+    while more:
+      page, cursor, more = query.fetch_page(SHARD_SIZE, start_cursor=cursor)
+      if page:
+        starts.append(page[0].user_id)
+    shard_list = run_in_transaction(
+        lambda: _claim_shards(prediction_key, starts))
+    if shard_list is None:
+      _, finished = score_prediction(prediction_key,
+                                     time.time() + TIME_BUDGET)
+      if not finished:
+        executor.submit('plan', prediction_id=prediction_id)
+      return
+  starts = shard_list.shard_starts
+  ends = starts[1:] + [None]
+  shards = [
+      ScoringProgress.get_or_insert(_shard_key(prediction_key, i).id(),
+                                    start_user=start, end_user=end)
+      for i, (start, end) in enumerate(zip(starts, ends))]
+  for i, shard in enumerate(shards):
+    if not shard.done:
+      executor.submit('shard', prediction_id=prediction_id, shard=str(i))
+  _resolve_if_complete(prediction_key)
+
+
+def score_shard(prediction_id, shard):
+  """Pays one shard of a prediction's traders, then checks the barrier."""
+  prediction_key = ndb.Key(urlsafe=prediction_id)
+  shard_key = _shard_key(prediction_key, int(shard))
+  progress = shard_key.get()
+  query = _traders(prediction_key, progress.start_user, progress.end_user)
+  audit, _ = _score_range(shard_key, prediction_key, query, None, False)
+  logging.info('Paid %d traders in shard %s of %s', len(audit), shard,
+               prediction_id)
+  _resolve_if_complete(prediction_key)
+
+
+def _resolve_if_complete(prediction_key):
+  """Marks the prediction resolved once every one of its shards is done."""
+  shard_list = _shard_list_key(prediction_key).get()
+  shards = ndb.get_multi(
+      [_shard_key(prediction_key, i) for i in range(shard_list.shards)])
+  if not all(shard.done for shard in shards):
+    return
+
+  @ndb.transactional
+  def resolve():
+    prediction = prediction_key.get()
+    if not prediction.resolved:
+      prediction.resolved = True
+      prediction.put()
+
+  resolve()
+
+
+class TaskQueueExecutor(object):
+  """Runs scoring jobs as push tasks on the scorer queue."""
+
+  def submit(self, job, **params):
+    taskqueue.add(url='/tasks/scorer/' + job, params=params,
+                  queue_name='scorer')
+
+
+class LocalExecutor(object):
+  """Runs scoring jobs in-process, in submission order, on run()."""
+
+  def __init__(self):
+    self.pending = collections.deque()
+
+  def submit(self, job, **params):
+    self.pending.append((job, params))
+
+  def run(self):
+    while self.pending:
+      job, params = self.pending.popleft()
+      JOBS[job](**params)
+
+
+JOBS = {'plan': plan_shards, 'shard': score_shard}
+
+
+def _default_executor():
+  if os.environ.get('SERVER_SOFTWARE'):
+    return TaskQueueExecutor()
+  return LocalExecutor()
+
+
+executor = _default_executor()
+
+
+def fan_out():
+  """Starts sharded scoring of every prediction with an outcome."""
+  prediction_keys = _unscored()
+  for key in prediction_keys:
+    executor.submit('plan', prediction_id=key.urlsafe())
+  return prediction_keys
+
+
 class ScorerHandler(webapp2.RequestHandler):
 
   def get(self):
-    audit = scoring()
+    if os.environ.get('SHARDED_SCORING') == 'true':
+      logging.info('Started scoring %d predictions', len(fan_out()))
+      self.response.status = 204
+      return
+    audit, finished = score_all(time.time() + TIME_BUDGET)
     logging.info(str(audit))
+    if not finished:
+      # Out of time; carry on in a fresh request.
+      taskqueue.add(url='/tasks/scorer', method='GET')
+    self.response.status = 204
+
+
+class ScorerJobHandler(webapp2.RequestHandler):
+
+  def post(self, job):
+    JOBS[job](**dict(self.request.POST.items()))
     self.response.status = 204
 
 
-app = webapp2.WSGIApplication([('/.*', ScorerHandler),], debug=True)
+app = webapp2.WSGIApplication([
+    ('/tasks/scorer/(plan|shard)', ScorerJobHandler),
+    ('/.*', ScorerHandler),
+], debug=True)
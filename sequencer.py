@@ -0,0 +1,240 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Google, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Sequencer: Applies queued trades to a market in batches.
+
+In sequencing mode /trades/create stores a TradeTicket and queues it by
+prediction instead of writing the Prediction itself. A single worker per
+market then drains the queue and applies each batch of trades, in order, with
+one write of the market state.
+"""
+
+import webapp2
+
+import collections
+import datetime
+import logging
+import os
+import threading
+import time
+
+import activity
+import leaderboard
+import market_cache
+
+from models import ApplyTrade, Trade, TradeTicket
+from models import ledger_key, run_in_transaction
+from google.appengine.ext import ndb
+
+# Trades applied per transaction. Each trader adds an entity group, and a
+# cross-group transaction may touch at most 25.
+MAX_BATCH = 20
+# How long a worker holds leased orders before they are handed out again.
+LEASE_SECONDS = 60
+# Seconds per worker bucket; at most one worker per market starts per bucket.
+WORKER_INTERVAL = 1
+
+
+class LocalTradeQueue(object):
+  """In-process queue of tickets per market, for running off App Engine."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._queues = collections.defaultdict(collections.deque)
+
+  def add(self, prediction_key, ticket_key):
+    with self._lock:
+      self._queues[prediction_key.urlsafe()].append(ticket_key)
+
+  def lease(self, prediction_key, max_tasks):
+    """Returns up to max_tasks (ticket_key, handle) pairs in queue order."""
+    with self._lock:
+      queue = self._queues[prediction_key.urlsafe()]
+      return [(queue.popleft(), None)
+              for _ in range(min(max_tasks, len(queue)))]
+
+  def delete(self, handles):
+    pass
+
+  def notify(self, prediction_key):
+    # Nothing runs in the background locally; callers drain() directly.
+    pass
+
+
+class PullTradeQueue(object):
+  """App Engine pull queue of tickets, tagged by market."""
+
+  def __init__(self, queue_name='trades', worker_queue_name='sequencer',
+               worker_url='/tasks/sequencer', clock=time.time):
+    from google.appengine.api import taskqueue
+    self._taskqueue = taskqueue
+    self._clock = clock
+    self._queue = taskqueue.Queue(queue_name)
+    self._worker_queue_name = worker_queue_name
+    self._worker_url = worker_url
+
+  def add(self, prediction_key, ticket_key):
+    self._queue.add(self._taskqueue.Task(
+        payload=ticket_key.urlsafe(), method='PULL',
+        tag=prediction_key.urlsafe()))
+
+  def lease(self, prediction_key, max_tasks):
+    """Returns up to max_tasks (ticket_key, task) pairs in queue order."""
+    tasks = self._queue.lease_tasks_by_tag(
+        LEASE_SECONDS, max_tasks, tag=prediction_key.urlsafe())
+    return [(ndb.Key(urlsafe=task.payload), task) for task in tasks]
+
+  def delete(self, handles):
+    self._queue.delete_tasks(handles)
+
+  def notify(self, prediction_key):
+    """Makes sure a worker for the market runs after this ticket was added.
+
+    Workers are named by WORKER_INTERVAL bucket and only start once their
+    bucket has ended, so every ticket added during a bucket is seen by that
+    bucket's worker, however early an earlier worker drained and exited.
+    """
+    prediction_id = prediction_key.urlsafe()
+    bucket = int(self._clock() // WORKER_INTERVAL) + 1
+    try:
+      self._taskqueue.add(
+          url=self._worker_url,
+          params={'prediction_id': prediction_id},
+          name='seq-%s-%d' % (prediction_id, bucket),
+          eta=datetime.datetime.utcfromtimestamp(bucket * WORKER_INTERVAL),
+          queue_name=self._worker_queue_name)
+    except (self._taskqueue.TaskAlreadyExistsError,
+            self._taskqueue.TombstonedTaskError):
+      # The bucket's worker is already scheduled and has not started yet.
+      pass
+
+
+def _default_backend():
+  if os.environ.get('SERVER_SOFTWARE'):
+    return PullTradeQueue()
+  return LocalTradeQueue()
+
+
+backend = _default_backend()
+
+
+def enqueue(trade):
+  """Queue a trade for its market's sequencer; returns the ticket key."""
+  ticket = TradeTicket(
+      parent=trade.user_id,
+      prediction_id=trade.prediction_id,
+      direction=trade.direction,
+      contract=trade.contract,
+      quantity=trade.quantity)
+  ticket_key = ticket.put()
+  backend.add(trade.prediction_id, ticket_key)
+  backend.notify(trade.prediction_id)
+  return ticket_key
+
+
+def _apply_batch(prediction_key, ticket_keys):
+  """Fills or rejects a batch of tickets against fresh market state.
+
+  Returns the tickets, the filled trades, how many of them were their
+  trader's first in the market and the (profile, prediction, position) each
+  trader with a fill was left with.
+  """
+  tickets = [t for t in ndb.get_multi(ticket_keys)
+             if t is not None and t.status == 'PENDING']
+  if not tickets:
+    return [], [], 0, []
+  user_keys = list(collections.OrderedDict.fromkeys(
+      t.key.parent() for t in tickets))
+  loaded = ndb.get_multi(
+      [prediction_key] + user_keys +
+      [ledger_key(user_key, prediction_key) for user_key in user_keys])
+  prediction = loaded[0]
+  profiles = dict(zip(user_keys, loaded[1:len(user_keys) + 1]))
+  positions = dict(zip(user_keys, loaded[len(user_keys) + 1:]))
+  now = datetime.datetime.now()
+  writes = collections.OrderedDict()
+  filled = []
+  new_traders = 0
+  for ticket in tickets:
+    writes[id(ticket)] = ticket
+    profile = profiles[ticket.key.parent()]
+    trade = Trade(
+        parent=ticket.key.parent(),
+        prediction_id=prediction_key,
+        user_id=ticket.key.parent(),
+        direction=ticket.direction,
+        contract=ticket.contract,
+        quantity=ticket.quantity)
+    entities = 'error'
+    if prediction is not None and profile is not None:
+      entities = ApplyTrade(prediction, profile, trade,
+                            positions[ticket.key.parent()])
+    if entities == 'error':
+      ticket.status = 'REJECTED'
+    else:
+      ticket.status = 'FILLED'
+      ticket.fill_price = trade.cost
+      ticket.filled_time = now
+      if positions[ticket.key.parent()] is None:
+        new_traders += 1
+      positions[ticket.key.parent()] = entities[3]
+      filled.append(trade)
+      for entity in entities:
+        writes[id(entity)] = entity
+  ndb.put_multi(writes.values())
+  traders = collections.OrderedDict.fromkeys(
+      trade.user_id for trade in filled)
+  updates = [(profiles[user_key], prediction, positions[user_key])
+             for user_key in traders]
+  return tickets, filled, new_traders, updates
+
+
+def drain(prediction_key):
+  """Apply a market's queued trades until its queue is empty.
+
+  Tickets that are no longer PENDING are skipped, so re-running a batch whose
+  transaction committed but whose queue entries were not deleted is safe.
+  """
+  processed = 0
+  while True:
+    leased = backend.lease(prediction_key, MAX_BATCH)
+    if not leased:
+      break
+    ticket_keys = [ticket_key for ticket_key, _ in leased]
+    tickets, trades, new_traders, updates = run_in_transaction(
+        lambda: _apply_batch(prediction_key, ticket_keys))
+    backend.delete([handle for _, handle in leased])
+    if updates:
+      # Every update holds the same, committed, market.
+      market_cache.update(updates[0][1])
+    activity.record(prediction_key, trades, new_traders)
+    leaderboard.record_positions(updates)
+    if trades:
+      leaderboard.schedule_revalue(prediction_key)
+    processed += len(tickets)
+  return processed
+
+
+class SequencerHandler(webapp2.RequestHandler):
+
+  def post(self):
+    prediction_key = ndb.Key(urlsafe=self.request.get('prediction_id'))
+    processed = drain(prediction_key)
+    logging.info('Sequenced %d trades for %s', processed,
+                 prediction_key.urlsafe())
+    self.response.status = 204
+
+
+app = webapp2.WSGIApplication([('/.*', SequencerHandler),], debug=True)
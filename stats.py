@@ -0,0 +1,210 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Google, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Stats: trading volume, activity and trending per market.
+
+Committed trades add to sharded hourly ActivityShard counters, batched per
+market off the request path by activity.py. A periodic compaction
+(/tasks/stats) folds finished hours into each Prediction's totals, recomputes
+the last 24 hours' volume, trades and price change, and deletes shards that
+have dropped out of the window, so the board can sort on plain indexed
+properties.
+"""
+
+import webapp2
+
+import datetime
+import logging
+import random
+import time
+
+import rollups
+
+from models import ActivityShard, Prediction
+from models import run_in_transaction, to_timestamp
+from google.appengine.api import datastore_errors
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+# Counter shards per market per hour.
+SHARDS = 4
+# Hours in the rolling window.
+WINDOW_HOURS = 24
+# Most hours of shards a compaction will look back over; compaction must run
+# more often than every RETAIN_HOURS - WINDOW_HOURS hours.
+RETAIN_HOURS = 48
+# Markets compacted per transaction; each is an entity group.
+PAGE_SIZE = 20
+# Seconds a single compact() call may run before leaving the rest for later.
+TIME_BUDGET = 480
+# How much a move of the whole probability range multiplies trending.
+TRENDING_PRICE_WEIGHT = 10
+
+
+def _hour(when):
+  return int(to_timestamp(when) // 3600)
+
+
+def shard_key(prediction_key, hour, shard):
+  """Returns the key of one ActivityShard of a market's hour."""
+  return ndb.Key(ActivityShard, '%s:%d:%d' % (
+      prediction_key.urlsafe(), hour, shard))
+
+
+def record_activity(prediction_key, hours):
+  """Adds a batch of a market's committed trades to its hourly counters.
+
+  hours maps an hour (since the epoch) to (volume, trades, new traders) made
+  in it, where volume is the points that changed hands. Raises if the write
+  fails, so the batch can be retried.
+  """
+  keys = dict((hour, shard_key(prediction_key, hour,
+                               random.randint(0, SHARDS - 1)))
+              for hour in hours)
+
+  def txn():
+    shards = dict(zip(keys, ndb.get_multi(keys.values())))
+    for hour, (volume, trades, traders) in hours.items():
+      shard = shards[hour] or ActivityShard(key=keys[hour])
+      shard.volume += volume
+      shard.trades += trades
+      shard.traders += traders
+      shards[hour] = shard
+    ndb.put_multi(shards.values())
+
+  if hours:
+    run_in_transaction(txn)
+
+
+def trending(trades_24h, price_change_24h):
+  """Returns the trending score of a market's last 24 hours."""
+  return trades_24h * (1 + TRENDING_PRICE_WEIGHT * abs(price_change_24h))
+
+
+def _compact_page(predictions, now_hour):
+  """Folds a page of markets' shards into them; returns the shards to drop.
+
+  The page is written in one transaction. If that keeps colliding with
+  trades, each market is compacted in its own transaction instead, and a
+  market that still collides is left for the next run.
+  """
+  window_start = now_hour - WINDOW_HOURS + 1
+  # Shards from before the last compaction's window have been dropped.
+  first_hours = dict(
+      (p.key, max(now_hour - RETAIN_HOURS,
+                  min(p.stats_hour - WINDOW_HOURS + 1, window_start)))
+      for p in predictions)
+  keys = [shard_key(key, hour, shard) for key, first in first_hours.items()
+          for hour in range(first, now_hour + 1) for shard in range(SHARDS)]
+  shards = dict((k, v) for k, v in zip(keys, ndb.get_multi(keys)) if v)
+  prediction_keys = first_hours.keys()
+  before = dict(zip(prediction_keys, rollups.closes_at(
+      prediction_keys, window_start * 3600 - 1)))
+
+  def fold(prediction):
+    """Updates one loaded market; returns whether anything changed."""
+    fold_from = max(prediction.stats_hour, first_hours[prediction.key])
+    volume, trade_count, trader_count = (
+        prediction.volume, prediction.trade_count, prediction.trader_count)
+    volume_24h, trades_24h = 0.00, 0
+    for hour in range(first_hours[prediction.key], now_hour + 1):
+      for shard in range(SHARDS):
+        counts = shards.get(shard_key(prediction.key, hour, shard))
+        if counts is None:
+          continue
+        if fold_from <= hour < now_hour:
+          volume += counts.volume
+          trade_count += counts.trades
+          trader_count += counts.traders
+        if hour >= window_start:
+          volume_24h += counts.volume
+          trades_24h += counts.trades
+    change = 0.00
+    if before[prediction.key] is not None:
+      change = prediction.GetPriceByPredictionId() - before[prediction.key]
+    values = dict(
+        volume=volume, trade_count=trade_count, trader_count=trader_count,
+        volume_24h=volume_24h, trades_24h=trades_24h,
+        price_change_24h=change, trending=trending(trades_24h, change))
+    if all(getattr(prediction, name) == value
+           for name, value in values.items()):
+      # Nothing folded or moved, so leave the market (and stats_hour) alone.
+      return False
+    prediction.populate(stats_hour=now_hour, **values)
+    return True
+
+  def txn(keys):
+    ndb.put_multi([prediction for prediction in ndb.get_multi(keys)
+                   if prediction is not None and fold(prediction)])
+
+  compacted = prediction_keys
+  try:
+    run_in_transaction(lambda: txn(prediction_keys))
+  except datastore_errors.TransactionFailedError:
+    compacted = []
+    for key in prediction_keys:
+      try:
+        run_in_transaction(lambda: txn([key]))
+        compacted.append(key)
+      except datastore_errors.TransactionFailedError:
+        logging.warning('Left activity of %s for the next compaction',
+                        key.urlsafe())
+  return [key for key in shards
+          if int(key.id().rsplit(':', 2)[1]) < window_start and
+          ndb.Key(urlsafe=key.id().rsplit(':', 2)[0]) in compacted]
+
+
+def compact(cursor=None, deadline=None):
+  """Compacts the counters of every open market, a page at a time.
+
+  Returns (markets compacted, next cursor or None if finished).
+  """
+  now_hour = _hour(datetime.datetime.now())
+  query = Prediction.query(
+      ndb.AND(Prediction.outcome == 'UNKNOWN', Prediction.resolved == False))
+  compacted = 0
+  while True:
+    predictions, cursor, more = query.fetch_page(
+        PAGE_SIZE, start_cursor=cursor)
+    if predictions:
+      ndb.delete_multi(_compact_page(predictions, now_hour))
+    compacted += len(predictions)
+    if not more or not cursor:
+      return compacted, None
+    if deadline is not None and time.time() >= deadline:
+      return compacted, cursor
+
+
+class StatsHandler(webapp2.RequestHandler):
+
+  def get(self):
+    self.post()
+
+  def post(self):
+    cursor = self.request.get('cursor')
+    compacted, next_cursor = compact(
+        Cursor(urlsafe=cursor) if cursor else None,
+        time.time() + TIME_BUDGET)
+    logging.info('Compacted activity of %d markets', compacted)
+    if next_cursor:
+      # Out of time; carry on in a fresh request.
+      taskqueue.add(url='/tasks/stats',
+                    params={'cursor': next_cursor.urlsafe()})
+    self.response.status = 204
+
+
+app = webapp2.WSGIApplication([('/.*', StatsHandler),], debug=True)